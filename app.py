@@ -1,86 +1,231 @@
 # app.py
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session
-import pickle
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session, g, Response
+import csv
+import io
 import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import numpy as np
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder, StandardScaler
-from sklearn.cluster import KMeans
-from sklearn.ensemble import GradientBoostingClassifier
-import sqlite3
+from db import Database
+from migrations import is_current, migrate
+from purchase_writer import GroupCommitWriter, WriterOverloaded
+from spending_summary import EXPORT_COLUMNS, iter_purchase_chunks, record_purchases, user_summary
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import current_user, login_user, logout_user, login_required, LoginManager, UserMixin
 from datetime import datetime
 import traceback # For detailed error logging
+import warnings
+from model_bundle import BundleError, ModelSet, current_version, load_bundle, load_current_bundle, set_current_version
+from model_schema import (BUNDLES_DIR, CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES,
+                          validate_numeric_fields)
+from price_table import PriceTableManager
+from pricing import PricingRulesFile
+from metrics import Registry, SamplingProfiler, StageTimer
+from micro_batcher import BatcherOverloaded, MicroBatcher
+from prediction_cache import PredictionCache
+from profile_cache import ProfileCache
+from shadow import ShadowError, ShadowEvaluator
+from traffic_capture import TrafficRecorder
 
 # --- Configuration ---
-MODEL_DIR = 'trained_models'
-# Corrected feature names to match the Colab notebook exactly for model input
-SEGMENTATION_FEATURES = [
-    'Age', 'Gender', 'City', 'Occupation', 'Product_Category',
-    'Weather', 'Time_of_Day', 'Loyalty_Tier', 'Age_Group',
-    'User_Product_Count', 'Purchase_Amount_Scaled'
-]
-GB_FEATURES = [
-    'Age', 'Gender', 'City', 'Occupation', 'Product_Category',
-    'Weather', 'Time_of_Day', 'Loyalty_Tier',
-    'User_Product_Count', 'Age_Group',
-    'Purchase_Amount_Scaled', 'CustomerSegment' # CustomerSegment is the numerical ID
-]
-# Categorical features that need Label Encoding
-CATEGORICAL_COLS = [
-    'Gender', 'City', 'Occupation', 'Product_Category',
-    'Weather', 'Time_of_Day', 'Loyalty_Tier'
-]
-DATABASE = 'users_data.db'
+# Feature lists and MODEL_DIR live in model_schema.py (shared with the offline tools)
+DATABASE = os.environ.get('DATABASE_PATH', 'users_data.db')
+# SQLite tuning for the per-thread connections in db.Database
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KIB = int(os.environ.get('DB_CACHE_SIZE_KIB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 268435456))
+# 'direct' commits each checkout in its own transaction; 'group' hands it to a background writer that
+# group-commits all checkouts arriving within PURCHASE_GROUP_COMMIT_MS and acks each one after the commit
+PURCHASE_WRITE_MODE = os.environ.get('PURCHASE_WRITE_MODE', 'direct')
+PURCHASE_GROUP_COMMIT_MS = float(os.environ.get('PURCHASE_GROUP_COMMIT_MS', 5))
+PURCHASE_ACK_TIMEOUT = float(os.environ.get('PURCHASE_ACK_TIMEOUT', 10))
+# Longest Idempotency-Key accepted by /complete_purchase
+MAX_IDEMPOTENCY_KEY_LENGTH = 128
+# Orders shown per /my_orders page (keyset pagination)
+ORDERS_PAGE_SIZE = int(os.environ.get('ORDERS_PAGE_SIZE', 50))
+# Purchases read per keyset query while streaming an order history CSV
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 1000))
+# Set FAST_INFERENCE=0 to always run the sklearn models instead of the flattened array evaluator
+FAST_INFERENCE = os.environ.get('FAST_INFERENCE', '1') != '0'
+# In-process cache of model outputs per encoded feature vector (size 0 disables it)
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 300))
+# Per-process user profile cache; the TTL bounds staleness from purchases made in other workers
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 50000))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 30))
+# Upper bound on items accepted by /predict_price_batch in one call
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', 500))
+# Cross-request micro-batching of model calls (micro_batcher.py), for threaded workers. Requests arriving within
+# INFERENCE_BATCH_WINDOW_MS (up to INFERENCE_BATCH_MAX_ITEMS rows) share one model call; with more than
+# INFERENCE_MAX_PENDING requests waiting, new ones get a 503 instead of joining the backlog.
+INFERENCE_MICRO_BATCHING = os.environ.get('INFERENCE_MICRO_BATCHING', '0') == '1'
+INFERENCE_BATCH_WINDOW_MS = float(os.environ.get('INFERENCE_BATCH_WINDOW_MS', 2))
+INFERENCE_BATCH_MAX_ITEMS = int(os.environ.get('INFERENCE_BATCH_MAX_ITEMS', 64))
+INFERENCE_MAX_PENDING = int(os.environ.get('INFERENCE_MAX_PENDING', 1024))
+INFERENCE_TIMEOUT = float(os.environ.get('INFERENCE_TIMEOUT', 2))
+# Upper bound on grid points evaluated by one /predict_price_sweep call
+MAX_SWEEP_POINTS = int(os.environ.get('MAX_SWEEP_POINTS', 2000))
+# Memory-mapped model bundles (model_bundle.py). When MODEL_BUNDLES_DIR/CURRENT exists it is served instead
+# of the pickles, and every worker re-reads CURRENT at most every MODEL_RELOAD_CHECK_SECONDS to pick up a new version.
+MODEL_BUNDLES_DIR = os.environ.get('MODEL_BUNDLES_DIR', BUNDLES_DIR)
+MODEL_RELOAD_CHECK_SECONDS = float(os.environ.get('MODEL_RELOAD_CHECK_SECONDS', 5))
+# Segment discount caps and price floors (see pricing.py); edits to the file are picked up within
+# PRICING_RULES_CHECK_SECONDS without a restart
+PRICING_RULES_PATH = os.environ.get('PRICING_RULES_PATH', 'pricing_rules.json')
+PRICING_RULES_CHECK_SECONDS = float(os.environ.get('PRICING_RULES_CHECK_SECONDS', 5))
+# PRICE_TABLE=1 answers in-domain requests from a precomputed segment/probability table (price_table.py) instead
+# of the models. Each model version's table is built on a background thread (or mapped from PRICE_TABLE_DIR) and
+# only served while its measured error passes every gate: the table also supplies the response's segment and
+# conversion probability, so segment agreement must be at least PRICE_TABLE_MIN_SEGMENT_AGREEMENT and the p99
+# probability error at most PRICE_TABLE_MAX_PROBABILITY_ERROR, besides the p99 relative price error.
+# The default grid puts a bucket edge at every GB split (exact for served rows; ~327 MB and a few minutes of one
+# core to build for the shipped models, so prebuild with `python price_table.py build` before a deploy).
+PRICE_TABLE = os.environ.get('PRICE_TABLE', '0') == '1'
+PRICE_TABLE_DIR = os.environ.get('PRICE_TABLE_DIR', 'trained_models/price_tables')
+# Bucket edges of the raw Age, User_Product_Count and Purchase_Amount inputs: "splits", "splits:LOW:HIGH",
+# "E0,E1,...,En" or (amounts only) "geometric:N:LOW:HIGH"; see price_table.parse_edges
+PRICE_TABLE_AGE_EDGES = os.environ.get('PRICE_TABLE_AGE_EDGES', 'splits')
+PRICE_TABLE_COUNT_EDGES = os.environ.get('PRICE_TABLE_COUNT_EDGES', 'splits')
+PRICE_TABLE_AMOUNT_EDGES = os.environ.get('PRICE_TABLE_AMOUNT_EDGES', 'splits')
+PRICE_TABLE_MAX_PRICE_ERROR = float(os.environ.get('PRICE_TABLE_MAX_PRICE_ERROR', 0.10))
+PRICE_TABLE_MIN_SEGMENT_AGREEMENT = float(os.environ.get('PRICE_TABLE_MIN_SEGMENT_AGREEMENT', 0.99))
+PRICE_TABLE_MAX_PROBABILITY_ERROR = float(os.environ.get('PRICE_TABLE_MAX_PROBABILITY_ERROR', 0.02))
+# Shadow evaluation (shadow.py): a candidate model set (SHADOW_MODEL_VERSION names a bundle in MODEL_BUNDLES_DIR,
+# or SHADOW_MODEL_DIR a directory of pickles) also scores a SHADOW_SAMPLE_RATE share of pricing requests on
+# SHADOW_THREADS background threads, after the response is computed, and /admin/shadow reports how far it diverges.
+# Evaluations not finished within SHADOW_TIME_BUDGET seconds, or beyond SHADOW_MAX_QUEUED waiting, are dropped.
+SHADOW_MODEL_VERSION = os.environ.get('SHADOW_MODEL_VERSION')
+SHADOW_MODEL_DIR = os.environ.get('SHADOW_MODEL_DIR')
+SHADOW_THREADS = int(os.environ.get('SHADOW_THREADS', 1))
+SHADOW_MAX_QUEUED = int(os.environ.get('SHADOW_MAX_QUEUED', 32))
+SHADOW_TIME_BUDGET = float(os.environ.get('SHADOW_TIME_BUDGET', 0.25))
+SHADOW_SAMPLE_RATE = float(os.environ.get('SHADOW_SAMPLE_RATE', 1.0))
+# Set TRAFFIC_CAPTURE_PATH to append /predict_price and /complete_purchase payloads to that JSONL file for
+# replay with benchmarks/run_benchmarks.py (TRAFFIC_CAPTURE_SAMPLE_RATE records only a fraction of requests)
+TRAFFIC_CAPTURE_PATH = os.environ.get('TRAFFIC_CAPTURE_PATH')
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE_RATE', 1.0))
+# Token for the /admin routes (sent as the X-Admin-Token header); admin routes are disabled when unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Seconds spent in each startup phase of this process (printed at the end of startup, exported on /metrics).
+# Under gunicorn.conf.py's preload_app these run once in the master; forked workers inherit the results.
+startup_timings = {}
 
 # --- Global Model Variables ---
-label_encoders = {}
-scaler_purchase_amount = None
-scaler_segmentation_features = None
-kmeans_model = None
-segment_mapping = {}
-gb_model = None
-loading_success = True
+# The ModelSet serving requests (encoder, segmentation + conversion engine, segment mapping).
+# Hot reload replaces this single reference; each request reads it once and uses that set throughout,
+# so a swap never mixes old and new models inside one response. None means loading failed.
+models = None
+_models_lock = threading.Lock() # serializes reloads; never held while serving requests
+_last_models_check = time.monotonic()
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL)
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+pricing_rules = PricingRulesFile(PRICING_RULES_PATH, PRICING_RULES_CHECK_SECONDS)
+price_tables = PriceTableManager(PRICE_TABLE_DIR, PRICE_TABLE_MAX_PRICE_ERROR, pricing_rules.current,
+                                 PRICE_TABLE_MIN_SEGMENT_AGREEMENT, PRICE_TABLE_MAX_PROBABILITY_ERROR,
+                                 {"age_edges": PRICE_TABLE_AGE_EDGES, "count_edges": PRICE_TABLE_COUNT_EDGES,
+                                  "amount_edges": PRICE_TABLE_AMOUNT_EDGES})
+
+# Prometheus metrics served on /metrics (see metrics.py). Per-stage timings are labelled by endpoint and stage.
+metrics_registry = Registry()
+http_requests_total = metrics_registry.counter(
+    'neuroprice_http_requests_total', 'HTTP requests handled.', ('endpoint', 'method', 'status'))
+http_request_seconds = metrics_registry.histogram(
+    'neuroprice_http_request_duration_seconds', 'Time spent handling HTTP requests.', ('endpoint', 'method'))
+stage_seconds = metrics_registry.histogram(
+    'neuroprice_stage_duration_seconds', 'Time spent in each stage of a request pipeline.', ('endpoint', 'stage'))
+price_table_lookups = metrics_registry.counter(
+    'neuroprice_price_table_lookups_total', 'Rows answered from the price table (hit) or sent to the models (fallback).',
+    ('result',))
+shadow_seconds = metrics_registry.histogram(
+    'neuroprice_shadow_model_seconds', 'Time the shadow candidate spent scoring one request.')
+shadow_evaluator = ShadowEvaluator(pricing_rules.current, SHADOW_THREADS, SHADOW_MAX_QUEUED, SHADOW_TIME_BUDGET,
+                                   SHADOW_SAMPLE_RATE, on_evaluated=shadow_seconds.observe)
+profiler = SamplingProfiler()
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_PATH, TRAFFIC_CAPTURE_SAMPLE_RATE) if TRAFFIC_CAPTURE_PATH else None
+CAPTURED_ENDPOINTS = {'predict_price_api', 'complete_purchase'}
+
+# The models are fed NumPy rows built by FeatureEncoder (already in the fitted column order),
+# so sklearn's "X does not have valid feature names" warning on every call is just noise.
+warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+# Dropdown options for the register/predict forms, built once per model load instead of on every request.
+# Falls back to fixed defaults for any encoder that failed to load.
+DEFAULT_FORM_OPTIONS = {
+    'Gender': ['Male', 'Female', 'Other'],
+    'City': ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Miami'],
+    'Occupation': ['Engineer', 'Artist', 'Doctor', 'HR', 'Software Dev', 'Other'],
+    'Loyalty_Tier': ['Gold', 'Silver', 'Bronze', 'None'],
+    'Product_Category': ['Electronics', 'Fashion', 'Grocery', 'Home'],
+    'Weather': ['Sunny', 'Rainy', 'Cloudy', 'Snowy', 'Foggy'],
+    'Time_of_Day': ['Morning', 'Afternoon', 'Evening', 'Night'],
+}
+
+def build_form_options(model_set):
+    classes = model_set.feature_encoder.classes if model_set is not None else {}
+    return {col: (list(classes[col]) if classes.get(col) else defaults)
+            for col, defaults in DEFAULT_FORM_OPTIONS.items()}
+
+FORM_OPTIONS = build_form_options(None)
+
+# Loads the bundle named by version, else the CURRENT bundle, else the pickles in MODEL_DIR
+def load_models(version=None):
+    if version is not None:
+        return load_bundle(os.path.join(MODEL_BUNDLES_DIR, version))
+    bundle = load_current_bundle(MODEL_BUNDLES_DIR)
+    if bundle is not None:
+        print(f"✓ model bundle '{bundle.version}' mapped from {bundle.source}.")
+        return bundle
+    return ModelSet.from_pickles(MODEL_DIR, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS, fast_inference=FAST_INFERENCE)
+
+# A shadow candidate: the bundle named by version, or the pickles in model_dir
+def load_shadow_candidate(version=None, model_dir=None):
+    if version is not None:
+        return load_bundle(os.path.join(MODEL_BUNDLES_DIR, version))
+    return ModelSet.from_pickles(model_dir, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS,
+                                 fast_inference=FAST_INFERENCE, verbose=False)
+
+# Atomically makes model_set the one serving requests
+def install_models(model_set):
+    global models, FORM_OPTIONS
+    FORM_OPTIONS = build_form_options(model_set)
+    models = model_set
+
+# Swaps in the bundle CURRENT points at if it differs from the one being served. Returns True on a swap.
+def reload_models_if_changed():
+    with _models_lock:
+        version = current_version(MODEL_BUNDLES_DIR)
+        if version is None or (models is not None and models.version == version):
+            return False
+        new_models = load_models(version)
+        install_models(new_models)
+        print(f"Models hot-reloaded: now serving '{new_models.version}'.")
+        return True
 
 print("--- Attempting to Load Trained Models ---")
+_phase_started = time.perf_counter()
 try:
-    with open(os.path.join(MODEL_DIR, 'label_encoders.pkl'), 'rb') as f:
-        label_encoders = pickle.load(f)
-    print("✓ label_encoders loaded.")
-
-    with open(os.path.join(MODEL_DIR, 'scaler_purchase_amount.pkl'), 'rb') as f:
-        scaler_purchase_amount = pickle.load(f)
-    print("✓ scaler_purchase_amount loaded.")
-
-    with open(os.path.join(MODEL_DIR, 'scaler_segmentation_features.pkl'), 'rb') as f:
-        scaler_segmentation_features = pickle.load(f)
-    print("✓ scaler_segmentation_features loaded.")
-
-    with open(os.path.join(MODEL_DIR, 'kmeans_model.pkl'), 'rb') as f:
-        kmeans_model = pickle.load(f)
-    print("✓ kmeans_model loaded.")
-
-    with open(os.path.join(MODEL_DIR, 'segment_mapping.pkl'), 'rb') as f:
-        segment_mapping = pickle.load(f)
-    print("✓ segment_mapping loaded.")
-
-    with open(os.path.join(MODEL_DIR, 'gb_model.pkl'), 'rb') as f:
-        gb_model = pickle.load(f)
-    print("✓ gb_model loaded.")
+    install_models(load_models())
 
 except FileNotFoundError as e:
     print(f"ERROR: A required model file was not found: {e}")
     print(f"Please ensure the '{MODEL_DIR}' directory exists in the same location as app.py "
             f"and contains all .pkl files from your Colab notebook.")
-    loading_success = False
 except Exception as e:
     print(f"ERROR: An unexpected error occurred during model loading: {e}")
     print("Check your model files for corruption or version incompatibility.")
-    loading_success = False
 
-print("--- All Models Loaded Successfully ---" if loading_success else "!!! API will operate with known model loading errors. !!!")
+if models is not None and (SHADOW_MODEL_VERSION or SHADOW_MODEL_DIR):
+    try:
+        shadow_evaluator.set_candidate(load_shadow_candidate(SHADOW_MODEL_VERSION, SHADOW_MODEL_DIR), models)
+        print(f"✓ shadow candidate '{shadow_evaluator.candidate.version}' loaded; it scores live traffic in the background.")
+    except Exception as e:
+        print(f"ERROR: could not load the shadow candidate: {e}. Shadow evaluation is off.")
+
+startup_timings['models'] = time.perf_counter() - _phase_started
+print("--- All Models Loaded Successfully ---" if models is not None else "!!! API will operate with known model loading errors. !!!")
 
 
 # --- Flask App Initialization ---
@@ -105,133 +250,258 @@ class User(UserMixin):
     def get_username(self):
         return self._username
 
-# Flask-Login user loader callback
+# Flask-Login user loader callback (served from profile_cache when possible)
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    user_data = conn.execute("SELECT id, username FROM users WHERE id = ?", (user_id,)).fetchone()
-    if user_data:
-        conn.close()
-        return User(user_data['id'], username=user_data['username'])
-        
-    conn.close()
+    profile = get_user_profile(user_id)
+    if profile:
+        return User(profile['id'], username=profile['username'])
     return None
 
 # --- Database Setup Functions ---
+database = Database(DATABASE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS, cache_size_kib=DB_CACHE_SIZE_KIB,
+                    mmap_size=DB_MMAP_SIZE)
+
+# This thread's reused connection (WAL mode, cached statements). Do not close it;
+# wrap writes in database.transaction() instead of calling commit()/rollback() by hand.
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return database.connection()
 
-def init_db():
-    with app.app_context():
-        db = get_db_connection()
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                name TEXT NOT NULL,
-                age INTEGER NOT NULL,
-                gender TEXT NOT NULL,
-                city TEXT NOT NULL,
-                occupation TEXT NOT NULL,
-                loyalty_tier TEXT NOT NULL
-            )
-        ''')
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS purchases (
-                purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                product_name TEXT NOT NULL,
-                product_category TEXT NOT NULL,
-                original_price REAL NOT NULL,
-                quantity INTEGER NOT NULL,
-                purchase_date TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        db.commit()
+purchase_writer = GroupCommitWriter(database, max_delay_ms=PURCHASE_GROUP_COMMIT_MS)
+
+# Next 'user_NNN' id from the id_sequences counter (O(1), no scan over users).
+# Must run inside database.transaction(): the UPDATE holds the write lock, so concurrent
+# registrations can never be handed the same number.
+def allocate_user_id(conn):
+    conn.execute("UPDATE id_sequences SET last_value = last_value + 1 WHERE name = 'users'")
+    next_value = conn.execute("SELECT last_value FROM id_sequences WHERE name = 'users'").fetchone()[0]
+    return f"user_{next_value:03d}"
 
-        if db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+# Read-only check that lets an already initialized database skip init_db's write transaction, so starting
+# many workers at once does not queue them all on the write lock
+def _db_initialized():
+    conn = get_db_connection()
+    return (is_current(conn)
+            and conn.execute("SELECT EXISTS(SELECT 1 FROM users)").fetchone()[0]
+            and conn.execute("SELECT EXISTS(SELECT 1 FROM purchases WHERE user_id = 'user_001')").fetchone()[0])
+
+def init_db():
+    if _db_initialized():
+        return
+    with app.app_context(), database.transaction() as db:
+        # Schema changes are versioned in migrations.py
+        for version, description in migrate(db):
+            print(f"Applied schema migration {version}: {description}")
+
+        if not db.execute("SELECT EXISTS(SELECT 1 FROM users)").fetchone()[0]:
             db.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       ('user_001', 'alice_u', generate_password_hash('alicepass'), 'Alice', 28, 'Female', 'New York', 'Engineer', 'Gold'))
+                       (allocate_user_id(db), 'alice_u', generate_password_hash('alicepass'), 'Alice', 28, 'Female', 'New York', 'Engineer', 'Gold'))
             db.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       ('user_002', 'bob_u', generate_password_hash('bobpass'), 'Bob', 45, 'Male', 'Los Angeles', 'Artist', 'Silver'))
+                       (allocate_user_id(db), 'bob_u', generate_password_hash('bobpass'), 'Bob', 45, 'Male', 'Los Angeles', 'Artist', 'Silver'))
             # Added a new user for better testing of dynamic creation
             db.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       ('user_003', 'charlie_u', generate_password_hash('charliepass'), 'Charlie', 35, 'Male', 'Houston', 'Doctor', 'Bronze'))
+                       (allocate_user_id(db), 'charlie_u', generate_password_hash('charliepass'), 'Charlie', 35, 'Male', 'Houston', 'Doctor', 'Bronze'))
             print("Sample users added.")
         
         # Add sample purchases for user_001 if none exist
-        if db.execute("SELECT COUNT(*) FROM purchases WHERE user_id = 'user_001'").fetchone()[0] == 0:
-            db.execute("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) VALUES (?, ?, ?, ?, ?, ?)",
-                       ('user_001', 'Smartphone', 'Electronics', 1499.0, 1, datetime.now().isoformat()))
-            db.execute("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) VALUES (?, ?, ?, ?, ?, ?)",
-                       ('user_001', 'Organic Rice Pack', 'Grocery', 299.0, 2, datetime.now().isoformat()))
+        if not db.execute("SELECT EXISTS(SELECT 1 FROM purchases WHERE user_id = 'user_001')").fetchone()[0]:
+            sample_purchases = [('user_001', 'Smartphone', 'Electronics', 1499.0, 1, datetime.now().isoformat()),
+                                ('user_001', 'Organic Rice Pack', 'Grocery', 299.0, 2, datetime.now().isoformat())]
+            db.executemany("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) VALUES (?, ?, ?, ?, ?, ?)",
+                           sample_purchases)
+            record_purchases(db, sample_purchases)
+            quantities = {}
+            for purchase in sample_purchases:
+                quantities[purchase[0]] = quantities.get(purchase[0], 0) + purchase[4]
+            db.executemany("UPDATE users SET product_count = product_count + ? WHERE id = ?",
+                           [(quantity, user_id) for user_id, quantity in quantities.items()])
             print("Sample purchases for user_001 added.")
 
-        db.commit()
     print("Database initialized and populated with sample data.")
 
 # Call init_db() on app startup to ensure DB is ready
+_phase_started = time.perf_counter()
 with app.app_context():
     init_db()
+# No SQLite connection may cross a fork(): with preload_app the master closes its own before workers are forked
+database.close()
+startup_timings['db_init'] = time.perf_counter() - _phase_started
+print("Startup timings: " + ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in startup_timings.items()))
 
 # --- Helper Functions ---
-# Match Colab notebook's Age_Group function
-def get_age_group(age):
-    if age < 30:
-        return 0  # Young
-    elif age < 50:
-        return 1  # Mid-age
-    else:
-        return 2  # Senior
-
-# Match Colab notebook's smart_pricing logic more closely.
-def calculate_optimized_price(original_price, conversion_prob, segment_label):
-    segment_discount_caps = {
-        'Premium Buyer': 0.95,
-        'Impulse Buyer': 0.90,
-        'Bargain Hunter': 0.88,
-        'Budget Buyer': 0.85,
-        'New Customer': 0.85
+# Profile dict for one users row: id/username plus keys matching Colab notebook's feature names
+def _profile_from_row(user_row):
+    return {
+        'id': user_row['id'],
+        'username': user_row['username'],
+        'Age': user_row['age'],
+        'Gender': user_row['gender'],
+        'City': user_row['city'],
+        'Occupation': user_row['occupation'],
+        'Loyalty_Tier': user_row['loyalty_tier'],
+        'User_Product_Count': user_row['product_count'] # Materialized purchase total, no SUM over history
     }
-    
-    threshold = segment_discount_caps.get(segment_label, 0.90) 
-    price_factor = max(threshold, conversion_prob) 
-    
-    raw_price = original_price * price_factor
-    
-    capped_by_flat_discount = max(raw_price, original_price - 100) # Price should not go below original - 100
-    
-    capped_by_percentage = max(capped_by_flat_discount, original_price * 0.70) # Max 30% discount
-    
-    return max(0.0, capped_by_percentage)
 
-# Helper function for fetching user data and calculating user_product_count
+# Returns the cached profile for user_id, loading it from the users table on a miss
+def get_user_profile(user_id):
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        user_row = get_db_connection().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        if not user_row:
+            return None
+        profile = _profile_from_row(user_row)
+        profile_cache.put(user_id, profile)
+    return profile
+
+# Helper function for fetching user data including User_Product_Count
 # This will return a dictionary with keys matching your Colab's feature names
 def get_user_data_from_db(user_id):
-    conn = get_db_connection()
-    user_row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    if user_row:
-        # Calculate User_Product_Count: Sum of quantities from purchases table for the user
-        total_products_bought = conn.execute("SELECT SUM(quantity) FROM purchases WHERE user_id = ?", (user_id,)).fetchone()[0] or 0
-        
-        # Construct dictionary with keys matching Colab notebook's feature names
-        user_data = {
-            'Age': user_row['age'], 
-            'Gender': user_row['gender'],
-            'City': user_row['city'],
-            'Occupation': user_row['occupation'],
-            'Loyalty_Tier': user_row['loyalty_tier'],
-            'User_Product_Count': total_products_bought
-        }
-        conn.close()
-        return user_data
-    
-    conn.close()
-    return None
+    profile = get_user_profile(user_id)
+    if profile is None:
+        return None
+    profile.pop('id')
+    profile.pop('username')
+    return profile
+
+
+# Collects and validates one pricing request into a dict keyed by the notebook's feature names.
+# Logged-in users (user_db_info given) only supply product/environment fields; guests supply everything.
+# Labels are checked against model_set's encoder.
+# Returns (customer_input_data, None, None) on success or (None, error_message, http_status).
+def build_customer_input(model_set, request_data, user_db_info=None):
+    if not isinstance(request_data, dict):
+        return None, "Request body must be a JSON object.", 400
+
+    customer_input_data = {}
+
+    if user_db_info is not None:
+        # Populate customer_input_data with fetched user profile data (ensuring correct keys)
+        # Using .get safely in case a new column is added to 'users' but not accounted for here
+        customer_input_data['Age'] = user_db_info.get('Age')
+        customer_input_data['Gender'] = user_db_info.get('Gender')
+        customer_input_data['City'] = user_db_info.get('City')
+        customer_input_data['Occupation'] = user_db_info.get('Occupation')
+        customer_input_data['Loyalty_Tier'] = user_db_info.get('Loyalty_Tier')
+        customer_input_data['User_Product_Count'] = user_db_info.get('User_Product_Count') # Dynamically calculated from DB
+
+        # Take product and environmental data from the request (from frontend form)
+        expected_from_form_loggedIn = ['Product_Category', 'Purchase_Amount', 'Weather', 'Time_of_Day']
+        for field in expected_from_form_loggedIn:
+            if field not in request_data or request_data[field] is None:
+                return None, f"Missing required field for logged-in user: '{field}'", 400
+            customer_input_data[field] = request_data[field]
+
+    else: # Guest User
+        expected_from_form_guest = [
+            "Age", "Gender", "City", "Occupation", "Loyalty_Tier", "User_Product_Count",
+            "Product_Category", "Purchase_Amount", "Weather", "Time_of_Day"
+        ]
+        for field in expected_from_form_guest:
+            if field not in request_data or request_data[field] is None:
+                return None, f"Missing or null value for required field for guest user: '{field}'", 400
+            customer_input_data[field] = request_data[field]
+
+    # Convert types and validate values before they reach the models (batch_score.py shares these checks)
+    numeric_error = validate_numeric_fields(customer_input_data)
+    if numeric_error is not None:
+        return None, numeric_error, 400
+
+    # Handle unseen labels by returning an error instead of letting LabelEncoder raise one
+    feature_encoder = model_set.feature_encoder
+    for col in CATEGORICAL_COLS:
+        if col not in feature_encoder.code_tables:
+            return None, f"LabelEncoder for '{col}' not found. Models might be incomplete or mismatched.", 500
+        input_value = customer_input_data[col]
+        if feature_encoder.code(col, input_value) is None:
+            return None, f"Unseen label for '{col}': '{input_value}'. Please provide a valid value from: {feature_encoder.classes[col]}", 422
+
+    return customer_input_data, None, None
+
+# Runs one micro-batch of (model_set, X) payloads: payloads for the same model set are stacked into one
+# matrix and predicted together, then split back. Returns one (cluster_ids, probabilities) per payload.
+def _predict_micro_batch(payloads):
+    timer = StageTimer(stage_seconds, 'inference_batch')
+    results = [None] * len(payloads)
+    groups = {}
+    for i, (model_set, _) in enumerate(payloads):
+        groups.setdefault(id(model_set), (model_set, []))[1].append(i)
+    for model_set, indices in groups.values():
+        X = np.concatenate([payloads[i][1] for i in indices])
+        cluster_ids, conversion_probabilities = model_set.predict(X, timer)
+        start = 0
+        for i in indices:
+            end = start + len(payloads[i][1])
+            results[i] = (cluster_ids[start:end], conversion_probabilities[start:end])
+            start = end
+    return results
+
+inference_batcher = MicroBatcher(_predict_micro_batch, INFERENCE_BATCH_WINDOW_MS, INFERENCE_BATCH_MAX_ITEMS,
+                                 INFERENCE_MAX_PENDING, name='inference-micro-batcher')
+
+# Model outputs for X, through inference_batcher when micro-batching is on.
+# Raises BatcherOverloaded or FutureTimeoutError when the batcher cannot take or finish the work in time.
+def run_models(model_set, X, timer):
+    if not INFERENCE_MICRO_BATCHING:
+        return model_set.predict(X, timer)
+    with timer('inference_queue'): # the model stages themselves are timed under endpoint="inference_batch"
+        return inference_batcher.submit((model_set, X), n_items=len(X)).result(timeout=INFERENCE_TIMEOUT)
+
+# Encodes validated rows and returns (cluster_ids, conversion_probabilities) for them from model_set.
+# With PRICE_TABLE on, rows the price table serves (inside its domain and in their cell's segment) are answered
+# from it; of the rest, rows already in prediction_cache skip the models and the others are evaluated together
+# in one pass, each model called once on the whole matrix instead of once per row.
+# With a shadow candidate set, the rows the models answered (directly or from prediction_cache) and their outputs
+# are then handed to shadow_evaluator (enqueue only). Rows answered from the price table are left out: their
+# outputs are the table's approximation, and comparing against it would measure table error, not the candidate.
+def predict_customer_rows(model_set, rows, timer):
+    with timer('label_encoding'):
+        X = model_set.feature_encoder.encode_rows(rows)
+    cluster_ids, conversion_probabilities, model_rows = _predict_encoded_rows(model_set, rows, X, timer)
+    if shadow_evaluator.active and len(model_rows):
+        with timer('shadow_submit'):
+            if len(model_rows) < len(rows):
+                X = X[model_rows]
+            shadow_evaluator.submit(model_set, X, [rows[i]['Purchase_Amount'] for i in model_rows],
+                                    cluster_ids[model_rows], conversion_probabilities[model_rows])
+    return cluster_ids, conversion_probabilities
+
+# (cluster_ids, conversion_probabilities, indices of the rows answered by the models or prediction_cache)
+def _predict_encoded_rows(model_set, rows, X, timer):
+    cluster_ids = np.empty(len(rows), dtype=np.int64)
+    conversion_probabilities = np.empty(len(rows), dtype=np.float64)
+
+    table = price_tables.get(model_set) if PRICE_TABLE else None
+    if table is not None:
+        with timer('table_lookup'):
+            in_domain, table_ids, table_probs = table.lookup(model_set, X)
+            cluster_ids[in_domain] = table_ids[in_domain]
+            conversion_probabilities[in_domain] = table_probs[in_domain]
+            remaining = np.flatnonzero(~in_domain).tolist()
+        price_table_lookups.inc(len(rows) - len(remaining), result='hit')
+        price_table_lookups.inc(len(remaining), result='fallback')
+        if not remaining:
+            return cluster_ids, conversion_probabilities, remaining
+    else:
+        remaining = list(range(len(rows)))
+
+    with timer('cache_lookup'):
+        keys = {i: PredictionCache.make_key(model_set.version, X[i], rows[i]['Purchase_Amount']) for i in remaining}
+        missing = []
+        for i, key in keys.items():
+            cached = prediction_cache.get(key)
+            if cached is None:
+                missing.append(i)
+            else:
+                cluster_ids[i], conversion_probabilities[i] = cached
+
+    if missing:
+        missing_ids, missing_probs = run_models(model_set, X[missing], timer)
+        cluster_ids[missing] = missing_ids
+        conversion_probabilities[missing] = missing_probs
+        for i in missing:
+            prediction_cache.put(keys[i], (int(cluster_ids[i]), float(conversion_probabilities[i])))
+
+    return cluster_ids, conversion_probabilities, remaining
 
 
 # --- Authentication Routes ---
@@ -251,51 +521,34 @@ def register():
         occupation = request.form['occupation']
         loyalty_tier = request.form['loyalty_tier']
 
-        conn = get_db_connection()
-        user_exists = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+        user_exists = get_db_connection().execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
         if user_exists:
-            conn.close()
             flash('Username already exists. Please choose a different one.', 'danger')
             return render_template('register.html', 
                                    user_data=request.form, # Pass form data back to pre-populate (without password)
-                                   genders=list(label_encoders.get('Gender', {'classes_': ['Male', 'Female', 'Other']}).classes_), 
-                                   cities=list(label_encoders.get('City', {'classes_': ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Miami']}).classes_), 
-                                   occupations=list(label_encoders.get('Occupation', {'classes_': ['Engineer', 'Artist', 'Doctor', 'HR', 'Software Dev', 'Other']}).classes_), 
-                                   loyalty_tiers=list(label_encoders.get('Loyalty_Tier', {'classes_': ['Gold', 'Silver', 'Bronze', 'None']}).classes_))
+                                   genders=FORM_OPTIONS['Gender'],
+                                   cities=FORM_OPTIONS['City'],
+                                   occupations=FORM_OPTIONS['Occupation'],
+                                   loyalty_tiers=FORM_OPTIONS['Loyalty_Tier'])
         
         hashed_password = generate_password_hash(password)
         
         try:
-            last_user_id_num = conn.execute("SELECT MAX(CAST(SUBSTR(id, 6) AS INTEGER)) FROM users").fetchone()[0] or 0
-            new_id = f"user_{last_user_id_num + 1:03d}"
-            conn.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                         (new_id, username, hashed_password, name, age, gender, city, occupation, loyalty_tier))
-            conn.commit()
+            with database.transaction() as conn:
+                new_id = allocate_user_id(conn)
+                conn.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (new_id, username, hashed_password, name, age, gender, city, occupation, loyalty_tier))
             flash('Account created successfully! Please log in.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
-            conn.rollback()
             flash(f'An error occurred during registration: {e}', 'danger')
-        finally:
-            conn.close()
     
-    # Pre-populate form options for GET request or on error (get from LabelEncoders if possible)
-    genders = list(label_encoders.get('Gender', {'classes_':[]}).classes_) if 'Gender' in label_encoders else ['Male', 'Female', 'Other']
-    cities = list(label_encoders.get('City', {'classes_':[]}).classes_) if 'City' in label_encoders else ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Miami']
-    occupations = list(label_encoders.get('Occupation', {'classes_':[]}).classes_) if 'Occupation' in label_encoders else ['Engineer', 'Artist', 'Doctor', 'HR', 'Software Dev', 'Other']
-    loyalty_tiers = list(label_encoders.get('Loyalty_Tier', {'classes_':[]}).classes_) if 'Loyalty_Tier' in label_encoders else ['Gold', 'Silver', 'Bronze', 'None']
-
-    # Default options if label_encoders are not loaded
-    if not genders: genders = ['Male', 'Female', 'Other']
-    if not cities: cities = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Miami']
-    if not occupations: occupations = ['Engineer', 'Artist', 'Doctor', 'HR', 'Software Dev', 'Other']
-    if not loyalty_tiers: loyalty_tiers = ['Gold', 'Silver', 'Bronze', 'None']
-
+    # Form options are precomputed once at model load (see FORM_OPTIONS)
     return render_template('register.html', 
-                           genders=genders, 
-                           cities=cities, 
-                           occupations=occupations, 
-                           loyalty_tiers=loyalty_tiers)
+                           genders=FORM_OPTIONS['Gender'],
+                           cities=FORM_OPTIONS['City'],
+                           occupations=FORM_OPTIONS['Occupation'],
+                           loyalty_tiers=FORM_OPTIONS['Loyalty_Tier'])
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -307,9 +560,7 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db_connection()
-        user_row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-        conn.close()
+        user_row = get_db_connection().execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
 
         if user_row and check_password_hash(user_row['password'], password):
             user = User(user_row['id'], username=user_row['username'])
@@ -355,151 +606,136 @@ def predict_page():
             logout_user()
             return redirect(url_for('login'))
 
-    # Provide all possible options for dropdowns for guest users dynamically from label_encoders
-    # Use .get with a default dictionary to avoid errors if LabelEncoder not loaded
-    genders = list(label_encoders.get('Gender', {'classes_':['Male', 'Female', 'Other']}).classes_) 
-    cities = list(label_encoders.get('City', {'classes_':['New York', 'Los Angeles', 'Chicago', 'Houston', 'Miami']}).classes_) 
-    occupations = list(label_encoders.get('Occupation', {'classes_':['Engineer', 'Artist', 'Doctor', 'HR', 'Software Dev', 'Other']}).classes_) 
-    loyalty_tiers = list(label_encoders.get('Loyalty_Tier', {'classes_':['Gold', 'Silver', 'Bronze', 'None']}).classes_) 
-    product_categories = list(label_encoders.get('Product_Category', {'classes_':['Electronics', 'Fashion', 'Grocery', 'Home']}).classes_) 
-    weather_options = list(label_encoders.get('Weather', {'classes_':['Sunny', 'Rainy', 'Cloudy', 'Snowy', 'Foggy']}).classes_) 
-    time_of_day_options = list(label_encoders.get('Time_of_Day', {'classes_':['Morning', 'Afternoon', 'Evening', 'Night']}).classes_) 
-
+    # All possible options for the guest dropdowns, precomputed from the encoder classes at model load
     return render_template('predict.html', 
                            current_user=current_user, 
                            current_user_data=user_data_for_template,
-                           genders=genders,
-                           cities=cities,
-                           occupations=occupations,
-                           loyalty_tiers=loyalty_tiers,
-                           product_categories=product_categories,
-                           weather_options=weather_options,
-                           time_of_day_options=time_of_day_options
+                           genders=FORM_OPTIONS['Gender'],
+                           cities=FORM_OPTIONS['City'],
+                           occupations=FORM_OPTIONS['Occupation'],
+                           loyalty_tiers=FORM_OPTIONS['Loyalty_Tier'],
+                           product_categories=FORM_OPTIONS['Product_Category'],
+                           weather_options=FORM_OPTIONS['Weather'],
+                           time_of_day_options=FORM_OPTIONS['Time_of_Day']
                            )
 
 @app.route('/my_orders', methods=['GET'])
 @login_required # Only logged-in users can view orders
 def my_orders():
     user_id = current_user.get_id()
-    conn = get_db_connection()
-    # Fetch all purchases for the current user, ordered by date
-    orders = conn.execute("SELECT * FROM purchases WHERE user_id = ? ORDER BY purchase_date DESC", (user_id,)).fetchall()
-    conn.close()
-    return render_template('my_orders.html', current_user=current_user, orders=orders)
+
+    # Keyset pagination: the cursor is the (purchase_date, purchase_id) of the last order on the previous
+    # page, so every page is one range scan on idx_purchases_user_date however deep the history goes
+    timer = StageTimer(stage_seconds, 'my_orders')
+    cursor = request.args.get('cursor')
+    if cursor:
+        before_date, _, before_id = cursor.rpartition('|')
+        if not before_date or not before_id.isdigit():
+            flash('Invalid page link. Showing your most recent orders.', 'warning')
+            return redirect(url_for('my_orders'))
+        with timer('db_query'):
+            orders = get_db_connection().execute(
+                "SELECT * FROM purchases WHERE user_id = ? AND (purchase_date, purchase_id) < (?, ?) "
+                "ORDER BY purchase_date DESC, purchase_id DESC LIMIT ?",
+                (user_id, before_date, int(before_id), ORDERS_PAGE_SIZE + 1)).fetchall()
+    else:
+        with timer('db_query'):
+            orders = get_db_connection().execute(
+                "SELECT * FROM purchases WHERE user_id = ? ORDER BY purchase_date DESC, purchase_id DESC LIMIT ?",
+                (user_id, ORDERS_PAGE_SIZE + 1)).fetchall()
+
+    # One extra row tells us whether an older page exists without a COUNT(*)
+    next_cursor = None
+    if len(orders) > ORDERS_PAGE_SIZE:
+        orders = orders[:ORDERS_PAGE_SIZE]
+        next_cursor = f"{orders[-1]['purchase_date']}|{orders[-1]['purchase_id']}"
+
+    with timer('render'):
+        return render_template('my_orders.html', current_user=current_user, orders=orders,
+                               next_cursor=next_cursor, is_first_page=not cursor)
+
+# Totals by product_category and by month, read from the summary tables kept up to date by complete_purchase
+@app.route('/my_orders/summary', methods=['GET'])
+@login_required
+def my_orders_summary():
+    return jsonify(user_summary(get_db_connection(), current_user.get_id()))
+
+@app.route('/my_orders/export.csv', methods=['GET'])
+@login_required
+def my_orders_export():
+    return _order_history_csv(current_user.get_id())
+
+# Streams a user's whole order history as CSV, oldest first. Rows are read EXPORT_CHUNK_ROWS at a time
+# (see spending_summary.iter_purchase_chunks) and written out as they come, so neither the worker's memory
+# nor an open read transaction grows with the length of the history or the speed of the client.
+# generate() needs no request context: it only uses the user_id, cancelled event and get_db_connection it closes
+# over, so it can be pulled after the request has ended and on any thread (asgi.py pulls each piece on a pool thread).
+def _order_history_csv(user_id):
+    cancelled = request.environ.get('neuroprice.cancelled') # set by asgi.py when the client goes away
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow((*EXPORT_COLUMNS, 'line_total'))
+        for rows in iter_purchase_chunks(get_db_connection, user_id, EXPORT_CHUNK_ROWS):
+            if cancelled is not None and cancelled.is_set():
+                return
+            writer.writerows((*row, round(row[4] * row[5], 2)) for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="orders_{user_id}.csv"'})
 
 
 # --- API Endpoint for Price Prediction ---
 @app.route('/predict_price', methods=['POST'])
 def predict_price_api():
-    if not loading_success:
+    model_set = models # one consistent model set for this whole request, even across a hot reload
+    if model_set is None:
         return jsonify({"error": "API is not fully functional due to model loading errors. Please check server logs."}), 503
 
     request_data = request.get_json() # Renamed to avoid clash with `data` variable for prediction DataFrame
-
-    customer_input_data = {}
+    timer = StageTimer(stage_seconds, 'predict_price')
 
     if current_user.is_authenticated:
-        user_id = current_user.get_id()
-        user_db_info = get_user_data_from_db(user_id) 
-        
+        with timer('profile_fetch'):
+            user_db_info = get_user_data_from_db(current_user.get_id())
         if not user_db_info:
             return jsonify({"error": "Logged-in user data not found in database."}), 500
-        
-        # Populate customer_input_data with fetched user profile data (ensuring correct keys)
-        # Using .get safely in case a new column is added to 'users' but not accounted for here
-        customer_input_data['Age'] = user_db_info.get('Age') 
-        customer_input_data['Gender'] = user_db_info.get('Gender')
-        customer_input_data['City'] = user_db_info.get('City')
-        customer_input_data['Occupation'] = user_db_info.get('Occupation')
-        customer_input_data['Loyalty_Tier'] = user_db_info.get('Loyalty_Tier')
-        customer_input_data['User_Product_Count'] = user_db_info.get('User_Product_Count') # Dynamically calculated from DB
-        
-        # Take product and environmental data from the request (from frontend form)
-        expected_from_form_loggedIn = ['Product_Category', 'Purchase_Amount', 'Weather', 'Time_of_Day']
-        for field in expected_from_form_loggedIn:
-            if field not in request_data or request_data[field] is None:
-                return jsonify({"error": f"Missing required field for logged-in user: '{field}'"}), 400
-            customer_input_data[field] = request_data[field]
-
-    else: # Guest User
-        expected_from_form_guest = [
-            "Age", "Gender", "City", "Occupation", "Loyalty_Tier", "User_Product_Count",
-            "Product_Category", "Purchase_Amount", "Weather", "Time_of_Day"
-        ]
-        for field in expected_from_form_guest:
-            if field not in request_data or request_data[field] is None:
-                return jsonify({"error": f"Missing or null value for required field for guest user: '{field}'"}), 400
-            customer_input_data[field] = request_data[field]
-            
-    try:
-        # Convert types and validate values before creating DataFrame
-        customer_input_data['Age'] = int(customer_input_data['Age'])
-        if not (0 < customer_input_data['Age'] < 120):
-            return jsonify({"error": "Age must be a realistic number (1-119)."}), 400
-
-        customer_input_data['Purchase_Amount'] = float(customer_input_data['Purchase_Amount'])
-        if customer_input_data['Purchase_Amount'] <= 0:
-            return jsonify({"error": "Original purchase amount must be positive."}), 400
-
-        customer_input_data['User_Product_Count'] = int(customer_input_data['User_Product_Count'])
-        if customer_input_data['User_Product_Count'] < 0:
-            return jsonify({"error": "User product count cannot be negative."}), 400
-
-        # Create DataFrame with a single row for prediction.
-        # Ensure column order is not random. It's best practice to build DF from a dict that matches order if possible
-        # or reorder it explicitly. Pandas usually preserves dict key order (Python 3.7+).
-        input_df = pd.DataFrame([customer_input_data])
-        original_purchase_amount_float = input_df['Purchase_Amount'].iloc[0]
-
-        # Apply LabelEncoders for all categorical features
-        # Keep track of column order, especially if you had a fixed order from Colab
-        for col in CATEGORICAL_COLS: 
-            if col not in label_encoders:
-                return jsonify({"error": f"LabelEncoder for '{col}' not found. Models might be incomplete or mismatched."}), 500
-
-            le = label_encoders[col]
-            input_value = input_df[col].iloc[0]
-            # Handle unseen labels by returning an error instead of raising one
-            if input_value not in le.classes_:
-                return jsonify({"error": f"Unseen label for '{col}': '{input_value}'. Please provide a valid value from: {list(le.classes_)}"}), 422
-            input_df[col] = le.transform(input_df[col])
-
-        # Apply Age_Group transformation
-        input_df['Age_Group'] = input_df['Age'].apply(get_age_group)
-
-        # Apply Purchase_Amount_Scaled transformation using the correct scaler
-        input_df['Purchase_Amount_Scaled'] = scaler_purchase_amount.transform(input_df[['Purchase_Amount']])
-        
-        # --- Debugging Print Statement ---
-        # print("\n--- DataFrame before Segmentation/GB Prediction ---")
-        # print("Columns:", input_df.columns.tolist())
-        # print("DataFrame content:\n", input_df)
-        # print("--- End Debugging ---")
-
-        # --- Segmentation ---
-        # Verify that input_df contains all features required by SEGMENTATION_FEATURES in the correct order/presence
-        df_for_segmentation = input_df[SEGMENTATION_FEATURES]
-        scaled_for_segmentation = scaler_segmentation_features.transform(df_for_segmentation)
-        cluster_id = kmeans_model.predict(scaled_for_segmentation)[0]
-        customer_segment_label = segment_mapping.get(cluster_id, "Unknown Segment")
-        input_df['CustomerSegment'] = cluster_id # Add numerical segment ID for GB model
-
-
-        # --- Conversion Prediction ---
-        # Verify that input_df contains all features required by GB_FEATURES in the correct order/presence
-        df_for_gb_prediction = input_df[GB_FEATURES]
-        conversion_probability = gb_model.predict_proba(df_for_gb_prediction)[:, 1][0]
+    else:
+        user_db_info = None
 
+    with timer('validation'):
+        customer_input_data, error, status = build_customer_input(model_set, request_data, user_db_info)
+    if error:
+        return jsonify({"error": error}), status
 
+    try:
+        original_purchase_amount_float = customer_input_data['Purchase_Amount']
+
+        # --- Segmentation + Conversion Prediction ---
+        # Encoded straight into a NumPy row (label codes, Age_Group, Purchase_Amount_Scaled); served from
+        # prediction_cache when the same encoded profile/product/context was priced recently
+        cluster_ids, conversion_probabilities = predict_customer_rows(model_set, [customer_input_data], timer)
+        cluster_id = cluster_ids[0]
+        customer_segment_label = model_set.segment_label(cluster_id)
+        conversion_probability = conversion_probabilities[0]
+
+    except (BatcherOverloaded, FutureTimeoutError):
+        return jsonify({"error": "Pricing is temporarily overloaded. Please retry shortly."}), 503
     except Exception as e:
         traceback.print_exc() # Print full traceback to console
         return jsonify({"error": f"Error during model prediction pipeline: {str(e)}. Check server logs for details."}), 500
 
     try:
-        optimized_price = calculate_optimized_price(
-            original_purchase_amount_float, conversion_probability, customer_segment_label
-        )
-        
+        with timer('pricing_rules'):
+            optimized_price = pricing_rules.current().price(
+                original_purchase_amount_float, conversion_probability, customer_segment_label
+            )
+
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": f"Error during optimized price calculation: {str(e)}. Check server logs for details."}), 500
@@ -515,6 +751,394 @@ def predict_price_api():
     return jsonify(response)
 
 
+# --- Batch Price Prediction API ---
+# Prices a whole page of products in one call. Body: {"context": {...}, "items": [{...}, ...]}
+# Each item is merged over the shared context (e.g. Weather/Time_of_Day or a guest profile),
+# validated on its own, and all valid rows go through the models in a single vectorized pass.
+# Invalid items get a per-item error entry; they never fail the rest of the batch.
+@app.route('/predict_price_batch', methods=['POST'])
+def predict_price_batch_api():
+    model_set = models # one consistent model set for this whole request, even across a hot reload
+    if model_set is None:
+        return jsonify({"error": "API is not fully functional due to model loading errors. Please check server logs."}), 503
+
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        return jsonify({"error": "Request body must be a JSON object with an 'items' list."}), 400
+
+    items = request_data.get('items')
+    context = request_data.get('context') or {}
+    if not items or not isinstance(items, list):
+        return jsonify({"error": "No items provided."}), 400
+    if not isinstance(context, dict):
+        return jsonify({"error": "'context' must be a JSON object."}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"Too many items in one batch ({len(items)}). Maximum is {MAX_BATCH_ITEMS}."}), 413
+
+    timer = StageTimer(stage_seconds, 'predict_price_batch')
+
+    # The profile is fetched once for the whole batch instead of once per item
+    if current_user.is_authenticated:
+        with timer('profile_fetch'):
+            user_db_info = get_user_data_from_db(current_user.get_id())
+        if not user_db_info:
+            return jsonify({"error": "Logged-in user data not found in database."}), 500
+    else:
+        user_db_info = None
+
+    results = [None] * len(items)
+    valid_rows = []
+    valid_indices = []
+    with timer('validation'):
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[i] = {"index": i, "error": "Each item must be a JSON object.", "status": 400}
+                continue
+            customer_input_data, error, status = build_customer_input(model_set, {**context, **item}, user_db_info)
+            if error:
+                results[i] = {"index": i, "error": error, "status": status}
+                continue
+            valid_rows.append(customer_input_data)
+            valid_indices.append(i)
+
+    if valid_rows:
+        try:
+            cluster_ids, conversion_probabilities = predict_customer_rows(model_set, valid_rows, timer)
+        except (BatcherOverloaded, FutureTimeoutError):
+            return jsonify({"error": "Pricing is temporarily overloaded. Please retry shortly."}), 503
+        except Exception as e:
+            traceback.print_exc()
+            for i in valid_indices:
+                results[i] = {"index": i, "error": f"Error during model prediction pipeline: {str(e)}. Check server logs for details.", "status": 500}
+        else:
+            # All valid items are priced together by the compiled pricing rules
+            original_prices = np.array([row['Purchase_Amount'] for row in valid_rows])
+            try:
+                with timer('pricing_rules'):
+                    optimized_prices = pricing_rules.current().apply(original_prices, conversion_probabilities, cluster_ids,
+                                                                     model_set.segment_mapping)
+            except Exception as e:
+                traceback.print_exc()
+                optimized_prices = None
+                for i in valid_indices:
+                    results[i] = {"index": i, "error": f"Error during optimized price calculation: {str(e)}. Check server logs for details.", "status": 500}
+            for row_pos, i in enumerate(valid_indices):
+                if optimized_prices is None:
+                    break
+                results[i] = {
+                    "index": i,
+                    "customer_segment": model_set.segment_label(cluster_ids[row_pos]),
+                    "original_price": valid_rows[row_pos]['Purchase_Amount'],
+                    "optimized_price": float(optimized_prices[row_pos]),
+                    "predicted_conversion_probability": float(conversion_probabilities[row_pos])
+                }
+
+    return jsonify({
+        "results": results,
+        "total_items": len(items),
+        "failed_items": len(items) - sum(1 for r in results if "error" not in r),
+        "notes": "Price is dynamically adjusted based on predicted conversion and customer segment and rules."
+    })
+
+
+# --- Price Sensitivity Sweep API ---
+# What-if curves for one customer. The profile/product is validated and encoded once, then every variant
+# is a copy of that row with only the swept columns changed, and the whole grid goes through the
+# scaler, segmentation, conversion model and pricing rules in one pass. Body: the /predict_price fields plus
+#   {"sweep": "purchase_amount", "purchase_amounts": [..]}
+#   {"sweep": "purchase_amount", "purchase_amount_range": {"min": 10, "max": 500, "steps": 50}}
+#   {"sweep": "weather_time_of_day"}   (every Weather x Time_of_Day combination)
+# Swept fields may be omitted from the body.
+@app.route('/predict_price_sweep', methods=['POST'])
+def predict_price_sweep_api():
+    model_set = models # one consistent model set for this whole request, even across a hot reload
+    if model_set is None:
+        return jsonify({"error": "API is not fully functional due to model loading errors. Please check server logs."}), 503
+
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        return jsonify({"error": "Request body must be a JSON object."}), 400
+
+    encoder = model_set.feature_encoder
+    sweep = request_data.get('sweep')
+    if sweep == 'purchase_amount':
+        if 'purchase_amounts' in request_data:
+            amounts = request_data['purchase_amounts']
+            if not isinstance(amounts, list) or not amounts:
+                return jsonify({"error": "'purchase_amounts' must be a non-empty list."}), 400
+            try:
+                amounts = [float(amount) for amount in amounts]
+            except (TypeError, ValueError) as e:
+                return jsonify({"error": f"Invalid numeric value in 'purchase_amounts': {e}"}), 400
+        else:
+            amount_range = request_data.get('purchase_amount_range')
+            if not isinstance(amount_range, dict):
+                return jsonify({"error": "Provide 'purchase_amounts' or 'purchase_amount_range' for a purchase_amount sweep."}), 400
+            try:
+                low, high, steps = float(amount_range['min']), float(amount_range['max']), int(amount_range['steps'])
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({"error": f"'purchase_amount_range' needs numeric 'min', 'max' and 'steps': {e}"}), 400
+            if steps < 1 or high < low:
+                return jsonify({"error": "'purchase_amount_range' needs steps >= 1 and max >= min."}), 400
+            if steps > MAX_SWEEP_POINTS:
+                return jsonify({"error": f"Too many sweep points ({steps}). Maximum is {MAX_SWEEP_POINTS}."}), 413
+            amounts = np.linspace(low, high, steps).tolist()
+        if any(not np.isfinite(amount) or amount <= 0 for amount in amounts):
+            return jsonify({"error": "Original purchase amount must be positive."}), 400
+        variations = {'Purchase_Amount': amounts}
+        base_request = {**request_data, 'Purchase_Amount': amounts[0]}
+    elif sweep == 'weather_time_of_day':
+        combinations = [(weather, time_of_day) for weather in encoder.classes['Weather']
+                        for time_of_day in encoder.classes['Time_of_Day']]
+        variations = {'Weather': [weather for weather, _ in combinations],
+                      'Time_of_Day': [time_of_day for _, time_of_day in combinations]}
+        base_request = {**request_data, 'Weather': combinations[0][0], 'Time_of_Day': combinations[0][1]}
+    else:
+        return jsonify({"error": "'sweep' must be 'purchase_amount' or 'weather_time_of_day'."}), 400
+
+    n_points = len(next(iter(variations.values())))
+    if n_points > MAX_SWEEP_POINTS:
+        return jsonify({"error": f"Too many sweep points ({n_points}). Maximum is {MAX_SWEEP_POINTS}."}), 413
+
+    if current_user.is_authenticated:
+        user_db_info = get_user_data_from_db(current_user.get_id())
+        if not user_db_info:
+            return jsonify({"error": "Logged-in user data not found in database."}), 500
+    else:
+        user_db_info = None
+
+    customer_input_data, error, status = build_customer_input(model_set, base_request, user_db_info)
+    if error:
+        return jsonify({"error": error}), status
+
+    try:
+        X = encoder.sweep(encoder.encode_row(customer_input_data), variations)
+        original_prices = (np.asarray(variations['Purchase_Amount']) if 'Purchase_Amount' in variations
+                           else np.full(n_points, customer_input_data['Purchase_Amount']))
+        cluster_ids, conversion_probabilities = model_set.predict(X) # already one batched call
+        optimized_prices = pricing_rules.current().apply(original_prices, conversion_probabilities, cluster_ids,
+                                                         model_set.segment_mapping)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": f"Error during model prediction pipeline: {str(e)}. Check server logs for details."}), 500
+
+    points = []
+    for i in range(n_points):
+        point = {name: values[i] for name, values in variations.items() if name != 'Purchase_Amount'} # amount is original_price
+        point.update({
+            "customer_segment": model_set.segment_label(cluster_ids[i]),
+            "original_price": float(original_prices[i]),
+            "optimized_price": float(optimized_prices[i]),
+            "predicted_conversion_probability": float(conversion_probabilities[i])
+        })
+        points.append(point)
+
+    fixed = {key: value for key, value in customer_input_data.items() if key not in variations}
+    return jsonify({"sweep": sweep, "fixed_inputs": fixed, "points": points, "total_points": n_points})
+
+
+# --- Model hot reload ---
+# Every worker re-reads the CURRENT bundle pointer at most every MODEL_RELOAD_CHECK_SECONDS and, if it moved,
+# loads the new bundle on a background thread and swaps it in. Requests keep being served by the old set
+# until the swap, so nothing is dropped or delayed.
+@app.before_request
+def check_for_new_models():
+    global _last_models_check
+    now = time.monotonic()
+    if now - _last_models_check < MODEL_RELOAD_CHECK_SECONDS:
+        return
+    _last_models_check = now
+    version = current_version(MODEL_BUNDLES_DIR)
+    if version is not None and (models is None or models.version != version) and not _models_lock.locked():
+        threading.Thread(target=_reload_models_in_background, name='model-reload', daemon=True).start()
+
+def _reload_models_in_background():
+    try:
+        reload_models_if_changed()
+    except Exception:
+        print("ERROR: model hot reload failed; still serving the previous models.")
+        traceback.print_exc()
+
+def _admin_authorized():
+    return bool(ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.route('/admin/models', methods=['GET'])
+def admin_models():
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    return jsonify({"serving": models.describe() if models is not None else None,
+                    "current_bundle": current_version(MODEL_BUNDLES_DIR)})
+
+# Loads a model set and swaps it in for this worker. With {"version": V} the CURRENT pointer is moved to V
+# first, so the other workers follow within MODEL_RELOAD_CHECK_SECONDS. Without a version this worker
+# reloads whatever CURRENT (or, with no bundles, the pickles) holds right now.
+@app.route('/admin/models/reload', methods=['POST'])
+def admin_reload_models():
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    version = (request.get_json(silent=True) or {}).get('version')
+    previous = models.describe() if models is not None else None
+    try:
+        with _models_lock:
+            new_models = load_models(version) if version else load_models()
+            if version:
+                set_current_version(MODEL_BUNDLES_DIR, version)
+            install_models(new_models)
+    except (BundleError, FileNotFoundError) as e:
+        return jsonify({"error": f"Could not load models: {e}", "serving": previous}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": f"Could not load models: {e}", "serving": previous}), 500
+    print(f"Models reloaded by admin request: now serving '{new_models.version}'.")
+    return jsonify({"previous": previous, "serving": new_models.describe()})
+
+
+# The same summary and export for support staff, for any user
+@app.route('/admin/users/<user_id>/summary', methods=['GET'])
+def admin_user_summary(user_id):
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    conn = get_db_connection()
+    if not conn.execute("SELECT EXISTS(SELECT 1 FROM users WHERE id = ?)", (user_id,)).fetchone()[0]:
+        return jsonify({"error": "Unknown user."}), 404
+    return jsonify({"user_id": user_id, **user_summary(conn, user_id)})
+
+@app.route('/admin/users/<user_id>/orders.csv', methods=['GET'])
+def admin_user_export(user_id):
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    if not get_db_connection().execute("SELECT EXISTS(SELECT 1 FROM users WHERE id = ?)", (user_id,)).fetchone()[0]:
+        return jsonify({"error": "Unknown user."}), 404
+    return _order_history_csv(user_id)
+
+
+@app.route('/admin/pricing_rules', methods=['GET'])
+def admin_pricing_rules():
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    return jsonify({"path": PRICING_RULES_PATH, **pricing_rules.current().describe()})
+
+
+# --- Prediction cache counters (hits / misses / evictions) ---
+@app.route('/prediction_cache/stats', methods=['GET'])
+def prediction_cache_stats():
+    return jsonify(prediction_cache.stats())
+
+
+@app.route('/admin/price_table', methods=['GET', 'POST'])
+def admin_price_table():
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    if request.method == 'POST': # rebuild for the serving models, e.g. after a pricing rules change
+        if models is None:
+            return jsonify({"error": "No models loaded."}), 503
+        if not price_tables.rebuild(models):
+            return jsonify({"error": "A price table build is already running."}), 409
+        return jsonify({"message": f"Price table build started for '{models.version}'."}), 202
+    return jsonify({"enabled": PRICE_TABLE, **price_tables.stats()})
+
+
+# GET: divergence of the shadow candidate from the serving models in this worker (see shadow.py).
+# POST {"version": V} or {"model_dir": D}: shadow that bundle / directory of pickles instead (this worker only,
+# like SHADOW_MODEL_VERSION / SHADOW_MODEL_DIR for all of them). DELETE: stop shadowing.
+@app.route('/admin/shadow', methods=['GET', 'POST', 'DELETE'])
+def admin_shadow():
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    if request.method == 'DELETE':
+        shadow_evaluator.set_candidate(None)
+        return jsonify({"message": "Shadow evaluation stopped."})
+    if request.method == 'POST':
+        if models is None:
+            return jsonify({"error": "No models loaded."}), 503
+        body = request.get_json(silent=True) or {}
+        if not body.get('version') and not body.get('model_dir'):
+            return jsonify({"error": "Provide 'version' (a model bundle) or 'model_dir' (a directory of pickles)."}), 400
+        try:
+            candidate = load_shadow_candidate(body.get('version'), body.get('model_dir'))
+            shadow_evaluator.set_candidate(candidate, models)
+        except (BundleError, FileNotFoundError, ShadowError) as e:
+            return jsonify({"error": f"Could not use the shadow candidate: {e}"}), 400
+        print(f"Shadow candidate set by admin request: '{candidate.version}'.")
+    return jsonify(shadow_evaluator.stats())
+
+
+@app.route('/inference_batcher/stats', methods=['GET'])
+def inference_batcher_stats():
+    return jsonify({"enabled": INFERENCE_MICRO_BATCHING, **inference_batcher.stats()})
+
+
+# --- Metrics and profiling ---
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched' # route names, not raw paths, keep label cardinality bounded
+        http_request_seconds.observe(elapsed, endpoint=endpoint, method=request.method)
+        http_requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        if traffic_recorder is not None and endpoint in CAPTURED_ENDPOINTS:
+            try:
+                traffic_recorder.record(request.path, request.method, request.get_json(silent=True), response.status_code,
+                                        elapsed * 1000.0, current_user.is_authenticated)
+            except OSError as e:
+                print(f"WARNING: traffic capture failed: {e}")
+    return response
+
+metrics_registry.gauge_callback(
+    'neuroprice_cache_events', 'Prediction and profile cache hits, misses, evictions and expirations since start.',
+    lambda: {(cache_name, event): stats[event]
+             for cache_name, stats in (('prediction', prediction_cache.stats()), ('profile', profile_cache.stats()))
+             for event in ('hits', 'misses', 'evictions', 'expirations') if event in stats},
+    ('cache', 'event'))
+metrics_registry.gauge_callback(
+    'neuroprice_inference_batcher', 'Micro-batcher queue depth and totals (see /inference_batcher/stats).',
+    lambda: {(key,): inference_batcher.stats()[key] for key in ('pending', 'batches', 'items', 'shed', 'failed_batches')},
+    ('stat',))
+metrics_registry.gauge_callback(
+    'neuroprice_shadow_requests', 'Requests offered to the shadow candidate, by outcome (see /admin/shadow).',
+    lambda: {(result,): count for result, count in dict(shadow_evaluator.counts).items()}, ('result',))
+metrics_registry.gauge_callback(
+    'neuroprice_startup_seconds', 'Seconds spent in each startup phase of this process (or of the preloading master).',
+    lambda: {(phase,): seconds for phase, seconds in startup_timings.items()}, ('phase',))
+metrics_registry.gauge_callback(
+    'neuroprice_model_info', 'The model version this worker is serving (value is always 1).',
+    lambda: {(models.version,): 1} if models is not None else {}, ('version',))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return metrics_registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Sampling profiler, switched on and off at runtime. POST /admin/profiler {"action": "start", "interval_ms": 5,
+# "max_seconds": 60} starts it; {"action": "stop"} stops it and returns the hottest stacks; GET shows progress.
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    if not _admin_authorized():
+        return jsonify({"error": "Forbidden."}), 403
+    if request.method == 'GET':
+        return jsonify(profiler.report(limit=int(request.args.get('limit', 50))))
+    body = request.get_json(silent=True) or {}
+    action = body.get('action')
+    if action == 'start':
+        try:
+            interval_ms = float(body.get('interval_ms', 5))
+            max_seconds = float(body.get('max_seconds', 60))
+        except (TypeError, ValueError):
+            return jsonify({"error": "'interval_ms' and 'max_seconds' must be numbers."}), 400
+        if interval_ms < 1 or max_seconds <= 0:
+            return jsonify({"error": "'interval_ms' must be at least 1 and 'max_seconds' positive."}), 400
+        if not profiler.start(interval_ms, max_seconds):
+            return jsonify({"error": "Profiler is already running."}), 409
+        return jsonify({"message": "Profiler started.", "interval_ms": interval_ms, "max_seconds": max_seconds})
+    if action == 'stop':
+        return jsonify(profiler.stop())
+    return jsonify({"error": "'action' must be 'start' or 'stop'."}), 400
+
+
 # --- Purchase Completion API (Logs purchases to DB) ---
 @app.route('/complete_purchase', methods=['POST'])
 @login_required 
@@ -527,30 +1151,94 @@ def complete_purchase():
     if not cart_items or not isinstance(cart_items, list):
         return jsonify({"error": "No cart items provided."}), 400
 
-    conn = get_db_connection()
+    # Optional Idempotency-Key header (or "idempotency_key" field): a retry carrying the key of an order that was
+    # already recorded gets the original answer instead of a second order
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if idempotency_key is not None and (not isinstance(idempotency_key, str)
+                                        or not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH):
+        return jsonify({"error": f"Idempotency key must be a string of 1-{MAX_IDEMPOTENCY_KEY_LENGTH} characters."}), 400
+
+    timer = StageTimer(stage_seconds, 'complete_purchase')
+
+    # Validate the whole cart before touching the database; one timestamp for the whole order
+    purchase_date = datetime.now().isoformat()
+    purchase_rows = []
+    with timer('validation'):
+        for index, item in enumerate(cart_items):
+            purchase_row, error = _validate_cart_item(item)
+            if error:
+                return jsonify({"error": f"Invalid cart item #{index + 1}: {error}", "item_index": index}), 400
+            purchase_rows.append((user_id, *purchase_row, purchase_date))
+
     try:
-        for item in cart_items:
-            product_name = item.get('name')
-            product_category = item.get('category') 
-            original_price = item.get('original_price') 
-            if not original_price: 
-                original_price = item.get('price')
-            
-            quantity = item.get('quantity', 1) 
-
-            if not all([product_name, product_category, original_price, quantity is not None]):
-                raise ValueError(f"Missing product details in cart item: {item}. Must have name, category, original_price, quantity.")
-
-            conn.execute("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) VALUES (?, ?, ?, ?, ?, ?)",
-                         (user_id, product_name, product_category, original_price, quantity, datetime.now().isoformat()))
-        conn.commit()
-        return jsonify({"message": "Purchase recorded successfully!", "total_items_purchased": len(cart_items)})
+        if PURCHASE_WRITE_MODE == 'group':
+            with timer('db_write'):
+                future = purchase_writer.submit(lambda conn: _write_purchases(conn, user_id, purchase_rows, idempotency_key))
+                product_count, replayed = future.result(timeout=PURCHASE_ACK_TIMEOUT) # returns only after the group commit
+        else:
+            # FULL: the order is acknowledged as recorded, so the commit must reach disk before the reply
+            with timer('db_write'), database.transaction(synchronous='FULL') as conn:
+                product_count, replayed = _write_purchases(conn, user_id, purchase_rows, idempotency_key)
+    except WriterOverloaded as e:
+        return jsonify({"error": f"{e} Please retry shortly."}), 503
+    except FutureTimeoutError:
+        # Still queued in the group-commit writer and will almost always be recorded: not a failure, and
+        # resubmitting without an idempotency key would create a second order
+        return jsonify({"status": "pending",
+                        "message": "Your order was received and is still being recorded. Do not resubmit it; "
+                                   "it will appear in My Orders shortly."
+                                   + (" Retrying with the same Idempotency-Key is safe." if idempotency_key else "")}), 202
     except Exception as e:
-        conn.rollback()
         traceback.print_exc()
         return jsonify({"error": f"Failed to record purchase: {e}. Check server logs."}), 500
-    finally:
-        conn.close()
+
+    if replayed:
+        return jsonify({"message": "This order was already recorded.", "replayed": True,
+                        "total_items_purchased": len(cart_items)})
+    profile_cache.update_product_count(user_id, product_count)
+    return jsonify({"message": "Purchase recorded successfully!", "total_items_purchased": len(cart_items)})
+
+
+# Returns ((product_name, product_category, original_price, quantity), None) or (None, error_message)
+def _validate_cart_item(item):
+    if not isinstance(item, dict):
+        return None, "each cart item must be a JSON object."
+    product_name = item.get('name')
+    product_category = item.get('category')
+    original_price = item.get('original_price')
+    if not original_price:
+        original_price = item.get('price')
+    quantity = item.get('quantity', 1)
+
+    if not all([product_name, product_category, original_price, quantity is not None]):
+        return None, f"Missing product details in cart item: {item}. Must have name, category, original_price, quantity."
+    try:
+        original_price = float(original_price)
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        return None, f"original_price and quantity must be numbers in cart item: {item}."
+    if original_price <= 0 or quantity <= 0:
+        return None, f"original_price and quantity must be positive in cart item: {item}."
+    return (product_name, product_category, original_price, quantity), None
+
+# Inserts all rows of one validated order with executemany and bumps the materialized
+# User_Product_Count and spending summaries, inside the caller's transaction (or group-commit savepoint).
+# With an idempotency_key the key is claimed first; if this user already recorded an order under it nothing
+# is written. Returns (the user's product_count, whether the order was a replay).
+def _write_purchases(conn, user_id, purchase_rows, idempotency_key=None):
+    if idempotency_key is not None:
+        claimed = conn.execute(
+            "INSERT INTO purchase_orders (user_id, idempotency_key, items, created_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, idempotency_key) DO NOTHING",
+            (user_id, idempotency_key, len(purchase_rows), purchase_rows[0][5])).rowcount
+        if not claimed:
+            return conn.execute("SELECT product_count FROM users WHERE id = ?", (user_id,)).fetchone()[0], True
+    conn.executemany("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) VALUES (?, ?, ?, ?, ?, ?)",
+                     purchase_rows)
+    record_purchases(conn, purchase_rows)
+    total_quantity = sum(row[4] for row in purchase_rows)
+    conn.execute("UPDATE users SET product_count = product_count + ? WHERE id = ?", (total_quantity, user_id))
+    return conn.execute("SELECT product_count FROM users WHERE id = ?", (user_id,)).fetchone()[0], False
 
 
 # --- Run the Flask App (if running directly via python app.py) ---
@@ -0,0 +1,334 @@
+# asgi.py
+#
+# ASGI entry point serving the same Flask app (every route, session and login) from an event-loop server:
+#
+#   uvicorn asgi:application
+#   gunicorn asgi:application -k uvicorn.workers.UvicornWorker -w 2
+#
+# The event loop owns the sockets: request bodies are read and responses written asynchronously, so a slow
+# or idle client costs a coroutine, not a worker thread. Only once a request has fully arrived does the Flask
+# (WSGI) handler run, on one of two bounded thread pools:
+#   inference  the /predict_price* routes (model evaluation; NumPy releases the GIL in the heavy parts)
+#   io         everything else (SQLite reads and writes, templates)
+# so a burst of slow database work cannot starve pricing, and the other way round.
+#
+# Admission: a pool takes at most ASGI_<POOL>_THREADS + ASGI_<POOL>_QUEUE requests; beyond that new requests
+# get an immediate 503 instead of queueing behind work the box cannot finish.
+# Timeouts and cancellation: a response must be produced within ASGI_REQUEST_TIMEOUT seconds or the client
+# gets a 504. On a timeout or a client disconnect, a handler still waiting for a thread is dropped without
+# running. A handler already running cannot be interrupted (Python threads cannot be killed), but
+# environ['neuroprice.cancelled'] (a threading.Event) is set so long loops can stop early, and its output is
+# discarded. Streamed responses are pulled from the handler in ~64 KiB pieces, one pool task per piece, so a
+# slow reader never holds a thread while its socket drains.
+# Those pieces may be pulled on different pool threads, so each response gets one contextvars.Context, copied
+# when the request is dispatched. The app call and every pull and close() run inside it, so iterators that rely
+# on context variables (Flask's stream_with_context, for one) see the same context as the handler that made them.
+
+import asyncio
+import contextvars
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app, metrics_registry
+
+# Threads per pool and how many further requests each pool may queue before answering 503
+ASGI_INFERENCE_THREADS = int(os.environ.get('ASGI_INFERENCE_THREADS', 4))
+ASGI_INFERENCE_QUEUE = int(os.environ.get('ASGI_INFERENCE_QUEUE', 256))
+ASGI_IO_THREADS = int(os.environ.get('ASGI_IO_THREADS', 8))
+ASGI_IO_QUEUE = int(os.environ.get('ASGI_IO_QUEUE', 256))
+# Seconds a request may take from the moment its body has arrived until its response starts (and, for a
+# streamed response, for each further piece)
+ASGI_REQUEST_TIMEOUT = float(os.environ.get('ASGI_REQUEST_TIMEOUT', 30))
+# Largest request body accepted (413 beyond it)
+ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 10 * 1024 * 1024))
+# Path prefixes served by the inference pool
+INFERENCE_PATH_PREFIXES = ('/predict_price',)
+RESPONSE_PIECE_BYTES = 64 * 1024
+
+
+class RequestTimedOut(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class BoundedPool:
+    def __init__(self, name, max_threads, max_queued):
+        self.name = name
+        self.max_threads = int(max_threads)
+        self.limit = self.max_threads + int(max_queued)
+        self._executor = None
+        self._pid = None
+        # Touched only from the event loop thread (worker threads report back via call_soon_threadsafe)
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.cancelled = 0
+
+    # Threads do not survive fork(), so each worker process gets its own executor on first use
+    def _ensure_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.max_threads, thread_name_prefix=f'asgi-{self.name}')
+            self._pid = os.getpid()
+        return self._executor
+
+    def admit(self):
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            return False
+        return True
+
+    # Runs fn(*args) on the pool; in_flight counts the task until it has finished (or was cancelled unstarted),
+    # including tasks whose request already gave up on them
+    def submit(self, loop, fn, *args):
+        future = self._ensure_executor().submit(fn, *args)
+        self.in_flight += 1
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._task_done))
+        return future
+
+    def _task_done(self):
+        self.in_flight -= 1
+        self.completed += 1
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {"threads": self.max_threads, "limit": self.limit, "in_flight": self.in_flight,
+                "completed": self.completed, "rejected": self.rejected, "timed_out": self.timed_out,
+                "cancelled": self.cancelled}
+
+
+# --- WSGI side (runs on pool threads) ---
+# Calls the WSGI app and pulls the first piece of its response. Returns (status, headers, body, iterator);
+# iterator is None once the response is complete.
+def _start_wsgi(wsgi_app, environ):
+    response = {}
+    written = []
+
+    # Nothing is sent before the handler returns, so a later call (an error page, exc_info) simply replaces the headers
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+        return written.append # the legacy write() callable
+
+    result = wsgi_app(environ, start_response)
+    iterator = iter(result)
+    body, done = _pull_pieces(iterator, written)
+    if done:
+        _close(result)
+        return response['status'], response['headers'], body, None
+    return response['status'], response['headers'], body, (iterator, result)
+
+
+# Reads response pieces until about RESPONSE_PIECE_BYTES are gathered or the iterator ends. Returns (bytes, done).
+def _pull_pieces(iterator, pieces=None):
+    pieces = pieces if pieces is not None else []
+    size = sum(len(piece) for piece in pieces)
+    for piece in iterator:
+        if piece:
+            pieces.append(piece)
+            size += len(piece)
+        if size >= RESPONSE_PIECE_BYTES:
+            return b''.join(pieces), False
+    return b''.join(pieces), True
+
+
+def _close(result):
+    close = getattr(result, 'close', None)
+    if close is not None:
+        close()
+
+
+# The contextvars.Context one response runs in. A Context can only be entered by one thread at a time; pulls
+# are sequential, but an abandoned response's close() may be queued while its last pull is still running,
+# so entries are serialized.
+class ResponseContext:
+    def __init__(self):
+        self.context = contextvars.copy_context()
+        self._lock = threading.Lock()
+
+    def run(self, fn, *args):
+        with self._lock:
+            return self.context.run(fn, *args)
+
+
+# PEP 3333 environ for an ASGI http scope whose body has been read in full
+def build_environ(scope, body, cancelled):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]) if server[1] is not None else '80',
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'neuroprice.cancelled': cancelled,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    environ['CONTENT_LENGTH'] = str(len(body)) # the body is complete, even when the client sent it chunked
+    return environ
+
+
+# --- ASGI side (runs on the event loop) ---
+class WsgiBridge:
+    def __init__(self, wsgi_app, inference_pool, io_pool, request_timeout=ASGI_REQUEST_TIMEOUT,
+                 max_body_bytes=ASGI_MAX_BODY_BYTES):
+        self.wsgi_app = wsgi_app
+        self.inference_pool = inference_pool
+        self.io_pool = io_pool
+        self.request_timeout = float(request_timeout)
+        self.max_body_bytes = int(max_body_bytes)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+        elif scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1000})
+
+    async def _handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.inference_pool.shutdown()
+                self.io_pool.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def pool_for(self, path):
+        return self.inference_pool if path.startswith(INFERENCE_PATH_PREFIXES) else self.io_pool
+
+    # The whole request body, or None when the client went away or sent more than max_body_bytes
+    async def _read_body(self, receive, send):
+        pieces = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            piece = message.get('body', b'')
+            size += len(piece)
+            if size > self.max_body_bytes:
+                await _send_error(send, 413, b'Request body too large.')
+                return None
+            pieces.append(piece)
+            if not message.get('more_body', False):
+                return b''.join(pieces)
+
+    # Runs fn on pool, giving up when the deadline passes or the client disconnects
+    async def _in_pool(self, pool, deadline, cancelled, disconnected, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = asyncio.wrap_future(pool.submit(loop, fn, *args))
+        done, _ = await asyncio.wait({future, disconnected}, timeout=max(0.0, deadline - loop.time()),
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if future in done:
+            return future.result()
+        cancelled.set()
+        future.cancel() # only stops a task that has not started; a running one finishes and is ignored
+        if disconnected in done:
+            pool.cancelled += 1
+            raise ClientDisconnected()
+        pool.timed_out += 1
+        raise RequestTimedOut()
+
+    async def _handle_http(self, scope, receive, send):
+        body = await self._read_body(receive, send)
+        if body is None:
+            return
+        pool = self.pool_for(scope['path'])
+        if not pool.admit():
+            await _send_error(send, 503, b'Server is busy. Please retry shortly.', retry_after=b'1')
+            return
+
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        pending = None # (iterator, result) of a streamed response still being sent
+        started = False
+        context = ResponseContext()
+        try:
+            deadline = loop.time() + self.request_timeout
+            status, headers, piece, pending = await self._in_pool(
+                pool, deadline, cancelled, disconnected, context.run, _start_wsgi, self.wsgi_app,
+                build_environ(scope, body, cancelled))
+            await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+            started = True
+            while pending is not None:
+                await send({'type': 'http.response.body', 'body': piece, 'more_body': True})
+                deadline = loop.time() + self.request_timeout
+                piece, done = await self._in_pool(pool, deadline, cancelled, disconnected, context.run, _pull_pieces,
+                                                  pending[0])
+                if done:
+                    pool.submit(loop, context.run, _close, pending[1])
+                    pending = None
+            await send({'type': 'http.response.body', 'body': piece, 'more_body': False})
+        except RequestTimedOut:
+            if not started:
+                await _send_error(send, 504, b'The request took too long to process.')
+            # else: return mid-stream, so the server aborts the connection rather than end a truncated body cleanly
+        except ClientDisconnected:
+            pass
+        finally:
+            disconnected.cancel()
+            if pending is not None:
+                cancelled.set()
+                pool.submit(loop, context.run, _close, pending[1]) # WSGI requires close(), even on abandoned responses
+
+    def stats(self):
+        return {"inference": self.inference_pool.stats(), "io": self.io_pool.stats()}
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _send_error(send, status, message, retry_after=None):
+    headers = [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(message)).encode())]
+    if retry_after is not None:
+        headers.append((b'retry-after', retry_after))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': message, 'more_body': False})
+
+
+application = WsgiBridge(flask_app, BoundedPool('inference', ASGI_INFERENCE_THREADS, ASGI_INFERENCE_QUEUE),
+                         BoundedPool('io', ASGI_IO_THREADS, ASGI_IO_QUEUE))
+
+metrics_registry.gauge_callback(
+    'neuroprice_asgi_pool', 'ASGI thread pool occupancy and request outcomes (asgi.py).',
+    lambda: {(pool, key): value for pool, stats in application.stats().items()
+             for key, value in stats.items() if key not in ('threads', 'limit')},
+    ('pool', 'stat'))
@@ -0,0 +1,338 @@
+# batch_score.py
+#
+# Offline repricing of a whole customer file with the same pipeline as /predict_price
+# (FeatureEncoder -> segmentation -> GB conversion probability -> pricing rules).
+#
+# The input (shaped like Segmented_Customers.csv) is read in fixed-size chunks and the chunks are scored on
+# a process pool. At most 2 x workers chunks are in flight and results are written in input order as
+# they complete, so memory stays bounded no matter how large the file is.
+#
+# Output formats:
+#   csv   one CSV file, appended chunk by chunk
+#   npz   a directory of part-NNNNNN.npz files, one per chunk, each holding one array per column
+#
+# Progress is recorded in a JSON checkpoint after every chunk is durably written. Re-running the same
+# command resumes after the last completed chunk (use --restart to start over). Resuming skips input
+# lines without parsing them, so the input must not contain quoted newlines.
+#
+#   python batch_score.py Segmented_Customers.csv scored.csv --workers 8
+#   python batch_score.py nightly.csv scored_parts --format npz --chunk-size 200000
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from model_bundle import ModelSet, load_bundle, load_current_bundle
+from model_schema import (BUNDLES_DIR, CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, NUMERIC_FIELDS, SEGMENTATION_FEATURES,
+                          numeric_field_error, parse_numeric_field)
+from pricing import DEFAULT_PRICING_RULES, PricingRules
+
+CHECKPOINT_FORMAT_VERSION = 1
+# Segmented_Customers.csv has no User_Product_Count column; the models were trained with 1 everywhere
+DEFAULT_PRODUCT_COUNT = 1
+NUMERIC_COLS = list(NUMERIC_FIELDS)
+
+_worker_model_set = None # the ModelSet of this worker process, set by _init_worker
+_worker_pricing_rules = None # the PricingRules the parent loaded, passed to every worker
+
+
+# --- Model loading ---
+# Loads the bundle named by version, else the CURRENT bundle, else the pickles (mirrors app.load_models)
+def load_model_set(bundles_dir, model_dir, version=None, fast_inference=True):
+    if version is not None and not version.startswith('pickles@'):
+        return load_bundle(os.path.join(bundles_dir, version))
+    model_set = load_current_bundle(bundles_dir) if version is None else None
+    if model_set is None:
+        model_set = ModelSet.from_pickles(model_dir, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS,
+                                          fast_inference=fast_inference, verbose=False)
+    if version is not None and model_set.version != version:
+        raise RuntimeError(f"Model files changed while scoring: expected '{version}', found '{model_set.version}'.")
+    return model_set
+
+
+def _init_worker(bundles_dir, model_dir, version, fast_inference, pricing_rules):
+    global _worker_model_set, _worker_pricing_rules
+    import warnings
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    _worker_model_set = load_model_set(bundles_dir, model_dir, version, fast_inference)
+    _worker_pricing_rules = pricing_rules
+
+
+def _score_in_worker(args):
+    chunk_index, frame = args
+    return chunk_index, score_frame(_worker_model_set, _worker_pricing_rules, frame)
+
+
+# --- Scoring ---
+# Validates and prices every row of frame with the same rules as build_customer_input.
+# Returns a dict of result columns aligned with frame; invalid rows get an error message and NaN prices.
+def score_frame(model_set, pricing_rules, frame, default_product_count=DEFAULT_PRODUCT_COUNT):
+    n = len(frame)
+    errors = np.full(n, '', dtype=object)
+
+    def reject(mask, message):
+        mask = np.asarray(mask) & (errors == '')
+        errors[mask] = message
+
+    # messages: a Series aligned with frame, NaN where the row is fine
+    def reject_each(messages):
+        mask = messages.notna().to_numpy() & (errors == '')
+        errors[mask] = messages.to_numpy()[mask]
+
+    columns = {}
+    for col in NUMERIC_COLS + CATEGORICAL_COLS:
+        if col in frame.columns:
+            columns[col] = frame[col]
+        elif col == 'User_Product_Count':
+            columns[col] = pd.Series(default_product_count, index=frame.index)
+        else:
+            raise ValueError(f"Input is missing required column '{col}'.")
+        reject(columns[col].isna().to_numpy(), f"Missing or null value for required field: '{col}'")
+
+    # Every distinct value goes through build_customer_input's own parse and range check (once, not per row);
+    # all parse errors come before any range error, as in build_customer_input
+    numbers, range_errors = {}, []
+    for col in NUMERIC_COLS:
+        parsed, parse_error, range_error = {}, {}, {}
+        for value in pd.unique(columns[col].dropna()):
+            try:
+                parsed[value] = parse_numeric_field(col, value)
+            except (TypeError, ValueError) as e:
+                parse_error[value] = f"Invalid numeric value: {e}"
+                continue
+            error = numeric_field_error(col, parsed[value])
+            if error is not None:
+                range_error[value] = error
+        reject_each(columns[col].map(parse_error))
+        range_errors.append(columns[col].map(range_error))
+        numbers[col] = np.nan_to_num(columns[col].map(parsed).to_numpy(dtype=np.float64, na_value=np.nan))
+    for messages in range_errors:
+        reject_each(messages)
+    age = numbers['Age']
+    product_count = numbers['User_Product_Count']
+    purchase_amount = numbers['Purchase_Amount']
+
+    encoder = model_set.feature_encoder
+    codes = {}
+    for col in CATEGORICAL_COLS:
+        mapped = columns[col].map(encoder.code_tables[col]).to_numpy(dtype=np.float64, na_value=np.nan)
+        unseen = np.flatnonzero(np.isnan(mapped) & (errors == ''))
+        for i in unseen:
+            errors[i] = f"Unseen label for '{col}': '{columns[col].iat[i]}'"
+        codes[col] = mapped
+
+    segments = np.full(n, '', dtype=object)
+    probabilities = np.full(n, np.nan)
+    optimized = np.full(n, np.nan)
+    valid = errors == ''
+    if valid.any():
+        X = encoder.encode_columns({col: values[valid] for col, values in codes.items()},
+                                   age[valid], product_count[valid], purchase_amount[valid])
+        cluster_ids, conversion_probabilities = model_set.predict(X)
+        segments[valid] = [model_set.segment_label(cluster_id) for cluster_id in cluster_ids]
+        probabilities[valid] = conversion_probabilities
+        optimized[valid] = pricing_rules.apply(purchase_amount[valid], conversion_probabilities, cluster_ids,
+                                               model_set.segment_mapping)
+
+    return {
+        'customer_segment': segments,
+        'predicted_conversion_probability': probabilities,
+        'original_price': np.where(valid, purchase_amount, np.nan),
+        'optimized_price': optimized,
+        'error': errors,
+    }
+
+
+# --- Output writers ---
+# Both writers expose position() (what the checkpoint records), truncate(position) (drop anything written
+# after the last checkpoint when resuming) and write(chunk_index, columns).
+class CsvWriter:
+    def __init__(self, path):
+        self.path = path
+
+    def position(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def truncate(self, position):
+        if os.path.exists(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(position)
+
+    def write(self, chunk_index, columns):
+        header = self.position() == 0
+        with open(self.path, 'a', newline='') as f:
+            pd.DataFrame(columns).to_csv(f, header=header, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class NpzWriter:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _part(self, chunk_index):
+        return os.path.join(self.path, f'part-{chunk_index:06d}.npz')
+
+    def _part_indexes(self):
+        return sorted(int(name[5:11]) for name in os.listdir(self.path)
+                      if name.startswith('part-') and name.endswith('.npz'))
+
+    # Number of parts written; parts are renamed into place only once complete
+    def position(self):
+        return len(self._part_indexes())
+
+    def truncate(self, position):
+        for chunk_index in self._part_indexes():
+            if chunk_index >= position:
+                os.remove(self._part(chunk_index))
+
+    def write(self, chunk_index, columns):
+        arrays = {name: (values.astype(str) if values.dtype == object else values) for name, values in columns.items()}
+        tmp_path = self._part(chunk_index) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._part(chunk_index))
+
+
+# --- Checkpoints ---
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Reads the input in chunks of chunk_size rows, skipping the first skip_rows data rows without parsing them
+def _read_chunks(path, chunk_size, skip_rows):
+    with open(path, newline='') as f:
+        header = next(csv.reader([f.readline()]))
+        for _ in itertools.islice(f, skip_rows):
+            pass
+        # Everything stays text so labels like 'None' or 'NA' reach validation as written
+        for frame in pd.read_csv(f, names=header, header=None, chunksize=chunk_size, dtype=str,
+                                 keep_default_na=False, na_values=['']):
+            yield frame
+
+
+def run(args):
+    checkpoint_path = args.checkpoint or os.path.normpath(args.output) + '.checkpoint.json'
+    model_set = load_model_set(args.bundles_dir, args.model_dir, args.model_version, not args.no_fast_inference)
+    # Rules are read once so every chunk of one run is priced by the same policy
+    rules = PricingRules.from_file(args.pricing_rules) if os.path.exists(args.pricing_rules) else PricingRules(DEFAULT_PRICING_RULES)
+    writer = (CsvWriter if args.format == 'csv' else NpzWriter)(args.output)
+
+    job = {
+        "format_version": CHECKPOINT_FORMAT_VERSION,
+        "input": os.path.abspath(args.input),
+        "input_size": os.path.getsize(args.input),
+        "output": os.path.abspath(args.output),
+        "format": args.format,
+        "chunk_size": args.chunk_size,
+        "model_version": model_set.version,
+        "pricing_rules": {"default": rules.default, "segments": rules.segments},
+    }
+    state = None if args.restart else _read_checkpoint(checkpoint_path)
+    if state is not None:
+        if state["job"] != job:
+            sys.exit(f"Checkpoint {checkpoint_path} belongs to a different job (input, output, chunk size, "
+                     f"model version or pricing rules changed). Use --restart to start over.")
+        if state["finished"]:
+            print(f"Already complete: {state['rows_done']} rows scored into {args.output}.")
+            return
+        writer.truncate(state["output_position"])
+        print(f"Resuming after chunk {state['chunks_done']} ({state['rows_done']} rows already scored).")
+    else:
+        writer.truncate(0)
+        state = {"job": job, "chunks_done": 0, "rows_done": 0, "failed_rows": 0,
+                 "output_position": writer.position(), "finished": False}
+        _write_checkpoint(checkpoint_path, state)
+
+    print(f"Scoring {args.input} with model '{model_set.version}' using {args.workers} worker(s), "
+          f"{args.chunk_size} rows per chunk.")
+    started = time.monotonic()
+    chunks = enumerate(_read_chunks(args.input, args.chunk_size, state["rows_done"]), start=state["chunks_done"])
+
+    def finish_chunk(chunk_index, frame, results):
+        columns = {col: frame[col].to_numpy(dtype=object) for col in args.keep_columns if col in frame.columns}
+        columns.update(results)
+        writer.write(chunk_index, columns)
+        state["chunks_done"] = chunk_index + 1
+        state["rows_done"] += len(frame)
+        state["failed_rows"] += int((results['error'] != '').sum())
+        state["output_position"] = writer.position()
+        _write_checkpoint(checkpoint_path, state)
+        elapsed = time.monotonic() - started
+        print(f"  chunk {chunk_index}: {state['rows_done']} rows done, {state['failed_rows']} invalid "
+              f"({elapsed:.1f}s elapsed)")
+
+    if args.workers <= 1:
+        for chunk_index, frame in chunks:
+            finish_chunk(chunk_index, frame, score_frame(model_set, rules, frame))
+    else:
+        init_args = (args.bundles_dir, args.model_dir, model_set.version, not args.no_fast_inference, rules)
+        max_in_flight = 2 * args.workers
+        with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=init_args) as pool:
+            pending = {} # chunk_index -> (frame, future), written strictly in chunk order
+            next_to_write = state["chunks_done"]
+            for chunk_index, frame in itertools.chain(chunks, [(None, None)]):
+                if frame is not None:
+                    pending[chunk_index] = (frame, pool.submit(_score_in_worker, (chunk_index, frame)))
+                # Drain in order; block on the oldest chunk while too many are in flight or the input is exhausted
+                while pending and (len(pending) >= max_in_flight or frame is None or pending[next_to_write][1].done()):
+                    oldest_frame, future = pending.pop(next_to_write)
+                    finish_chunk(next_to_write, oldest_frame, future.result()[1])
+                    next_to_write += 1
+
+    state["finished"] = True
+    _write_checkpoint(checkpoint_path, state)
+    elapsed = time.monotonic() - started
+    print(f"Done: {state['rows_done']} rows ({state['failed_rows']} invalid) written to {args.output} "
+          f"in {elapsed:.1f}s.")
+
+
+if __name__ == '__main__':
+    import warnings
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    parser = argparse.ArgumentParser(description="Reprice a customer CSV offline with the trained models.")
+    parser.add_argument('input', help="CSV shaped like Segmented_Customers.csv")
+    parser.add_argument('output', help="output CSV file, or output directory for --format npz")
+    parser.add_argument('--format', choices=['csv', 'npz'], default='csv')
+    parser.add_argument('--chunk-size', type=int, default=100000, help="rows per chunk (default 100000)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="scoring processes; 1 scores in this process (default: CPU count)")
+    parser.add_argument('--keep-columns', type=lambda s: [c for c in s.split(',') if c], default=['User_ID', 'Product_ID'],
+                        help="comma-separated input columns copied to the output (default User_ID,Product_ID)")
+    parser.add_argument('--checkpoint', help="checkpoint file (default: <output>.checkpoint.json)")
+    parser.add_argument('--restart', action='store_true', help="ignore any existing checkpoint and start over")
+    parser.add_argument('--model-version', help="bundle version to score with (default: CURRENT bundle, else the pickles)")
+    parser.add_argument('--bundles-dir', default=BUNDLES_DIR)
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--pricing-rules', default='pricing_rules.json',
+                        help="pricing rules file (default pricing_rules.json; built-in rules if missing)")
+    parser.add_argument('--no-fast-inference', action='store_true', help="use the sklearn models when scoring from pickles")
+    args = parser.parse_args()
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+    run(args)
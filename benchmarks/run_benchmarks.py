@@ -0,0 +1,305 @@
+# benchmarks/run_benchmarks.py
+#
+# Performance regression harness. Runs the app in-process through the Flask test client (no network),
+# against a throwaway copy of the database, and reports latency percentiles, throughput and peak memory.
+#
+#   replay   replays captured traffic (TRAFFIC_CAPTURE_PATH, see traffic_capture.py) or generated traffic
+#            against /predict_price and /complete_purchase
+#   stages   microbenchmarks each pipeline stage (label encoding, scaling, KMeans, GB, pricing rules)
+#            at several batch sizes
+#   all      both
+#
+#   python benchmarks/run_benchmarks.py replay --traffic captured.jsonl
+#   python benchmarks/run_benchmarks.py all --generate 5000 --save-baseline benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py all --generate 5000 --baseline benchmarks/baseline.json
+#
+# With --baseline, every metric is compared against the stored run and the exit status is 1 if any got
+# worse by more than --tolerance (default 25%). Compare runs from the same machine only.
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_USERNAME = 'bench_user'
+BENCH_PASSWORD = 'bench-password'
+DEFAULT_BATCH_SIZES = (1, 8, 64, 512, 4096)
+
+
+# Imports app with a temporary copy of the database so benchmarks never touch real data
+def load_app(use_prediction_cache):
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    work_dir = tempfile.mkdtemp(prefix='neuroprice-bench-')
+    database_path = os.path.join(work_dir, 'users_data.db')
+    if os.path.exists('users_data.db'):
+        shutil.copy('users_data.db', database_path)
+    os.environ['DATABASE_PATH'] = database_path
+    os.environ.pop('TRAFFIC_CAPTURE_PATH', None) # never capture the replay itself
+    if not use_prediction_cache:
+        os.environ['PREDICTION_CACHE_SIZE'] = '0'
+    import app as app_module
+    if app_module.models is None:
+        sys.exit("Models failed to load; nothing to benchmark.")
+    return app_module, work_dir
+
+
+# A logged-in test client for a benchmark user whose profile uses valid labels
+def bench_client(app_module):
+    from werkzeug.security import generate_password_hash
+    classes = app_module.models.feature_encoder.classes
+    with app_module.database.transaction() as conn:
+        if conn.execute("SELECT 1 FROM users WHERE username = ?", (BENCH_USERNAME,)).fetchone() is None:
+            conn.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (app_module.allocate_user_id(conn), BENCH_USERNAME, generate_password_hash(BENCH_PASSWORD),
+                          'Bench User', 34, classes['Gender'][0], classes['City'][0], classes['Occupation'][0],
+                          classes['Loyalty_Tier'][0]))
+    client = app_module.app.test_client()
+    response = client.post('/login', data={'username': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+    if response.status_code != 302:
+        sys.exit("Could not log in the benchmark user.")
+    return client
+
+
+def random_customer(classes, rng):
+    row = {col: rng.choice(labels) for col, labels in classes.items()}
+    row['Age'] = rng.randint(18, 80)
+    row['User_Product_Count'] = rng.randint(0, 40)
+    row['Purchase_Amount'] = round(np.exp(rng.uniform(1.5, 7.5)), 2)
+    return row
+
+
+# Synthetic traffic in the capture format: mostly guest and logged-in price checks, some checkouts
+def generate_traffic(classes, n_requests, seed=0, purchase_share=0.05, authenticated_share=0.3):
+    rng = random.Random(seed)
+    records = []
+    for _ in range(n_requests):
+        roll = rng.random()
+        if roll < purchase_share:
+            items = [{"name": f"Product {rng.randint(1, 500)}", "category": rng.choice(classes['Product_Category']),
+                      "original_price": round(rng.uniform(5, 900), 2), "quantity": rng.randint(1, 3)}
+                     for _ in range(rng.randint(1, 4))]
+            records.append({"endpoint": "/complete_purchase", "authenticated": True, "payload": {"cart_items": items}})
+        elif roll < purchase_share + authenticated_share:
+            customer = random_customer(classes, rng)
+            payload = {key: customer[key] for key in ('Product_Category', 'Purchase_Amount', 'Weather', 'Time_of_Day')}
+            records.append({"endpoint": "/predict_price", "authenticated": True, "payload": payload})
+        else:
+            records.append({"endpoint": "/predict_price", "authenticated": False, "payload": random_customer(classes, rng)})
+    return records
+
+
+def latency_summary(latencies):
+    latencies_ms = np.asarray(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {"count": len(latencies), "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99),
+            "mean_ms": float(latencies_ms.mean())}
+
+
+def run_replay(app_module, records, warmup, trace_memory):
+    guest = app_module.app.test_client()
+    member = bench_client(app_module)
+    replayable = [r for r in records if r.get("endpoint") in ('/predict_price', '/complete_purchase')]
+    if not replayable:
+        sys.exit("No /predict_price or /complete_purchase records to replay.")
+
+    def send(record):
+        client = member if record.get("authenticated") or record["endpoint"] == '/complete_purchase' else guest
+        return client.post(record["endpoint"], json=record.get("payload"))
+
+    for record in replayable[:warmup]:
+        send(record)
+
+    latencies = {}
+    statuses = {}
+    started = time.perf_counter()
+    for record in replayable[warmup:]:
+        t0 = time.perf_counter()
+        response = send(record)
+        elapsed = time.perf_counter() - t0
+        latencies.setdefault(record["endpoint"], []).append(elapsed)
+        key = f'{record["endpoint"]} {response.status_code}'
+        statuses[key] = statuses.get(key, 0) + 1
+    wall = time.perf_counter() - started
+
+    # tracemalloc slows every allocation down, so peak memory is measured in a second, untimed pass
+    traced_peak = None
+    if trace_memory:
+        tracemalloc.start()
+        for record in replayable[warmup:]:
+            send(record)
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    if not all_latencies:
+        sys.exit("Nothing left to measure after the warmup requests.")
+    result = {
+        "overall": {**latency_summary(all_latencies), "throughput_rps": len(all_latencies) / wall},
+        "endpoints": {endpoint: latency_summary(values) for endpoint, values in latencies.items()},
+        "statuses": statuses,
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if traced_peak is not None:
+        result["peak_traced_kib"] = traced_peak // 1024
+    return result
+
+
+# Collects per-stage durations from ModelSet.predict's timer hook
+class StageClock:
+    def __init__(self):
+        self.totals = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] = self.totals.get(stage, 0.0) + time.perf_counter() - started
+
+
+def run_stages(app_module, batch_sizes, min_seconds, seed=0):
+    model_set = app_module.models
+    rules = app_module.pricing_rules.current()
+    classes = model_set.feature_encoder.classes
+    rng = random.Random(seed)
+    results = {}
+    for batch_size in batch_sizes:
+        rows = [random_customer(classes, rng) for _ in range(batch_size)]
+        amounts = np.array([row['Purchase_Amount'] for row in rows])
+        clock = StageClock()
+        calls = 0
+        started = time.perf_counter()
+        while calls < 3 or time.perf_counter() - started < min_seconds:
+            with clock('label_encoding'):
+                X = model_set.feature_encoder.encode_rows(rows)
+            cluster_ids, probabilities = model_set.predict(X, clock)
+            with clock('pricing_rules'):
+                rules.apply(amounts, probabilities, cluster_ids, model_set.segment_mapping)
+            calls += 1
+        results[str(batch_size)] = {
+            stage: {"us_per_call": total / calls * 1e6, "rows_per_s": batch_size * calls / total if total else 0.0}
+            for stage, total in clock.totals.items()
+        }
+        total = sum(clock.totals.values())
+        results[str(batch_size)]["pipeline"] = {"us_per_call": total / calls * 1e6,
+                                                "rows_per_s": batch_size * calls / total if total else 0.0}
+    return results
+
+
+# (name, value, lower_is_better) for every comparable metric of one run
+def flatten_metrics(results):
+    metrics = []
+    replay = results.get("replay")
+    if replay:
+        for endpoint, summary in [("overall", replay["overall"])] + sorted(replay["endpoints"].items()):
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                metrics.append((f"replay {endpoint} {key}", summary[key], True))
+        metrics.append(("replay overall throughput_rps", replay["overall"]["throughput_rps"], False))
+        metrics.append(("replay peak_rss_kib", replay["peak_rss_kib"], True))
+    for batch_size, stages in sorted((results.get("stages") or {}).items(), key=lambda item: int(item[0])):
+        for stage, values in sorted(stages.items()):
+            metrics.append((f"stage batch={batch_size} {stage} us_per_call", values["us_per_call"], True))
+    return metrics
+
+
+def compare(results, baseline, tolerance):
+    baseline_metrics = {name: value for name, value, _ in flatten_metrics(baseline)}
+    regressions = []
+    print(f"\n{'metric':<58} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, value, lower_is_better in flatten_metrics(results):
+        if name not in baseline_metrics or not baseline_metrics[name]:
+            continue
+        change = (value - baseline_metrics[name]) / baseline_metrics[name]
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        flag = '  REGRESSION' if worse else ''
+        print(f"{name:<58} {baseline_metrics[name]:>12.3f} {value:>12.3f} {change:>+8.1%}{flag}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results):
+    replay = results.get("replay")
+    if replay:
+        print(f"\n{'endpoint':<22} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for endpoint, summary in [("overall", replay["overall"])] + sorted(replay["endpoints"].items()):
+            print(f"{endpoint:<22} {summary['count']:>7} {summary['p50_ms']:>9.3f} {summary['p95_ms']:>9.3f} "
+                  f"{summary['p99_ms']:>9.3f}")
+        print(f"throughput: {replay['overall']['throughput_rps']:.1f} requests/s (sequential, one client)")
+        print(f"statuses: {replay['statuses']}")
+        print(f"peak RSS: {replay['peak_rss_kib'] / 1024:.1f} MiB" +
+              (f", peak traced Python allocations: {replay['peak_traced_kib'] / 1024:.1f} MiB" if "peak_traced_kib" in replay else ""))
+    stages = results.get("stages")
+    if stages:
+        print(f"\n{'batch':>6} {'stage':<16} {'us/call':>12} {'rows/s':>14}")
+        for batch_size, values in sorted(stages.items(), key=lambda item: int(item[0])):
+            for stage, numbers in values.items():
+                print(f"{batch_size:>6} {stage:<16} {numbers['us_per_call']:>12.1f} {numbers['rows_per_s']:>14.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay traffic and microbenchmark the pricing pipeline in-process.")
+    parser.add_argument('mode', choices=['replay', 'stages', 'all'])
+    parser.add_argument('--traffic', help="JSONL capture file to replay (see TRAFFIC_CAPTURE_PATH)")
+    parser.add_argument('--generate', type=int, default=2000, help="synthetic requests to replay when --traffic is not given")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=50, help="requests sent before measuring")
+    parser.add_argument('--prediction-cache', action='store_true', help="keep the prediction cache on during replay")
+    parser.add_argument('--trace-memory', action='store_true', help="also report peak traced Python allocations (slower)")
+    parser.add_argument('--batch-sizes', default=','.join(map(str, DEFAULT_BATCH_SIZES)))
+    parser.add_argument('--min-seconds', type=float, default=0.3, help="minimum measuring time per batch size")
+    parser.add_argument('--save-baseline', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against this JSON file and exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown before flagging")
+    args = parser.parse_args()
+
+    import warnings
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    app_module, work_dir = load_app(args.prediction_cache)
+    try:
+        results = {"meta": {"created_at": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(),
+                            "machine": platform.machine(), "processor": platform.processor(),
+                            "model_version": app_module.models.version}}
+        if args.mode in ('replay', 'all'):
+            if args.traffic:
+                from traffic_capture import read_traffic
+                records = list(read_traffic(args.traffic))
+            else:
+                records = generate_traffic(app_module.models.feature_encoder.classes, args.generate + args.warmup, args.seed)
+            results["replay"] = run_replay(app_module, records, args.warmup, args.trace_memory)
+        if args.mode in ('stages', 'all'):
+            batch_sizes = [int(size) for size in args.batch_sizes.split(',') if size]
+            results["stages"] = run_stages(app_module, batch_sizes, args.min_seconds, args.seed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}.")
+            sys.exit(1)
+        print("\nNo regressions beyond tolerance.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# db.py
+#
+# SQLite access layer: one long-lived connection per thread (per process) instead of a fresh
+# sqlite3.connect() for every query. Each connection is opened once with WAL journaling and tuned
+# pragmas, keeps sqlite3's compiled-statement cache warm for the app's fixed queries, and waits on
+# busy locks instead of failing. Writes go through transaction(), which takes the write lock up front
+# (BEGIN IMMEDIATE) so concurrent writers queue on busy_timeout rather than hitting "database is locked"
+# when a deferred read transaction tries to upgrade.
+# Connections run synchronous=NORMAL (a commit is durable only once the WAL is checkpointed); writes that are
+# acknowledged to a client, such as checkouts, pass synchronous='FULL' to transaction() so they fsync on commit.
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class Database:
+    SYNCHRONOUS = 'NORMAL'
+
+    def __init__(self, path, busy_timeout_ms=5000, cache_size_kib=16384, mmap_size=268435456,
+                 statement_cache_size=256):
+        self.path = path
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.cache_size_kib = int(cache_size_kib)
+        self.mmap_size = int(mmap_size)
+        self.statement_cache_size = int(statement_cache_size)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._inherited = [] # connections inherited through fork(), kept referenced so they are never closed here
+        self.connections_opened = 0
+
+    def _connect(self):
+        # isolation_level=None: no implicit BEGIN; transactions are explicit in transaction()
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000.0, isolation_level=None,
+                               cached_statements=self.statement_cache_size)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS}") # durable at checkpoints in WAL mode, no fsync per commit
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_size_kib}") # negative value = KiB
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with self._stats_lock:
+            self.connections_opened += 1
+        return conn
+
+    # This thread's connection, opened on first use. A connection inherited through fork()
+    # belongs to the parent process and is abandoned, never reused or closed here.
+    def connection(self):
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None or local.pid != os.getpid():
+            if conn is not None:
+                self._inherited.append(conn) # dropping it would close the parent's SQLite handle in this process
+            conn = self._connect()
+            local.conn = conn
+            local.pid = os.getpid()
+        return conn
+
+    # Write transaction on this thread's connection: commits on success, rolls back and re-raises on error.
+    # synchronous overrides the connection's level for this transaction only (set before BEGIN: SQLite refuses to change
+    # it inside a transaction) and is restored afterwards.
+    @contextmanager
+    def transaction(self, synchronous=None):
+        conn = self.connection()
+        if synchronous:
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+        finally:
+            if synchronous:
+                conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS}")
+
+    # Drops this thread's connection (e.g. after a test or when a worker shuts down)
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def stats(self):
+        return {"path": self.path, "connections_opened": self.connections_opened,
+                "busy_timeout_ms": self.busy_timeout_ms}
@@ -0,0 +1,187 @@
+# fast_inference.py
+#
+# Array-based replacements for gb_model.predict_proba and kmeans_model.predict.
+# Every GradientBoosting tree is flattened into shared contiguous arrays (feature, threshold,
+# left/right child, value) and all trees are walked together, level by level, for a whole batch.
+# KMeans assignment is a single matmul against precomputed centroids.
+# Both skip sklearn's per-call input validation and dispatch, which dominates at batch size 1.
+
+from contextlib import nullcontext
+
+import numpy as np
+
+# Rows walked through the trees at once; bounds the (rows x trees) node-index scratch arrays
+ROW_CHUNK_SIZE = 4096
+
+
+# Default for the engines' timer argument: runs each stage untimed
+def no_timer(stage):
+    return nullcontext()
+
+
+class FlatTreeEnsemble:
+    # Binary GradientBoostingClassifier (log_loss) flattened into node arrays.
+    # Leaves point at themselves, so every row can take exactly max_depth steps without branching.
+    def __init__(self, feature, threshold, left, right, value, roots, max_depth, learning_rate, init_raw, children=None):
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+        self.left = np.ascontiguousarray(left, dtype=np.intp)
+        self.right = np.ascontiguousarray(right, dtype=np.intp)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.roots = np.ascontiguousarray(roots, dtype=np.intp)
+        self.max_depth = int(max_depth)
+        self.learning_rate = float(learning_rate)
+        self.init_raw = float(init_raw)
+        self.n_trees = len(self.roots)
+        # left/right interleaved so one gather picks the next node: children[2 * node + go_right]
+        if children is None:
+            children = np.column_stack([self.left, self.right]).ravel()
+        self.children = np.ascontiguousarray(children, dtype=np.intp)
+
+    @classmethod
+    def from_sklearn(cls, gb_model):
+        if gb_model.estimators_.shape[1] != 1:
+            raise ValueError("Only binary GradientBoostingClassifier models can be flattened.")
+        trees = [est.tree_ for est in gb_model.estimators_[:, 0]]
+        sizes = [t.node_count for t in trees]
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+
+        feature, threshold, left, right, value = [], [], [], [], []
+        for t, offset in zip(trees, offsets):
+            node_ids = np.arange(t.node_count, dtype=np.intp) + offset
+            is_leaf = t.children_left == -1
+            feature.append(np.where(is_leaf, 0, t.feature))
+            threshold.append(np.where(is_leaf, 0.0, t.threshold))
+            left.append(np.where(is_leaf, node_ids, t.children_left + offset))
+            right.append(np.where(is_leaf, node_ids, t.children_right + offset))
+            value.append(t.value[:, 0, 0])
+
+        # Raw score of the init estimator (log-odds of the class prior); constant for every row
+        init_raw = gb_model._raw_predict_init(np.zeros((1, gb_model.n_features_in_), dtype=np.float32))[0, 0]
+
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(left),
+                   np.concatenate(right), np.concatenate(value), offsets,
+                   max(t.max_depth for t in trees), gb_model.learning_rate, init_raw)
+
+    def decision_function(self, X):
+        # Trees compare float32 features against float64 thresholds, same as sklearn
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_rows, n_features = X.shape
+        raw = np.empty(n_rows, dtype=np.float64)
+        for start in range(0, n_rows, ROW_CHUNK_SIZE):
+            chunk = X[start:start + ROW_CHUNK_SIZE]
+            n_chunk = chunk.shape[0]
+            flat_chunk = chunk.ravel()
+            row_offsets = (np.arange(n_chunk, dtype=np.intp) * n_features)[:, np.newaxis]
+
+            # (rows x trees) current node ids; every tree advances one level per step
+            nodes = np.broadcast_to(self.roots, (n_chunk, self.n_trees))
+            for _ in range(self.max_depth):
+                go_right = ~(flat_chunk[row_offsets + self.feature[nodes]] <= self.threshold[nodes])
+                nodes = self.children[2 * nodes + go_right]
+
+            # Stage contributions laid out (trees x rows) behind the init score. Reducing over the outer axis
+            # adds them strictly in stage order, so the result equals sklearn's predict_stages bit for bit.
+            # (numpy switches to pairwise summation for a single contiguous column, hence at least 2 columns.)
+            n_cols = max(n_chunk, 2)
+            stages = np.empty((self.n_trees + 1, n_cols), dtype=np.float64)
+            stages[0] = self.init_raw
+            np.multiply(self.learning_rate, self.value[nodes].T, out=stages[1:, :n_chunk])
+            if n_chunk == 1:
+                stages[1:, 1] = stages[1:, 0]
+            raw[start:start + n_chunk] = np.add.reduce(stages, axis=0)[:n_chunk]
+        return raw
+
+    # Distinct thresholds the trees compare column (an index into the GB matrix) against
+    def split_points(self, column):
+        internal = self.left != np.arange(len(self.left))
+        return np.unique(self.threshold[internal & (self.feature == column)])
+
+    # Probability of the positive class (gb_model.predict_proba(X)[:, 1]): the logistic function of the raw
+    # score, in place. Written in NumPy rather than scipy.special.expit (within one ulp of it) so serving
+    # never imports scipy, which would add a quarter of a second to every cold start.
+    def predict_positive_proba(self, X):
+        probs = self.decision_function(X)
+        with np.errstate(over='ignore'): # exp overflows to inf for very negative scores, giving 0.0 as it should
+            np.exp(np.negative(probs, out=probs), out=probs)
+        probs += 1.0
+        return np.reciprocal(probs, out=probs)
+
+
+class CentroidAssigner:
+    # Nearest-centroid assignment as ||c||^2 - 2 x.c; ||x||^2 is the same for every centroid so it is dropped
+    # counts: optional rows absorbed per centroid, kept so incremental updates can keep going (retrain_segmentation.py)
+    def __init__(self, centers, counts=None):
+        centers = np.asarray(centers, dtype=np.float64)
+        self.centers = centers
+        self.counts = None if counts is None else np.asarray(counts, dtype=np.float64)
+        self.neg2_centers_t = np.ascontiguousarray(-2.0 * centers.T)
+        self.center_sq_norms = np.einsum('ij,ij->i', centers, centers)
+
+    @classmethod
+    def from_sklearn(cls, kmeans_model):
+        return cls(kmeans_model.cluster_centers_)
+
+    def predict(self, X):
+        distances = X @ self.neg2_centers_t
+        distances += self.center_sq_norms
+        return np.argmin(distances, axis=1).astype(np.int32)
+
+
+class FastInferenceEngine:
+    # Drop-in for the sklearn calls (model_bundle.SklearnEngine): takes matrices in FeatureEncoder's row layout
+    def __init__(self, feature_encoder, segmenter, ensemble):
+        self.feature_encoder = feature_encoder
+        self.segmenter = segmenter
+        self.ensemble = ensemble
+
+    @classmethod
+    def from_sklearn(cls, feature_encoder, kmeans_model, gb_model):
+        return cls(feature_encoder, CentroidAssigner.from_sklearn(kmeans_model), FlatTreeEnsemble.from_sklearn(gb_model))
+
+    # timer(stage) is an optional context manager factory (see metrics.StageTimer) wrapped around each stage
+    def predict(self, X, timer=no_timer):
+        with timer('scaling'):
+            segmentation_X = self.feature_encoder.segmentation_matrix(X)
+        with timer('kmeans'):
+            cluster_ids = self.segmenter.predict(segmentation_X)
+        with timer('gb'):
+            conversion_probabilities = self.ensemble.predict_positive_proba(self.feature_encoder.gb_matrix(X, cluster_ids))
+        return cluster_ids, conversion_probabilities
+
+    # Segment ids alone (no GB pass)
+    def segment(self, X):
+        return self.segmenter.predict(self.feature_encoder.segmentation_matrix(X))
+
+    def split_points(self, column):
+        return self.ensemble.split_points(column)
+
+
+# Random but valid encoded rows covering every label, realistic ages, product counts and amounts
+def sample_feature_rows(feature_encoder, n_rows=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(n_rows):
+        row = {col: classes[rng.integers(len(classes))] for col, classes in feature_encoder.classes.items()}
+        row['Age'] = int(rng.integers(1, 120))
+        row['User_Product_Count'] = int(rng.integers(0, 60))
+        row['Purchase_Amount'] = float(np.round(np.exp(rng.uniform(0.0, 8.5)), 2))
+        rows.append(row)
+    return feature_encoder.encode_rows(rows)
+
+
+# Compares the engine against the sklearn models on X.
+# Returns (matches, n_segment_mismatches, max_probability_difference).
+def check_parity(engine, kmeans_model, gb_model, X, tolerance=1e-12):
+    encoder = engine.feature_encoder
+    fast_ids, fast_probs = engine.predict(X.copy())
+
+    reference = X.copy()
+    ref_ids = kmeans_model.predict(encoder.segmentation_matrix(reference))
+    ref_probs = gb_model.predict_proba(encoder.gb_matrix(reference, ref_ids))[:, 1]
+
+    n_segment_mismatches = int(np.count_nonzero(fast_ids != ref_ids))
+    # Compare probabilities on the reference segmentation so one boundary row cannot hide a tree bug
+    same_segment_probs = engine.ensemble.predict_positive_proba(encoder.gb_matrix(X.copy(), ref_ids))
+    max_diff = float(np.max(np.abs(same_segment_probs - ref_probs))) if len(X) else 0.0
+    return n_segment_mismatches == 0 and max_diff <= tolerance, n_segment_mismatches, max_diff
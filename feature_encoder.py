@@ -0,0 +1,128 @@
+# feature_encoder.py
+#
+# Turns validated customer input dicts into model-ready NumPy rows without building a pandas DataFrame.
+# Everything that does not depend on the request (label -> code tables, column index arrays for
+# SEGMENTATION_FEATURES / GB_FEATURES, scaler constants) is computed once when the encoder is built.
+# The numbers produced are identical to the original DataFrame + LabelEncoder + StandardScaler pipeline.
+
+import numpy as np
+
+# Match Colab notebook's Age_Group buckets: <30 Young, <50 Mid-age, else Senior
+AGE_GROUP_BOUNDS = (30, 50)
+
+
+class FeatureEncoder:
+    # classes: {categorical column: labels in LabelEncoder order}; the remaining arguments are the
+    # StandardScaler mean_/scale_ values. Use from_sklearn() to build one from the fitted objects.
+    def __init__(self, classes, purchase_amount_mean, purchase_amount_scale, segmentation_mean, segmentation_scale,
+                 segmentation_features, gb_features, categorical_cols):
+        self.categorical_cols = list(categorical_cols)
+        self.segmentation_features = list(segmentation_features)
+        self.gb_features = list(gb_features)
+
+        # One row layout holding every feature either model needs, in first-seen order
+        self.columns = []
+        for name in self.segmentation_features + self.gb_features:
+            if name not in self.columns:
+                self.columns.append(name)
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        self.n_columns = len(self.columns)
+
+        # Fixed index arrays used to slice the row layout for each model
+        self.segmentation_index = np.array([self.column_index[f] for f in self.segmentation_features], dtype=np.intp)
+        self.gb_index = np.array([self.column_index[f] for f in self.gb_features], dtype=np.intp)
+        self.segment_column = self.column_index['CustomerSegment']
+
+        # label -> code tables. LabelEncoder codes are positions in the sorted classes_ array.
+        self.classes = {}
+        self.code_tables = {}
+        for col in self.categorical_cols:
+            labels = [c.item() if hasattr(c, 'item') else c for c in classes[col]]
+            self.classes[col] = labels
+            self.code_tables[col] = {label: code for code, label in enumerate(labels)}
+        self._categorical_positions = [(col, self.column_index[col]) for col in self.categorical_cols]
+
+        self._age_column = self.column_index['Age']
+        self._age_group_column = self.column_index['Age_Group']
+        self._product_count_column = self.column_index['User_Product_Count']
+        self._amount_column = self.column_index['Purchase_Amount_Scaled']
+
+        # StandardScaler constants, pre-sliced so transform is two vector ops
+        self.purchase_amount_mean = float(purchase_amount_mean)
+        self.purchase_amount_scale = float(purchase_amount_scale)
+        self.segmentation_mean = np.asarray(segmentation_mean, dtype=np.float64)
+        self.segmentation_scale = np.asarray(segmentation_scale, dtype=np.float64)
+
+    @classmethod
+    def from_sklearn(cls, label_encoders, scaler_purchase_amount, scaler_segmentation_features,
+                     segmentation_features, gb_features, categorical_cols):
+        classes = {col: label_encoders[col].classes_ for col in categorical_cols}
+        return cls(classes, scaler_purchase_amount.mean_[0], scaler_purchase_amount.scale_[0],
+                   np.array(scaler_segmentation_features.mean_, dtype=np.float64),
+                   np.array(scaler_segmentation_features.scale_, dtype=np.float64),
+                   segmentation_features, gb_features, categorical_cols)
+
+    # Returns the integer code for a label, or None if the encoder never saw it
+    def code(self, col, value):
+        try:
+            return self.code_tables[col].get(value)
+        except TypeError: # unhashable JSON values (lists/dicts) are never valid labels
+            return None
+
+    def scale_purchase_amount(self, purchase_amount):
+        return (purchase_amount - self.purchase_amount_mean) / self.purchase_amount_scale
+
+    # Writes one validated customer input dict into a float row (CustomerSegment left as 0)
+    def encode_row(self, customer_input_data, out=None):
+        row = np.zeros(self.n_columns, dtype=np.float64) if out is None else out
+        for col, pos in self._categorical_positions:
+            row[pos] = self.code_tables[col][customer_input_data[col]]
+        age = customer_input_data['Age']
+        row[self._age_column] = age
+        row[self._age_group_column] = 0 if age < AGE_GROUP_BOUNDS[0] else (1 if age < AGE_GROUP_BOUNDS[1] else 2)
+        row[self._product_count_column] = customer_input_data['User_Product_Count']
+        row[self._amount_column] = self.scale_purchase_amount(customer_input_data['Purchase_Amount'])
+        if out is not None:
+            row[self.segment_column] = 0.0
+        return row
+
+    # Encodes N validated rows into an (N, n_columns) matrix
+    def encode_rows(self, rows):
+        X = np.zeros((len(rows), self.n_columns), dtype=np.float64)
+        for i, customer_input_data in enumerate(rows):
+            self.encode_row(customer_input_data, out=X[i])
+        return X
+
+    # Column-wise encode_rows for already validated arrays: codes maps each categorical column to its
+    # integer label codes (see code_tables); age, product_count and purchase_amount are numeric arrays
+    def encode_columns(self, codes, age, product_count, purchase_amount):
+        age = np.asarray(age, dtype=np.float64)
+        X = np.zeros((len(age), self.n_columns), dtype=np.float64)
+        for col, pos in self._categorical_positions:
+            X[:, pos] = codes[col]
+        X[:, self._age_column] = age
+        X[:, self._age_group_column] = np.where(age < AGE_GROUP_BOUNDS[0], 0, np.where(age < AGE_GROUP_BOUNDS[1], 1, 2))
+        X[:, self._product_count_column] = product_count
+        X[:, self._amount_column] = self.scale_purchase_amount(np.asarray(purchase_amount, dtype=np.float64))
+        return X
+
+    # Copies of one encoded row with some inputs varied: variations maps 'Purchase_Amount' or a categorical
+    # column to N raw values (amounts are scaled, labels must be known). Returns an (N, n_columns) matrix.
+    def sweep(self, row, variations):
+        n_rows = len(next(iter(variations.values())))
+        X = np.repeat(row[np.newaxis, :], n_rows, axis=0)
+        for name, values in variations.items():
+            if name == 'Purchase_Amount':
+                X[:, self._amount_column] = self.scale_purchase_amount(np.asarray(values, dtype=np.float64))
+            else:
+                X[:, self.column_index[name]] = [self.code_tables[name][value] for value in values]
+        return X
+
+    # Scaled matrix in SEGMENTATION_FEATURES order, ready for kmeans_model.predict
+    def segmentation_matrix(self, X):
+        return (X[:, self.segmentation_index] - self.segmentation_mean) / self.segmentation_scale
+
+    # Matrix in GB_FEATURES order with the numerical segment id filled in
+    def gb_matrix(self, X, cluster_ids):
+        X[:, self.segment_column] = cluster_ids
+        return X[:, self.gb_index]
@@ -0,0 +1,47 @@
+# gunicorn.conf.py
+#
+# Picked up automatically by `gunicorn app:app` (Procfile) from the working directory.
+#
+# preload_app: app.py is imported once, in the master: models are loaded (bundle arrays memory-mapped,
+# pickles unpickled), schema migrations and seed checks run, and every worker is then forked from that
+# finished state. Workers share the model memory copy-on-write and are ready as soon as they are forked,
+# instead of each repeating the whole startup. Set GUNICORN_PRELOAD=0 to go back to per-worker imports
+# (needed only if workers must pick up code changes on a HUP reload).
+#
+# Everything that holds threads, files or SQLite connections (db.Database, the micro-batcher, the group
+# commit writer, traffic capture, price tables) already re-creates them on first use in a new process,
+# and app.py closes the master's SQLite connection before the fork. gc.freeze() moves the preloaded objects
+# out of the collector's reach, so collections in the workers do not touch (and un-share) their pages.
+# Startup timings are logged for the master and for each worker.
+
+import gc
+import os
+import random
+import sys
+import time
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+_master_started = time.monotonic()
+
+
+def when_ready(server):
+    if preload_app:
+        gc.freeze()
+    app_module = sys.modules.get('app')
+    phases = getattr(app_module, 'startup_timings', {})
+    server.log.info("Master ready in %.0f ms (%s)", (time.monotonic() - _master_started) * 1000,
+                    ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in phases.items())
+                    or "app loads in the workers")
+
+
+def pre_fork(server, worker):
+    worker.fork_started = time.monotonic()
+
+
+def post_fork(server, worker):
+    random.seed() # otherwise every worker draws the same sequence (e.g. traffic capture sampling)
+
+
+def post_worker_init(worker):
+    worker.log.info("Worker %s ready in %.0f ms", worker.pid, (time.monotonic() - worker.fork_started) * 1000)
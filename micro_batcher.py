@@ -0,0 +1,109 @@
+# micro_batcher.py
+#
+# Dynamic micro-batching for model inference across concurrent requests.
+# Request handlers submit a payload and block on the returned Future. A background thread takes the first
+# waiting payload, keeps collecting for up to window_ms (or until max_batch_items rows are gathered), and
+# hands the whole group to process_batch in one call, so N concurrent single-row requests pay the fixed
+# per-call model cost once instead of N times.
+# The queue is bounded: when max_pending payloads are already waiting, submit raises BatcherOverloaded
+# immediately so the caller can shed load (503) instead of queueing behind a backlog it cannot clear.
+
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+
+class BatcherOverloaded(Exception):
+    pass
+
+
+class MicroBatcher:
+    # process_batch(payloads) must return one result per payload, in order
+    def __init__(self, process_batch, window_ms=2.0, max_batch_items=64, max_pending=1024, name='micro-batcher'):
+        self.process_batch = process_batch
+        self.window = window_ms / 1000.0
+        self.max_batch_items = int(max_batch_items)
+        self.max_pending = int(max_pending)
+        self.name = name
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.shed = 0
+        self.failed_batches = 0
+
+    # The batching thread does not survive fork(), so each process starts its own on first use
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    # Queues payload (counting as n_items rows toward max_batch_items) and returns a Future with its result
+    def submit(self, payload, n_items=1):
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((payload, n_items, future))
+        except queue.Full:
+            self.shed += 1
+            raise BatcherOverloaded(f"Inference queue is full ({self.max_pending} pending requests).")
+        return future
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        n_items = batch[0][1]
+        deadline = time.monotonic() + self.window
+        while n_items < self.max_batch_items:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(entry)
+            n_items += entry[1]
+        return batch, n_items
+
+    def _run(self):
+        while True:
+            batch, n_items = self._collect_batch()
+            futures = [future for _, _, future in batch]
+            try:
+                results = self.process_batch([payload for payload, _, _ in batch])
+            except Exception as e:
+                traceback.print_exc()
+                self.failed_batches += 1
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += n_items
+            self.largest_batch = max(self.largest_batch, n_items)
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "running": self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "window_ms": self.window * 1000.0,
+            "max_batch_items": self.max_batch_items,
+            "max_pending": self.max_pending,
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_items": (self.items / self.batches) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "shed": self.shed,
+            "failed_batches": self.failed_batches,
+        }
@@ -0,0 +1,150 @@
+# migrations.py
+#
+# Versioned schema migrations for users_data.db. The applied version lives in SQLite's
+# PRAGMA user_version; every migration with a higher number runs once, in order, inside the
+# caller's write transaction, so concurrent workers starting together apply each step exactly once.
+# To change the schema, append a new (version, description, function) entry; never edit an applied one.
+
+
+def _create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            city TEXT NOT NULL,
+            occupation TEXT NOT NULL,
+            loyalty_tier TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            product_category TEXT NOT NULL,
+            original_price REAL NOT NULL,
+            quantity INTEGER NOT NULL,
+            purchase_date TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+
+# Materialized SUM(purchases.quantity) per user, kept up to date by complete_purchase
+def _add_user_product_count(conn):
+    user_columns = [row[1] for row in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if 'product_count' not in user_columns:
+        conn.execute("ALTER TABLE users ADD COLUMN product_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE users SET product_count = COALESCE((SELECT SUM(quantity) FROM purchases WHERE user_id = users.id), 0)")
+
+
+# Serves my_orders' keyset pages (user_id = ? ORDER BY purchase_date DESC, purchase_id DESC) straight
+# from the index, and makes per-user aggregates over purchases an index range scan
+def _index_purchases_by_user_and_date(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases (user_id, purchase_date DESC, purchase_id DESC)")
+    conn.execute("ANALYZE purchases")
+
+
+# O(1) user id allocation: a one-row counter replaces SELECT MAX(CAST(SUBSTR(id, 6) AS INTEGER)) FROM users.
+# Seeded from the highest existing user_NNN id so new ids never collide with old ones.
+def _create_user_id_sequence(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, last_value INTEGER NOT NULL)")
+    conn.execute("""
+        INSERT OR IGNORE INTO id_sequences (name, last_value)
+        SELECT 'users', COALESCE(MAX(CAST(SUBSTR(id, 6) AS INTEGER)), 0) FROM users
+    """)
+
+
+# Per-user spending by category and by month, maintained by complete_purchase (see spending_summary.py)
+# and backfilled here from the existing purchases
+def _create_spending_summaries(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_category_totals (
+            user_id TEXT NOT NULL,
+            product_category TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (user_id, product_category)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_monthly_totals (
+            user_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("DELETE FROM user_category_totals")
+    conn.execute("DELETE FROM user_monthly_totals")
+    conn.execute("""
+        INSERT INTO user_category_totals (user_id, product_category, orders, quantity, amount)
+        SELECT user_id, product_category, COUNT(*), SUM(quantity), SUM(original_price * quantity)
+        FROM purchases GROUP BY user_id, product_category
+    """)
+    conn.execute("""
+        INSERT INTO user_monthly_totals (user_id, month, orders, quantity, amount)
+        SELECT user_id, SUBSTR(purchase_date, 1, 7), COUNT(*), SUM(quantity), SUM(original_price * quantity)
+        FROM purchases GROUP BY user_id, SUBSTR(purchase_date, 1, 7)
+    """)
+
+
+# Client-supplied idempotency keys of recorded orders: complete_purchase records the key in the same transaction
+# (or group-commit savepoint) as the order, so a retried request with the same key is answered without writing twice
+def _create_purchase_orders(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS purchase_orders (
+            user_id TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            items INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, idempotency_key)
+        ) WITHOUT ROWID
+    """)
+
+
+# The spending summaries' "orders" column counted purchase lines, not checkouts: renamed to say so
+def _rename_summary_orders_to_lines(conn):
+    conn.execute("ALTER TABLE user_category_totals RENAME COLUMN orders TO lines")
+    conn.execute("ALTER TABLE user_monthly_totals RENAME COLUMN orders TO lines")
+
+
+MIGRATIONS = [
+    (1, "create users and purchases tables", _create_base_tables),
+    (2, "add users.product_count", _add_user_product_count),
+    (3, "index purchases by (user_id, purchase_date, purchase_id)", _index_purchases_by_user_and_date),
+    (4, "add id_sequences for user ids", _create_user_id_sequence),
+    (5, "add per-user spending summaries by category and month", _create_spending_summaries),
+    (6, "add purchase_orders for idempotent checkouts", _create_purchase_orders),
+    (7, "rename spending summary orders to lines", _rename_summary_orders_to_lines),
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# True when conn's schema already has every migration applied
+def is_current(conn):
+    return schema_version(conn) >= MIGRATIONS[-1][0]
+
+
+# Applies every pending migration on conn (which must be inside a write transaction).
+# Returns the list of (version, description) that were applied.
+def migrate(conn):
+    applied = []
+    version = schema_version(conn)
+    for target_version, description, apply in MIGRATIONS:
+        if target_version <= version:
+            continue
+        apply(conn)
+        conn.execute(f"PRAGMA user_version = {int(target_version)}")
+        applied.append((target_version, description))
+    return applied
@@ -0,0 +1,294 @@
+# model_bundle.py
+#
+# Model sets and the versioned, memory-mappable bundle format.
+#
+# A ModelSet is everything one prediction needs (FeatureEncoder, segmentation + conversion engine,
+# segment_mapping) under one version string, so the app can swap models by replacing a single reference.
+# It is built either from the notebook pickles in trained_models/ or from a bundle:
+#
+#   trained_models/bundles/<version>/manifest.json   feature lists, label classes, segment mapping,
+#                                                     scalar parameters and a sha256 per array file
+#   trained_models/bundles/<version>/*.npy            GB tree arrays, KMeans centroids (+ counts once retrained), scaler params
+#   trained_models/bundles/CURRENT                    name of the version to serve
+#
+# Bundle arrays are opened with np.load(mmap_mode='r'): every gunicorn worker maps the same files,
+# so the OS page cache holds one copy instead of one unpickled copy per worker.
+#
+# Build a bundle from the pickles (verifies parity with sklearn first) and make it current:
+#   python model_bundle.py build [--version V] [--no-activate]
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+
+from feature_encoder import FeatureEncoder
+from fast_inference import (CentroidAssigner, FastInferenceEngine, FlatTreeEnsemble, check_parity, no_timer,
+                            sample_feature_rows)
+
+BUNDLE_FORMAT_VERSION = 1
+CURRENT_POINTER = 'CURRENT'
+
+
+class BundleError(Exception):
+    pass
+
+
+class SklearnEngine:
+    # The original sklearn calls, used when the flattened engine is disabled or fails its parity check
+    def __init__(self, feature_encoder, kmeans_model, gb_model):
+        self.feature_encoder = feature_encoder
+        self.kmeans_model = kmeans_model
+        self.gb_model = gb_model
+
+    def predict(self, X, timer=no_timer):
+        with timer('scaling'):
+            segmentation_X = self.feature_encoder.segmentation_matrix(X)
+        with timer('kmeans'):
+            cluster_ids = self.kmeans_model.predict(segmentation_X)
+        with timer('gb'):
+            conversion_probabilities = self.gb_model.predict_proba(self.feature_encoder.gb_matrix(X, cluster_ids))[:, 1]
+        return cluster_ids, conversion_probabilities
+
+    def segment(self, X):
+        return self.kmeans_model.predict(self.feature_encoder.segmentation_matrix(X))
+
+    def split_points(self, column):
+        trees = [est.tree_ for est in self.gb_model.estimators_[:, 0]]
+        return np.unique(np.concatenate([t.threshold[(t.children_left != -1) & (t.feature == column)] for t in trees]))
+
+
+class ModelSet:
+    def __init__(self, version, feature_encoder, engine, segment_mapping, source, metadata=None):
+        self.version = version
+        self.feature_encoder = feature_encoder
+        self.engine = engine
+        self.segment_mapping = {int(k): v for k, v in segment_mapping.items()}
+        self.source = source # where it was loaded from, for logs and /admin responses
+        self.metadata = dict(metadata or {}) # lineage saved with the bundle, e.g. the retraining watermark
+
+    # (cluster_ids, conversion_probabilities) for an (N, n_columns) matrix from feature_encoder;
+    # timer(stage) optionally times the scaling / kmeans / gb stages
+    def predict(self, X, timer=no_timer):
+        return self.engine.predict(X, timer)
+
+    # Segment ids alone for an (N, n_columns) matrix, without the GB pass
+    def segment(self, X):
+        return self.engine.segment(X)
+
+    # Distinct thresholds the GB model splits feature (a GB_FEATURES name) on, in the model's input units
+    # (Purchase_Amount_Scaled is scaled)
+    def split_points(self, feature):
+        return self.engine.split_points(self.feature_encoder.gb_features.index(feature))
+
+    def segment_label(self, cluster_id):
+        return self.segment_mapping.get(int(cluster_id), "Unknown Segment")
+
+    def describe(self):
+        return {"version": self.version, "source": self.source, "engine": type(self.engine).__name__,
+                "metadata": self.metadata}
+
+    @classmethod
+    def from_pickles(cls, model_dir, segmentation_features, gb_features, categorical_cols, fast_inference=True,
+                     verbose=True):
+        def load(name):
+            with open(os.path.join(model_dir, f'{name}.pkl'), 'rb') as f:
+                obj = pickle.load(f)
+            if verbose:
+                print(f"✓ {name} loaded.")
+            return obj
+
+        label_encoders = load('label_encoders')
+        scaler_purchase_amount = load('scaler_purchase_amount')
+        scaler_segmentation_features = load('scaler_segmentation_features')
+        kmeans_model = load('kmeans_model')
+        segment_mapping = load('segment_mapping')
+        gb_model = load('gb_model')
+
+        feature_encoder = FeatureEncoder.from_sklearn(label_encoders, scaler_purchase_amount, scaler_segmentation_features,
+                                                      segmentation_features, gb_features, categorical_cols)
+        if verbose:
+            print("✓ feature_encoder compiled.")
+
+        engine = SklearnEngine(feature_encoder, kmeans_model, gb_model)
+        if fast_inference:
+            try:
+                fast_engine = FastInferenceEngine.from_sklearn(feature_encoder, kmeans_model, gb_model)
+                parity_ok, segment_mismatches, max_prob_diff = check_parity(
+                    fast_engine, kmeans_model, gb_model, sample_feature_rows(feature_encoder))
+                if parity_ok:
+                    engine = fast_engine
+                    if verbose:
+                        print(f"✓ fast inference engine compiled ({fast_engine.ensemble.n_trees} trees, parity verified).")
+                else:
+                    print(f"WARNING: fast inference engine disagrees with sklearn ({segment_mismatches} segment mismatches, "
+                          f"max probability diff {max_prob_diff:.3g}). Falling back to sklearn models.")
+            except Exception as e:
+                print(f"WARNING: could not build fast inference engine: {e}. Falling back to sklearn models.")
+
+        return cls(f"pickles@{_pickles_fingerprint(model_dir)}", feature_encoder, engine, segment_mapping,
+                   source=os.path.abspath(model_dir))
+
+
+def _pickles_fingerprint(model_dir):
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(model_dir)):
+        if name.endswith('.pkl'):
+            digest.update(name.encode())
+            with open(os.path.join(model_dir, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# --- Writing bundles ---
+# Writes model_set (which must use the flattened engine) as bundles_dir/<version>. The directory is
+# assembled under a temporary name and renamed into place, so readers never see a partial bundle.
+def write_bundle(model_set, bundles_dir, version=None, activate=True):
+    if not isinstance(model_set.engine, FastInferenceEngine):
+        raise BundleError("Only model sets running the flattened engine can be bundled "
+                          "(the fast engine failed its parity check or was disabled).")
+    encoder = model_set.feature_encoder
+    ensemble = model_set.engine.ensemble
+    version = version or datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    target = os.path.join(bundles_dir, version)
+    if os.path.exists(target):
+        raise BundleError(f"Bundle version '{version}' already exists in {bundles_dir}.")
+
+    arrays = {
+        'gb_feature': ensemble.feature, 'gb_threshold': ensemble.threshold, 'gb_left': ensemble.left,
+        'gb_right': ensemble.right, 'gb_children': ensemble.children, 'gb_value': ensemble.value,
+        'gb_roots': ensemble.roots, 'kmeans_centers': model_set.engine.segmenter.centers,
+        'segmentation_mean': encoder.segmentation_mean, 'segmentation_scale': encoder.segmentation_scale,
+    }
+    if model_set.engine.segmenter.counts is not None:
+        arrays['kmeans_counts'] = model_set.engine.segmenter.counts
+
+    os.makedirs(bundles_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f'.{version}.', dir=bundles_dir)
+    try:
+        os.chmod(staging, 0o755)
+        files = {}
+        for name, array in arrays.items():
+            filename = f'{name}.npy'
+            np.save(os.path.join(staging, filename), np.ascontiguousarray(array))
+            files[name] = {"file": filename, "sha256": _sha256_file(os.path.join(staging, filename))}
+
+        manifest = {
+            "format_version": BUNDLE_FORMAT_VERSION,
+            "version": version,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "built_from": model_set.source,
+            "segmentation_features": encoder.segmentation_features,
+            "gb_features": encoder.gb_features,
+            "categorical_cols": encoder.categorical_cols,
+            "classes": encoder.classes,
+            "purchase_amount_mean": encoder.purchase_amount_mean,
+            "purchase_amount_scale": encoder.purchase_amount_scale,
+            "segment_mapping": {str(k): v for k, v in model_set.segment_mapping.items()},
+            "gb": {"max_depth": ensemble.max_depth, "learning_rate": ensemble.learning_rate, "init_raw": ensemble.init_raw},
+            "arrays": files,
+            "metadata": model_set.metadata,
+        }
+        with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(staging, target)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    if activate:
+        set_current_version(bundles_dir, version)
+    return target
+
+
+# Atomically points CURRENT at version (write to a temp file, then os.replace)
+def set_current_version(bundles_dir, version):
+    if not os.path.isfile(os.path.join(bundles_dir, version, 'manifest.json')):
+        raise BundleError(f"No bundle named '{version}' in {bundles_dir}.")
+    fd, tmp_path = tempfile.mkstemp(prefix='.CURRENT.', dir=bundles_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, os.path.join(bundles_dir, CURRENT_POINTER))
+
+
+def current_version(bundles_dir):
+    try:
+        with open(os.path.join(bundles_dir, CURRENT_POINTER)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+# --- Reading bundles ---
+def load_bundle(bundle_path, verify_checksums=True):
+    with open(os.path.join(bundle_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise BundleError(f"Unsupported bundle format {manifest.get('format_version')} in {bundle_path}.")
+
+    arrays = {}
+    for name, entry in manifest["arrays"].items():
+        path = os.path.join(bundle_path, entry["file"])
+        if verify_checksums and _sha256_file(path) != entry["sha256"]:
+            raise BundleError(f"Checksum mismatch for {path}; the bundle is corrupt or was modified.")
+        arrays[name] = np.load(path, mmap_mode='r')
+
+    encoder = FeatureEncoder(manifest["classes"], manifest["purchase_amount_mean"], manifest["purchase_amount_scale"],
+                             arrays['segmentation_mean'], arrays['segmentation_scale'],
+                             manifest["segmentation_features"], manifest["gb_features"], manifest["categorical_cols"])
+    gb = manifest["gb"]
+    ensemble = FlatTreeEnsemble(arrays['gb_feature'], arrays['gb_threshold'], arrays['gb_left'], arrays['gb_right'],
+                                arrays['gb_value'], arrays['gb_roots'], gb["max_depth"], gb["learning_rate"],
+                                gb["init_raw"], children=arrays['gb_children'])
+    engine = FastInferenceEngine(encoder, CentroidAssigner(arrays['kmeans_centers'], arrays.get('kmeans_counts')), ensemble)
+    return ModelSet(manifest["version"], encoder, engine, manifest["segment_mapping"], source=os.path.abspath(bundle_path),
+                    metadata=manifest.get("metadata"))
+
+
+# Loads the bundle CURRENT points at, or returns None if there is no CURRENT pointer
+def load_current_bundle(bundles_dir, verify_checksums=True):
+    version = current_version(bundles_dir)
+    if version is None:
+        return None
+    return load_bundle(os.path.join(bundles_dir, version), verify_checksums=verify_checksums)
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    from model_schema import BUNDLES_DIR, CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES
+
+    parser = argparse.ArgumentParser(description="Build a memory-mappable model bundle from the trained pickles.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help="bundle trained_models/*.pkl")
+    build.add_argument('--model-dir', default=MODEL_DIR)
+    build.add_argument('--bundles-dir', default=BUNDLES_DIR)
+    build.add_argument('--version')
+    build.add_argument('--no-activate', action='store_true', help="do not point CURRENT at the new bundle")
+    activate = sub.add_parser('activate', help="point CURRENT at an existing bundle")
+    activate.add_argument('version')
+    activate.add_argument('--bundles-dir', default=BUNDLES_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        model_set = ModelSet.from_pickles(args.model_dir, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS)
+        path = write_bundle(model_set, args.bundles_dir, version=args.version, activate=not args.no_activate)
+        print(f"Bundle written to {path}" + ("" if args.no_activate else " and made current."))
+    else:
+        set_current_version(args.bundles_dir, args.version)
+        print(f"CURRENT -> {args.version}")
@@ -0,0 +1,68 @@
+# model_schema.py
+#
+# Feature layout shared by the web app and the offline tools (bundle builder, batch scorer, retraining).
+# Kept free of Flask/DB imports so command-line tools can use it without starting the app.
+
+import math
+
+MODEL_DIR = 'trained_models'
+# Versioned model bundles (see model_bundle.py) live here; CURRENT names the one to serve
+BUNDLES_DIR = 'trained_models/bundles'
+
+# Corrected feature names to match the Colab notebook exactly for model input
+SEGMENTATION_FEATURES = [
+    'Age', 'Gender', 'City', 'Occupation', 'Product_Category',
+    'Weather', 'Time_of_Day', 'Loyalty_Tier', 'Age_Group',
+    'User_Product_Count', 'Purchase_Amount_Scaled'
+]
+GB_FEATURES = [
+    'Age', 'Gender', 'City', 'Occupation', 'Product_Category',
+    'Weather', 'Time_of_Day', 'Loyalty_Tier',
+    'User_Product_Count', 'Age_Group',
+    'Purchase_Amount_Scaled', 'CustomerSegment' # CustomerSegment is the numerical ID
+]
+# Categorical features that need Label Encoding
+CATEGORICAL_COLS = [
+    'Gender', 'City', 'Occupation', 'Product_Category',
+    'Weather', 'Time_of_Day', 'Loyalty_Tier'
+]
+
+# --- Numeric input validation ---
+# How /predict_price (app.build_customer_input) and batch_score.py parse and range-check the numeric fields
+# of a customer, so a value one of them rejects is never silently coerced by the other.
+NUMERIC_FIELDS = {'Age': int, 'Purchase_Amount': float, 'User_Product_Count': int}
+
+
+# Parsed value of a numeric field. Raises ValueError or TypeError for anything int()/float() refuse,
+# and for fractional numbers in the whole-number fields ("34.7" and 34.7 are both invalid Ages).
+def parse_numeric_field(field, value):
+    parse = NUMERIC_FIELDS[field]
+    if parse is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"'{field}' must be a whole number, got {value!r}")
+    return parse(value)
+
+
+# Range check for one parsed numeric field: the error message, or None
+def numeric_field_error(field, value):
+    if field == 'Age' and not 0 < value < 120:
+        return "Age must be a realistic number (1-119)."
+    if field == 'Purchase_Amount' and not (value > 0 and math.isfinite(value)):
+        return "Original purchase amount must be positive."
+    if field == 'User_Product_Count' and value < 0:
+        return "User product count cannot be negative."
+    return None
+
+
+# Parses the numeric fields of a customer dict in place, then range-checks them.
+# Returns the first error message, or None.
+def validate_numeric_fields(customer):
+    try:
+        for field in NUMERIC_FIELDS:
+            customer[field] = parse_numeric_field(field, customer[field])
+    except (TypeError, ValueError) as e:
+        return f"Invalid numeric value: {e}"
+    for field in NUMERIC_FIELDS:
+        error = numeric_field_error(field, customer[field])
+        if error is not None:
+            return error
+    return None
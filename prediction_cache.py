@@ -0,0 +1,84 @@
+# prediction_cache.py
+#
+# Bounded in-process LRU cache with a TTL for model outputs.
+# Keys are built from the fully encoded feature row (label codes, Age, Age_Group, User_Product_Count,
+# scaled amount) plus the raw Purchase_Amount, so any change in the inputs, including a new purchase
+# bumping User_Product_Count, is a different key and simply misses.
+# Values are the model outputs (cluster id, conversion probability); pricing rules are applied after lookup.
+# Keys also carry the model version, so entries from a replaced model set simply stop matching.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    def __init__(self, max_size=10000, ttl_seconds=300.0, clock=time.monotonic):
+        self.max_size = int(max_size)
+        self.ttl_seconds = float(ttl_seconds)
+        self._clock = clock
+        self._entries = OrderedDict() # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0 # dropped because the cache was full
+        self.expirations = 0 # dropped because the TTL ran out
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    # The model version is part of the key, so a hot model reload never serves the old models' outputs
+    @staticmethod
+    def make_key(model_version, encoded_row, purchase_amount):
+        return model_version, encoded_row.tobytes(), float(purchase_amount)
+
+    # Returns the cached value or None
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        expires_at = self._clock() + self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
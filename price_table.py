@@ -0,0 +1,509 @@
+# price_table.py
+#
+# Precomputed model outputs over a bucketed input domain, served from memory instead of running the models.
+#
+# Most /predict_price inputs come from small finite domains: the seven CATEGORICAL_COLS take a handful of
+# values each, and raw Age, User_Product_Count and Purchase_Amount are bucketed here. PriceTable evaluates
+# the model set once for every cell of that grid (at a representative Age, count and amount per bucket) and
+# keeps (segment id, conversion probability) per cell in two flat arrays. A request inside the domain becomes
+# an index computation plus an array read; requests outside it (ages, counts or amounts beyond the grid) fall
+# back to the models. Pricing rules are still applied to the request's real amount.
+#
+# Bucket edges for each numeric input are configurable (PRICE_TABLE_AGE_EDGES, PRICE_TABLE_COUNT_EDGES,
+# PRICE_TABLE_AMOUNT_EDGES or the CLI flags below; see parse_edges). The default, "splits", puts an edge at
+# every threshold the GB model splits that input on, so no tree changes branch inside a bucket and a cell's
+# probability is exactly the model's for every input in it, given the segment. The segment is not piecewise
+# constant (KMeans distances are linear in Age and Purchase_Amount), so every lookup recomputes it from the
+# centroids (5 distances, no GB pass) and a row whose segment differs from its cell's falls back to the
+# models. Served rows therefore match the full pipeline; with the shipped models about 98.7% of in-domain
+# rows are served.
+#
+# Every build still measures the table on random in-domain inputs against the full pipeline (segment
+# agreement, probability error, relative price error under the current pricing rules; served rows only)
+# and PriceTableManager only serves a table that passes all three gates: segment agreement of at least
+# min_segment_agreement, p99 absolute probability error within max_probability_error and p99 relative price
+# error within max_price_error. Coarser explicit edges (fewer cells) trade accuracy for size and may not pass.
+#
+# Default grid for the shipped models: 14,400 label combinations x 28 age buckets (18-80) x 1 count bucket
+# (0-999; the models never split on it) x 162 amount buckets (5-1000) = 65M cells, ~327 MB. Tables are saved
+# under PRICE_TABLE_DIR/<model version>/ and memory-mapped, so workers and restarts share one build.
+#
+#   python price_table.py build [--age-edges splits] [--amount-edges geometric:48:5:1000]
+#   python price_table.py report                          # error report of the saved table
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+
+from feature_encoder import AGE_GROUP_BOUNDS
+
+TABLE_FORMAT_VERSION = 2
+# Numeric inputs bucketed by the table: GB feature each one is split on, the range "splits" edges cover
+# (requests outside it fall back) and whether inputs are whole numbers
+EDGE_INPUTS = {
+    'Age': ('Age', (18, 81), True),
+    'User_Product_Count': ('User_Product_Count', (0, 1000), True),
+    'Purchase_Amount': ('Purchase_Amount_Scaled', (5.0, 1000.0), False),
+}
+DEFAULT_EDGES = 'splits'
+BUILD_CHUNK_ROWS = 262144
+ERROR_SAMPLE_ROWS = 20000
+
+
+# Parses a bucket edge spec for one of EDGE_INPUTS:
+#   splits                 an edge at every GB split point inside the input's default range
+#   splits:LOW:HIGH        the same inside [LOW, HIGH)
+#   geometric:N:LOW:HIGH   N log-spaced buckets (Purchase_Amount only)
+#   E0,E1,...,En           explicit edges: buckets [E0, E1), ..., [En-1, En)
+# Returns ('splits', (low, high)), ('geometric', n, low, high) or ('edges', edges); raises ValueError.
+def parse_edges(spec, name):
+    _, default_range, integer = EDGE_INPUTS[name]
+    if not isinstance(spec, str):
+        kind, values = 'edges', [float(v) for v in spec]
+    else:
+        kind, _, rest = spec.strip().partition(':')
+        if kind not in ('splits', 'geometric'):
+            kind, rest = 'edges', spec
+        try:
+            values = [float(v) for v in rest.replace(',', ':').split(':')] if rest else []
+        except ValueError:
+            raise ValueError(f"Invalid {name} bucket edges '{spec}'.")
+    if kind == 'geometric':
+        if integer or len(values) != 3 or values[0] != int(values[0]) or values[0] < 1 or not 0 < values[1] < values[2]:
+            raise ValueError(f"{name} edges 'geometric:N:LOW:HIGH' need N >= 1 and 0 < LOW < HIGH "
+                             "(Purchase_Amount only).")
+        return ('geometric', int(values[0]), values[1], values[2])
+    if kind == 'splits':
+        if values and len(values) != 2:
+            raise ValueError(f"{name} edges 'splits:LOW:HIGH' need exactly two bounds.")
+        values = values or list(default_range)
+    if len(values) < 2 or any(b <= a for a, b in zip(values, values[1:])):
+        raise ValueError(f"{name} bucket edges must be at least two increasing numbers.")
+    if integer and any(v != int(v) for v in values):
+        raise ValueError(f"{name} bucket edges must be whole numbers.")
+    if name == 'Purchase_Amount' and values[0] <= 0:
+        raise ValueError("Purchase_Amount bucket edges must be positive.")
+    return ('splits', (values[0], values[1])) if kind == 'splits' else ('edges', tuple(values))
+
+
+# Bucket edges (raw input units) for name under spec, for model_set
+def resolve_edges(model_set, name, spec):
+    parsed = parse_edges(spec, name)
+    if parsed[0] == 'edges':
+        return np.array(parsed[1])
+    if parsed[0] == 'geometric':
+        return np.geomspace(parsed[2], parsed[3], parsed[1] + 1)
+    feature, _, integer = EDGE_INPUTS[name]
+    low, high = parsed[1]
+    points = model_set.split_points(feature)
+    if name == 'Purchase_Amount':
+        encoder = model_set.feature_encoder
+        points = points * encoder.purchase_amount_scale + encoder.purchase_amount_mean
+    elif integer:
+        points = np.floor(points) + 1 # x <= t goes left: whole numbers from floor(t) + 1 go right
+    return np.unique(np.concatenate([[low], points[(points > low) & (points < high)], [high]]))
+
+
+class PriceTable:
+    def __init__(self, model_version, categorical_cols, shape, age_edges, count_edges, amount_edges,
+                 segments, probabilities, report=None, built_at=None):
+        self.model_version = model_version
+        self.categorical_cols = list(categorical_cols)
+        self.shape = tuple(int(n) for n in shape) # label counts..., age buckets, count buckets, amount buckets
+        self.age_edges = np.asarray(age_edges, dtype=np.float64)
+        self.count_edges = np.asarray(count_edges, dtype=np.float64)
+        self.amount_edges = np.asarray(amount_edges, dtype=np.float64)
+        self.segments = segments # (n_cells,) uint8
+        self.probabilities = probabilities # (n_cells,) float32
+        self.report = report or {}
+        self.built_at = built_at
+        self.strides = np.array([int(np.prod(self.shape[i + 1:])) for i in range(len(self.shape))], dtype=np.int64)
+        self._strides_list = self.strides.tolist()
+        self._age_edges_list = self.age_edges.tolist()
+        self._count_edges_list = self.count_edges.tolist()
+        self._layouts = {}
+
+    @property
+    def n_cells(self):
+        return int(np.prod(self.shape))
+
+    # Representative inputs of each bucket, the point every cell is evaluated at: the middle whole number of
+    # each age and count bucket, the geometric middle of each amount bucket
+    def representative_inputs(self):
+        ages = np.floor((self.age_edges[:-1] + self.age_edges[1:] - 1) / 2.0)
+        counts = np.floor((self.count_edges[:-1] + self.count_edges[1:] - 1) / 2.0)
+        amounts = np.sqrt(self.amount_edges[:-1] * self.amount_edges[1:])
+        return ages, counts, amounts
+
+    # Evaluates model_set on every cell, BUILD_CHUNK_ROWS cells at a time. Each *_edges is a spec for
+    # parse_edges or a sequence of edges; age buckets are also split at AGE_GROUP_BOUNDS so Age_Group is
+    # constant in every cell.
+    @classmethod
+    def build(cls, model_set, age_edges=DEFAULT_EDGES, count_edges=DEFAULT_EDGES, amount_edges=DEFAULT_EDGES):
+        encoder = model_set.feature_encoder
+        age_edges = resolve_edges(model_set, 'Age', age_edges)
+        age_edges = np.union1d(age_edges, [b for b in AGE_GROUP_BOUNDS if age_edges[0] < b < age_edges[-1]])
+        count_edges = resolve_edges(model_set, 'User_Product_Count', count_edges)
+        amount_edges = resolve_edges(model_set, 'Purchase_Amount', amount_edges)
+        shape = ([len(encoder.classes[col]) for col in encoder.categorical_cols]
+                 + [len(age_edges) - 1, len(count_edges) - 1, len(amount_edges) - 1])
+        n_cells = int(np.prod(shape))
+        table = cls(model_set.version, encoder.categorical_cols, shape, age_edges, count_edges, amount_edges,
+                    np.empty(n_cells, dtype=np.uint8), np.empty(n_cells, dtype=np.float32))
+        ages, counts, amounts = table.representative_inputs()
+        n_categorical = len(encoder.categorical_cols)
+        for start in range(0, n_cells, BUILD_CHUNK_ROWS):
+            cells = np.arange(start, min(start + BUILD_CHUNK_ROWS, n_cells), dtype=np.int64)
+            index = np.unravel_index(cells, table.shape)
+            codes = dict(zip(encoder.categorical_cols, index[:n_categorical]))
+            X = encoder.encode_columns(codes, ages[index[n_categorical]], counts[index[n_categorical + 1]],
+                                       amounts[index[n_categorical + 2]])
+            cluster_ids, conversion_probabilities = model_set.predict(X)
+            table.segments[cells] = cluster_ids
+            table.probabilities[cells] = conversion_probabilities
+        table.built_at = datetime.now(timezone.utc).isoformat()
+        return table
+
+    # Column positions and amount edges (in scaled units) for reading cells straight off encoder's rows
+    def _layout(self, encoder):
+        layout = self._layouts.get(id(encoder))
+        if layout is None:
+            column = encoder.column_index
+            key_columns = [column[col] for col in self.categorical_cols]
+            layout = {
+                "key_columns": np.array(key_columns, dtype=np.intp), "key_columns_list": key_columns,
+                "age": column['Age'], "count": column['User_Product_Count'], "amount": column['Purchase_Amount_Scaled'],
+                "amount_edges": encoder.scale_purchase_amount(self.amount_edges),
+            }
+            layout["amount_edges_list"] = layout["amount_edges"].tolist()
+            self._layouts = {id(encoder): layout} # one encoder per model version
+        return layout
+
+    # Flat cell index for each row of an encoded matrix X (FeatureEncoder layout) and a mask of the rows
+    # inside the table's domain; index entries of rows outside it are meaningless
+    def cell_index(self, encoder, X):
+        layout = self._layout(encoder)
+        age_bucket = np.searchsorted(self.age_edges, X[:, layout["age"]], side='right') - 1
+        count_bucket = np.searchsorted(self.count_edges, X[:, layout["count"]], side='right') - 1
+        amount_bucket = np.searchsorted(layout["amount_edges"], X[:, layout["amount"]], side='right') - 1
+        in_domain = ((age_bucket >= 0) & (age_bucket < self.shape[-3]) & (count_bucket >= 0)
+                     & (count_bucket < self.shape[-2]) & (amount_bucket >= 0) & (amount_bucket < self.shape[-1]))
+        index = (X[:, layout["key_columns"]] @ self.strides[:-3].astype(np.float64)).astype(np.int64)
+        index += age_bucket * self.strides[-3] + count_bucket * self.strides[-2] + amount_bucket
+        return index, in_domain
+
+    # (served mask, cluster ids, conversion probabilities) for the rows of X; outputs only valid where the mask
+    # is True. A row is served when it is inside the domain and model_set's centroids put it in the same segment
+    # as its cell.
+    def lookup(self, model_set, X):
+        if len(X) == 1:
+            return self._lookup_one(model_set, X)
+        index, served = self.cell_index(model_set.feature_encoder, X)
+        index[~served] = 0
+        cluster_ids = self.segments[index].astype(np.int64)
+        served &= cluster_ids == model_set.segment(X)
+        return served, cluster_ids, self.probabilities[index].astype(np.float64)
+
+    # lookup() for a single row in plain Python: a /predict_price request is one row, and the dozen small
+    # NumPy calls of the vectorized path would cost more than the models themselves
+    def _lookup_one(self, model_set, X):
+        layout = self._layout(model_set.feature_encoder)
+        values = X[0].tolist()
+        age_bucket = bisect_right(self._age_edges_list, values[layout["age"]]) - 1
+        count_bucket = bisect_right(self._count_edges_list, values[layout["count"]]) - 1
+        amount_bucket = bisect_right(layout["amount_edges_list"], values[layout["amount"]]) - 1
+        if (0 <= age_bucket < self.shape[-3] and 0 <= count_bucket < self.shape[-2]
+                and 0 <= amount_bucket < self.shape[-1]):
+            index = age_bucket * self._strides_list[-3] + count_bucket * self._strides_list[-2] + amount_bucket
+            for column, stride in zip(layout["key_columns_list"], self._strides_list):
+                index += int(values[column]) * stride
+            cluster_id = int(self.segments[index])
+            if cluster_id == model_set.segment(X)[0]:
+                return (np.ones(1, dtype=bool), np.array([cluster_id], dtype=np.int64),
+                        np.array([self.probabilities[index]], dtype=np.float64))
+        return np.zeros(1, dtype=bool), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.float64)
+
+    # Compares table lookups with the full pipeline on n_rows random in-domain inputs (uniform labels, ages
+    # and counts, log-uniform amounts) and stores the result in self.report. Errors are over the rows the
+    # table serves; served_share is their fraction (the rest fall back to the models).
+    def measure_error(self, model_set, pricing_rules, n_rows=ERROR_SAMPLE_ROWS, seed=0):
+        encoder = model_set.feature_encoder
+        rng = np.random.default_rng(seed)
+        codes = {col: rng.integers(0, len(encoder.classes[col]), n_rows) for col in encoder.categorical_cols}
+        age = rng.integers(int(self.age_edges[0]), int(self.age_edges[-1]), n_rows)
+        count = rng.integers(int(self.count_edges[0]), int(self.count_edges[-1]), n_rows)
+        amount = np.exp(rng.uniform(np.log(self.amount_edges[0]), np.log(self.amount_edges[-1]), n_rows))
+        X = encoder.encode_columns(codes, age, count, amount)
+        served, table_ids, table_probs = self.lookup(model_set, X)
+        model_ids, model_probs = model_set.predict(X)
+        self.report = {"sample_rows": n_rows, "pricing_rules_version": pricing_rules.version,
+                       "served_share": float(served.mean())}
+        if not served.any():
+            return self.report
+        amount, table_ids, table_probs = amount[served], table_ids[served], table_probs[served]
+        model_ids, model_probs = model_ids[served], model_probs[served]
+        model_prices = pricing_rules.apply(amount, model_probs, model_ids, model_set.segment_mapping)
+        table_prices = pricing_rules.apply(amount, table_probs, table_ids, model_set.segment_mapping)
+        prob_error = np.abs(table_probs - model_probs)
+        price_error = np.abs(table_prices - model_prices) / model_prices
+        self.report.update({
+            "segment_agreement": float(np.mean(table_ids == model_ids)),
+            "probability_abs_error": {"mean": float(prob_error.mean()), "p99": float(np.quantile(prob_error, 0.99)),
+                                      "max": float(prob_error.max())},
+            "price_rel_error": {"mean": float(price_error.mean()), "p99": float(np.quantile(price_error, 0.99)),
+                                "max": float(price_error.max())},
+            "price_exact_share": float(np.mean(table_prices == model_prices)),
+        })
+        return self.report
+
+    def describe(self):
+        return {
+            "model_version": self.model_version,
+            "built_at": self.built_at,
+            "cells": self.n_cells,
+            "bytes": int(self.segments.nbytes + self.probabilities.nbytes),
+            "shape": dict(zip(self.categorical_cols + ['Age', 'User_Product_Count', 'Purchase_Amount'], self.shape)),
+            "age_edges": self.age_edges.tolist(),
+            "count_edges": self.count_edges.tolist(),
+            "amount_range": [float(self.amount_edges[0]), float(self.amount_edges[-1])],
+            "error": self.report,
+        }
+
+    # Writes the table as directory/<model version>/ (two .npy files and table.json), assembled under a
+    # temporary name and renamed into place like model bundles; an existing table for the version is replaced
+    def save(self, directory):
+        target = os.path.join(directory, self.model_version)
+        os.makedirs(directory, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f'.{self.model_version}.', dir=directory)
+        try:
+            os.chmod(staging, 0o755)
+            np.save(os.path.join(staging, 'segments.npy'), self.segments)
+            np.save(os.path.join(staging, 'probabilities.npy'), self.probabilities)
+            meta = {
+                "format_version": TABLE_FORMAT_VERSION, "model_version": self.model_version,
+                "categorical_cols": self.categorical_cols, "shape": list(self.shape), "age_edges": self.age_edges.tolist(),
+                "count_edges": self.count_edges.tolist(), "amount_edges": self.amount_edges.tolist(),
+                "report": self.report, "built_at": self.built_at,
+            }
+            with open(os.path.join(staging, 'table.json'), 'w') as f:
+                json.dump(meta, f, indent=2)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            os.rename(staging, target)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return target
+
+    # Memory-maps the table saved for model_version, or returns None when there is none (or it is unreadable)
+    @classmethod
+    def load(cls, directory, model_version):
+        path = os.path.join(directory, model_version)
+        try:
+            with open(os.path.join(path, 'table.json')) as f:
+                meta = json.load(f)
+            if meta.get("format_version") != TABLE_FORMAT_VERSION:
+                return None
+            segments = np.load(os.path.join(path, 'segments.npy'), mmap_mode='r')
+            probabilities = np.load(os.path.join(path, 'probabilities.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if len(segments) != int(np.prod(meta["shape"])) or len(probabilities) != len(segments):
+            return None
+        return cls(meta["model_version"], meta["categorical_cols"], meta["shape"], meta["age_edges"],
+                   meta["count_edges"], meta["amount_edges"], segments, probabilities, meta.get("report"),
+                   meta.get("built_at"))
+
+
+# Exclusive flock held while a table for model_version is built and saved. Waits (blocking only the calling
+# thread) when another process holds it.
+@contextmanager
+def build_lock(directory, model_version):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'.{model_version}.lock'), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for the price table for '{model_version}' that another process is building.")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Keeps a PriceTable for the serving model version (built over grid: age_edges / count_edges / amount_edges
+# keyword arguments for PriceTable.build): the first get() for a new version (in each process)
+# memory-maps the saved table or starts building one on a background thread, and returns None until it is
+# ready, so requests keep using the models meanwhile. A table that fails any of the accuracy gates is kept for
+# inspection (stats() says which gates failed) but never served.
+# Builds are coordinated through an flock on directory/.<model version>.lock: across all worker processes
+# sharing the directory only one builds a version; the others wait on the lock in their background thread
+# (no CPU spent) and then map the table it saved. `python price_table.py build` takes the same lock, so a
+# table can also be built ahead of a deploy.
+class PriceTableManager:
+    def __init__(self, directory, max_price_error=0.10, pricing_rules_source=None, min_segment_agreement=0.99,
+                 max_probability_error=0.02, grid=None):
+        self.directory = directory
+        self.grid = dict(grid or {})
+        for name, key in [('Age', 'age_edges'), ('User_Product_Count', 'count_edges'), ('Purchase_Amount', 'amount_edges')]:
+            if key in self.grid:
+                parse_edges(self.grid[key], name) # a bad spec fails at startup, not in the background build
+        self.max_price_error = float(max_price_error)
+        self.min_segment_agreement = float(min_segment_agreement)
+        self.max_probability_error = float(max_probability_error)
+        self.pricing_rules_source = pricing_rules_source # callable returning the current PricingRules
+        self._lock = threading.Lock()
+        self._table = None
+        self._building = None # model version being built
+        self._pid = None
+        self.last_error = None
+
+    # Names of the accuracy gates table fails (a missing measurement fails its gate)
+    def failed_gates(self, table):
+        report = table.report
+        agreement = report.get("segment_agreement")
+        probability_p99 = report.get("probability_abs_error", {}).get("p99")
+        price_p99 = report.get("price_rel_error", {}).get("p99")
+        failed = []
+        if agreement is None or agreement < self.min_segment_agreement:
+            failed.append("segment_agreement")
+        if probability_p99 is None or probability_p99 > self.max_probability_error:
+            failed.append("probability_abs_error")
+        if price_p99 is None or price_p99 > self.max_price_error:
+            failed.append("price_rel_error")
+        return failed
+
+    def _usable(self, table):
+        return not self.failed_gates(table)
+
+    def get(self, model_set):
+        table = self._table
+        if table is not None and table.model_version == model_set.version and self._pid == os.getpid():
+            return table if self._usable(table) else None
+        with self._lock:
+            if self._pid != os.getpid(): # a build thread started before fork() did not come along
+                self._pid = os.getpid()
+                self._table = None
+                self._building = None
+            if self._building == model_set.version:
+                return None
+            table = PriceTable.load(self.directory, model_set.version)
+            if table is not None:
+                self._table = table
+                print(f"Price table for '{model_set.version}' mapped from {self.directory}.")
+                return table if self._usable(table) else None
+            self._start_build(model_set)
+        return None
+
+    def _start_build(self, model_set, force=False):
+        self._building = model_set.version
+        threading.Thread(target=self._build, args=(model_set, force), name='price-table-build', daemon=True).start()
+
+    # force: build even if another process has saved a table for this version in the meantime (rebuild())
+    def _build(self, model_set, force=False):
+        try:
+            with build_lock(self.directory, model_set.version):
+                table = None if force else PriceTable.load(self.directory, model_set.version)
+                if table is not None:
+                    self._table = table
+                    self.last_error = None
+                    print(f"Price table for '{model_set.version}' mapped from {self.directory} "
+                          "(built by another process).")
+                    return
+                started = time.perf_counter()
+                table = PriceTable.build(model_set, **self.grid)
+                table.measure_error(model_set, self.pricing_rules_source())
+                table.save(self.directory)
+            self._table = table
+            self.last_error = None
+            failed = self.failed_gates(table)
+            print(f"Price table for '{model_set.version}' built in {time.perf_counter() - started:.1f}s "
+                  f"({table.n_cells} cells, {table.report['served_share']:.1%} of in-domain rows served"
+                  f"{'; fails ' + ', '.join(failed) + ': not served' if failed else ''}).")
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"ERROR: price table build for '{model_set.version}' failed; requests use the models.")
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                if self._building == model_set.version:
+                    self._building = None
+
+    # Rebuilds the table for model_set in the background, replacing any saved one
+    def rebuild(self, model_set):
+        with self._lock:
+            if self._building is not None:
+                return False
+            self._pid = os.getpid()
+            self._start_build(model_set, force=True)
+        return True
+
+    def stats(self):
+        table = self._table
+        return {
+            "directory": self.directory,
+            "max_price_error": self.max_price_error,
+            "min_segment_agreement": self.min_segment_agreement,
+            "max_probability_error": self.max_probability_error,
+            "grid": self.grid,
+            "failed_gates": self.failed_gates(table) if table is not None else None,
+            "building": self._building,
+            "serving": table is not None and self._usable(table),
+            "last_error": self.last_error,
+            "table": table.describe() if table is not None else None,
+        }
+
+
+if __name__ == '__main__':
+    from model_bundle import ModelSet, load_current_bundle
+    from model_schema import BUNDLES_DIR, CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES
+    from pricing import PricingRulesFile
+
+    parser = argparse.ArgumentParser(description="Build or inspect the precomputed price table.")
+    parser.add_argument('command', choices=['build', 'report'])
+    parser.add_argument('--directory', default=os.environ.get('PRICE_TABLE_DIR', 'trained_models/price_tables'))
+    parser.add_argument('--bundles-dir', default=BUNDLES_DIR)
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--pricing-rules', default=os.environ.get('PRICING_RULES_PATH', 'pricing_rules.json'))
+    # Bucket edge specs (see parse_edges), defaulting to the same environment variables as the app
+    parser.add_argument('--age-edges', default=os.environ.get('PRICE_TABLE_AGE_EDGES', DEFAULT_EDGES))
+    parser.add_argument('--count-edges', default=os.environ.get('PRICE_TABLE_COUNT_EDGES', DEFAULT_EDGES))
+    parser.add_argument('--amount-edges', default=os.environ.get('PRICE_TABLE_AMOUNT_EDGES', DEFAULT_EDGES))
+    parser.add_argument('--error-sample-rows', type=int, default=ERROR_SAMPLE_ROWS)
+    args = parser.parse_args()
+    try:
+        for name, spec in [('Age', args.age_edges), ('User_Product_Count', args.count_edges),
+                           ('Purchase_Amount', args.amount_edges)]:
+            parse_edges(spec, name)
+    except ValueError as e:
+        parser.error(str(e))
+
+    model_set = load_current_bundle(args.bundles_dir)
+    if model_set is None:
+        model_set = ModelSet.from_pickles(args.model_dir, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS, verbose=False)
+    rules = PricingRulesFile(args.pricing_rules).current()
+    if args.command == 'build':
+        with build_lock(args.directory, model_set.version):
+            started = time.perf_counter()
+            table = PriceTable.build(model_set, args.age_edges, args.count_edges, args.amount_edges)
+            print(f"Evaluated {table.n_cells} cells for '{model_set.version}' in {time.perf_counter() - started:.1f}s.")
+            table.measure_error(model_set, rules, args.error_sample_rows)
+            print(f"Table saved to {table.save(args.directory)}")
+    else:
+        table = PriceTable.load(args.directory, model_set.version)
+        if table is None:
+            parser.exit(1, f"No price table for '{model_set.version}' in {args.directory}.\n")
+        table.measure_error(model_set, rules, args.error_sample_rows)
+    print(json.dumps(table.describe(), indent=2))
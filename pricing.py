@@ -0,0 +1,167 @@
+# pricing.py
+#
+# Price optimization rules applied on top of the model outputs.
+# Shared by app.py and the offline tools (batch_score.py) so both price exactly the same way.
+#
+# The rules live in a JSON file (pricing_rules.json by default) so policy changes need no deploy:
+#
+#   {
+#     "default":  {"discount_cap": 0.90, "max_flat_discount": 100, "min_price_factor": 0.70},
+#     "segments": {"Premium Buyer": {"discount_cap": 0.95}, ...}
+#   }
+#
+# discount_cap       lowest price factor the conversion probability may push the price to
+# max_flat_discount  the price never drops more than this amount below the original
+# min_price_factor   the price never drops below original * min_price_factor (0.70 = at most 30% off)
+#
+# Segments inherit any value they do not set from "default". PricingRules compiles the rules into
+# arrays indexed by segment id, so a whole batch is priced with a few NumPy operations.
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+RULE_FIELDS = ('discount_cap', 'max_flat_discount', 'min_price_factor')
+
+# Built-in policy, the Colab notebook's smart_pricing logic; used when no rules file exists
+DEFAULT_PRICING_RULES = {
+    "default": {"discount_cap": 0.90, "max_flat_discount": 100.0, "min_price_factor": 0.70},
+    "segments": {
+        "Premium Buyer": {"discount_cap": 0.95},
+        "Impulse Buyer": {"discount_cap": 0.90},
+        "Bargain Hunter": {"discount_cap": 0.88},
+        "Budget Buyer": {"discount_cap": 0.85},
+        "New Customer": {"discount_cap": 0.85},
+    },
+}
+
+
+class PricingRulesError(ValueError):
+    pass
+
+
+class PricingRules:
+    def __init__(self, config, version='built-in'):
+        self.version = version # the rules file mtime, or 'built-in'
+        self.default = self._validated(config.get('default', {}), DEFAULT_PRICING_RULES['default'], 'default')
+        segments = config.get('segments', {})
+        if not isinstance(segments, dict):
+            raise PricingRulesError("'segments' must be an object keyed by segment label.")
+        self.segments = {label: self._validated(rules, self.default, label) for label, rules in segments.items()}
+        self._compiled = {} # segment_mapping items -> (discount_cap, max_flat_discount, min_price_factor) arrays
+
+    @staticmethod
+    def _validated(rules, inherited, name):
+        if not isinstance(rules, dict):
+            raise PricingRulesError(f"Rules for '{name}' must be an object.")
+        unknown = set(rules) - set(RULE_FIELDS)
+        if unknown:
+            raise PricingRulesError(f"Unknown pricing rule(s) for '{name}': {sorted(unknown)}.")
+        merged = {}
+        for field in RULE_FIELDS:
+            value = rules.get(field, inherited[field])
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value) or value < 0:
+                raise PricingRulesError(f"'{field}' for '{name}' must be a non-negative number.")
+            merged[field] = float(value)
+        return merged
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            try:
+                config = json.load(f)
+            except json.JSONDecodeError as e:
+                raise PricingRulesError(f"{path} is not valid JSON: {e}.")
+            version = str(os.fstat(f.fileno()).st_mtime_ns)
+        if not isinstance(config, dict):
+            raise PricingRulesError(f"{path} must contain a JSON object.")
+        return cls(config, version)
+
+    def rules_for(self, segment_label):
+        return self.segments.get(segment_label, self.default)
+
+    # Rule arrays indexed by segment id for one segment_mapping ({id: label}). The extra last slot holds
+    # the default rules, used for ids the mapping does not know (the "Unknown Segment" case).
+    def compile(self, segment_mapping):
+        key = tuple(sorted(segment_mapping.items()))
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            size = max(segment_mapping, default=-1) + 2
+            compiled = tuple(np.full(size, self.default[field]) for field in RULE_FIELDS)
+            for segment_id, label in segment_mapping.items():
+                if segment_id >= 0:
+                    for array, field in zip(compiled, RULE_FIELDS):
+                        array[segment_id] = self.rules_for(label)[field]
+            self._compiled[key] = compiled
+        return compiled
+
+    # Optimized prices for whole arrays of original prices, conversion probabilities and segment ids
+    def apply(self, original_prices, conversion_probs, segment_ids, segment_mapping):
+        discount_cap, max_flat_discount, min_price_factor = self.compile(segment_mapping)
+        original_prices = np.asarray(original_prices, dtype=np.float64)
+        segment_ids = np.asarray(segment_ids, dtype=np.intp)
+        default_slot = len(discount_cap) - 1
+        index = np.where((segment_ids >= 0) & (segment_ids < default_slot), segment_ids, default_slot)
+
+        prices = original_prices * np.maximum(discount_cap[index], conversion_probs)
+        np.maximum(prices, original_prices - max_flat_discount[index], out=prices)
+        np.maximum(prices, original_prices * min_price_factor[index], out=prices)
+        np.maximum(prices, 0.0, out=prices)
+        return prices
+
+    # Scalar form of apply(), same arithmetic
+    def price(self, original_price, conversion_prob, segment_label):
+        rules = self.rules_for(segment_label)
+        raw_price = original_price * max(rules['discount_cap'], conversion_prob)
+        capped_by_flat_discount = max(raw_price, original_price - rules['max_flat_discount'])
+        capped_by_percentage = max(capped_by_flat_discount, original_price * rules['min_price_factor'])
+        return max(0.0, capped_by_percentage)
+
+    def describe(self):
+        return {"version": self.version, "default": self.default, "segments": self.segments}
+
+
+# Serves the rules from path, re-reading the file when its mtime changes (checked at most every
+# check_seconds). A missing file means the built-in rules; a broken edit keeps the last good rules.
+class PricingRulesFile:
+    def __init__(self, path, check_seconds=5.0, clock=time.monotonic):
+        self.path = path
+        self.check_seconds = float(check_seconds)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._rules = None
+        self._mtime = None
+        self._next_check = 0.0
+
+    def current(self):
+        if self._rules is not None and self._clock() < self._next_check:
+            return self._rules
+        with self._lock:
+            if self._rules is None or self._clock() >= self._next_check:
+                self._next_check = self._clock() + self.check_seconds
+                self._refresh()
+        return self._rules
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._rules is not None and mtime == self._mtime:
+            return
+        if mtime is None:
+            self._rules, self._mtime = PricingRules(DEFAULT_PRICING_RULES), None
+            return
+        try:
+            rules = PricingRules.from_file(self.path)
+        except (OSError, PricingRulesError) as e:
+            print(f"ERROR: could not load pricing rules from {self.path}: {e} Keeping the previous rules.")
+            if self._rules is None:
+                self._rules = PricingRules(DEFAULT_PRICING_RULES)
+            self._mtime = mtime # do not retry the same broken file on every check
+            return
+        self._rules, self._mtime = rules, mtime
+        print(f"Pricing rules loaded from {self.path} (version {rules.version}).")
@@ -0,0 +1,67 @@
+# profile_cache.py
+#
+# Write-through in-memory cache of user profiles (the users row plus the materialized User_Product_Count).
+# Shared by Flask-Login's load_user and get_user_data_from_db so an authenticated prediction does not
+# touch SQLite at all on a hit. complete_purchase writes the new count through after its commit.
+# The TTL bounds how long another gunicorn worker's purchase can go unseen by this process.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ProfileCache:
+    def __init__(self, max_size=50000, ttl_seconds=30.0, clock=time.monotonic):
+        self.max_size = int(max_size)
+        self.ttl_seconds = float(ttl_seconds)
+        self._clock = clock
+        self._entries = OrderedDict() # user_id -> (expires_at, profile dict)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns a copy of the cached profile or None
+    def get(self, user_id):
+        if self.max_size <= 0:
+            return None
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, user_id, profile):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (self._clock() + self.ttl_seconds, dict(profile))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # Write-through of a committed product count. Counts only grow, so an older value arriving
+    # late from a concurrent purchase never overwrites a newer one.
+    def update_product_count(self, user_id, product_count):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            expires_at, profile = entry
+            if product_count > profile['User_Product_Count']:
+                profile = dict(profile, User_Product_Count=product_count)
+                self._entries[user_id] = (expires_at, profile)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "ttl_seconds": self.ttl_seconds,
+                    "hits": self.hits, "misses": self.misses}
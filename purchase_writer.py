@@ -0,0 +1,124 @@
+# purchase_writer.py
+#
+# Write-behind queue with group commit for purchase ingestion.
+# Request handlers submit a write job (a function taking a connection) and block on the returned Future.
+# A single background writer thread drains the queue every few milliseconds and runs all pending jobs
+# in ONE transaction, each inside its own SAVEPOINT so a failing order is rolled back alone.
+# Futures are resolved only after that transaction has committed, so the client still gets a durable
+# acknowledgement, but N concurrent checkouts share one commit (and one fsync) instead of N.
+
+import atexit
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+
+class WriterOverloaded(Exception):
+    pass
+
+
+class GroupCommitWriter:
+    def __init__(self, database, max_delay_ms=5.0, max_batch=256, max_pending=10000, synchronous='FULL'):
+        self.database = database
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_batch = int(max_batch)
+        self.max_pending = int(max_pending)
+        # The writer's own connection fsyncs every commit; group commit pays for it once per batch
+        self.synchronous = synchronous
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.groups_committed = 0
+        self.jobs_committed = 0
+        self.jobs_failed = 0
+
+    # The writer thread does not survive fork(), so each process starts its own on first use
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='purchase-group-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    # Queues job(conn) for the next group commit and returns a Future with its result
+    def submit(self, job):
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((job, future))
+        except queue.Full:
+            raise WriterOverloaded(f"Purchase write queue is full ({self.max_pending} pending writes).")
+        return future
+
+    # Blocks until everything queued so far is committed (used at interpreter exit)
+    def flush(self, timeout=5.0):
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            return
+        self.submit(lambda conn: None).result(timeout=timeout)
+
+    def _collect_group(self):
+        group = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(group) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        conn = self.database.connection()
+        if self.synchronous:
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        while True:
+            group = self._collect_group()
+            results = []
+            try:
+                with self.database.transaction() as txn:
+                    for i, (job, future) in enumerate(group):
+                        savepoint = f"job_{i}"
+                        txn.execute(f"SAVEPOINT {savepoint}")
+                        try:
+                            results.append((future, job(txn), None))
+                            txn.execute(f"RELEASE {savepoint}")
+                        except Exception as e:
+                            txn.execute(f"ROLLBACK TO {savepoint}")
+                            txn.execute(f"RELEASE {savepoint}")
+                            results.append((future, None, e))
+            except Exception as e:
+                # The commit itself failed: nothing in this group was written
+                traceback.print_exc()
+                for _, future in group:
+                    future.set_exception(e)
+                self.jobs_failed += len(group)
+                continue
+
+            self.groups_committed += 1
+            for future, result, error in results:
+                if error is None:
+                    self.jobs_committed += 1
+                    future.set_result(result)
+                else:
+                    self.jobs_failed += 1
+                    future.set_exception(error)
+
+    def stats(self):
+        return {
+            "running": self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "groups_committed": self.groups_committed,
+            "jobs_committed": self.jobs_committed,
+            "jobs_failed": self.jobs_failed,
+        }
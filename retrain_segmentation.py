@@ -0,0 +1,194 @@
+# retrain_segmentation.py
+#
+# Incremental update of the segmentation (KMeans) centroids from new rows in the purchases table.
+#
+# Starting from the CURRENT bundle (or the pickles), purchases with purchase_id above the bundle's
+# watermark are streamed from SQLite by a single read-only query in purchase_id order, fetched in
+# batches, joined with the buyer's profile, encoded exactly like /predict_price, and folded into the
+# centroids with mini-batch k-means steps:
+#
+#   counts[c] += n_c;   center[c] += (sum of the n_c rows assigned to c - n_c * center[c]) / counts[c]
+#
+# Memory is bounded by --batch-size, however long the history is. Each centroid's running count is
+# stored in the new bundle (kmeans_counts.npy) together with the new watermark, so the next run continues
+# where this one stopped. The first run starts every centroid at --prior-weight rows, which sets how
+# far the notebook's centroids can drift. Centroid ids never change, so segment_mapping and the GB
+# model's CustomerSegment feature stay valid.
+#
+# User_Product_Count is taken as of each purchase, as /predict_price saw it when that order was priced:
+# users.product_count minus the quantities of the buyer's purchases at or after the purchase's
+# purchase_date (one checkout shares a single purchase_date, so the whole order is excluded). That sum is a
+# running total per buyer, newest first, computed with a window function in one pass over the purchases of
+# buyers with new rows (RANGE frame: purchases sharing a purchase_date are peers and all count).
+#
+# purchases does not record the weather, so Weather takes no part in assignment or updates (its
+# centroid coordinates are kept as trained). Time_of_Day comes from the purchase_date hour.
+#
+# The result is written as a new bundle and made CURRENT (unless --no-activate); running workers pick it
+# up within MODEL_RELOAD_CHECK_SECONDS.
+#
+#   python retrain_segmentation.py [--database users_data.db] [--batch-size 2048] [--dry-run]
+
+import argparse
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+import numpy as np
+
+from fast_inference import CentroidAssigner, FastInferenceEngine
+from model_bundle import BundleError, ModelSet, load_current_bundle, write_bundle
+from model_schema import BUNDLES_DIR, CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES
+
+DEFAULT_PRIOR_WEIGHT = 1000.0
+# Segmentation features the purchases table cannot provide
+UNOBSERVED_FEATURES = ('Weather',)
+# purchase_date hour -> Time_of_Day label (hours not listed are Night)
+TIME_OF_DAY_BY_HOUR = {**{h: 'Morning' for h in range(5, 12)}, **{h: 'Afternoon' for h in range(12, 17)},
+                       **{h: 'Evening' for h in range(17, 21)}}
+
+PURCHASES_QUERY = """
+    SELECT p.purchase_id, p.product_category, p.original_price, p.purchase_date,
+           u.age, u.gender, u.city, u.occupation, u.loyalty_tier, u.product_count - p.bought_since
+    FROM (SELECT purchase_id, user_id, product_category, original_price, purchase_date,
+                 SUM(quantity) OVER (PARTITION BY user_id ORDER BY purchase_date DESC
+                                     RANGE BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS bought_since
+          FROM purchases
+          WHERE user_id IN (SELECT user_id FROM purchases WHERE purchase_id > :watermark)) p
+    JOIN users u ON u.id = p.user_id
+    WHERE p.purchase_id > :watermark
+    ORDER BY p.purchase_id
+"""
+
+
+# Yields lists of purchase rows after watermark, batch_size at a time, in purchase_id order. One query on one
+# cursor: the running totals are computed once, and every batch reads the same snapshot of the database.
+def stream_purchases(conn, watermark, batch_size):
+    cursor = conn.execute(PURCHASES_QUERY, {"watermark": watermark})
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
+
+
+def _time_of_day(purchase_date):
+    try:
+        return TIME_OF_DAY_BY_HOUR.get(datetime.fromisoformat(purchase_date).hour, 'Night')
+    except (TypeError, ValueError):
+        return None
+
+
+# Turns joined purchase rows into validated customer dicts; rows with labels the encoder never saw
+# (or unusable values) are dropped. Returns (customer dicts, number dropped).
+def purchases_to_customers(encoder, rows, placeholder_weather):
+    customers = []
+    for (_, category, price, purchase_date, age, gender, city, occupation, loyalty_tier, product_count) in rows:
+        customer = {
+            'Age': age, 'Gender': gender, 'City': city, 'Occupation': occupation, 'Loyalty_Tier': loyalty_tier,
+            'Product_Category': category, 'Weather': placeholder_weather, 'Time_of_Day': _time_of_day(purchase_date),
+            'User_Product_Count': product_count, 'Purchase_Amount': price,
+        }
+        if (not isinstance(age, int) or not 0 < age < 120 or not isinstance(price, (int, float)) or price <= 0
+                or product_count is None or product_count < 0
+                or any(encoder.code(col, customer[col]) is None for col in CATEGORICAL_COLS)):
+            continue
+        customers.append(customer)
+    return customers, len(rows) - len(customers)
+
+
+# One mini-batch k-means step on the observed columns of S (rows in segmentation space). Updates
+# centers and counts in place and returns the cluster assignment of each row.
+def minibatch_update(centers, counts, S, observed):
+    S_obs = S[:, observed]
+    C_obs = centers[:, observed]
+    distances = (C_obs * C_obs).sum(axis=1) - 2.0 * S_obs @ C_obs.T
+    assignment = np.argmin(distances, axis=1)
+    n_per_center = np.bincount(assignment, minlength=len(centers)).astype(np.float64)
+    sums = np.zeros_like(C_obs)
+    np.add.at(sums, assignment, S_obs)
+    touched = n_per_center > 0
+    counts[touched] += n_per_center[touched]
+    step = (sums[touched] - n_per_center[touched, None] * C_obs[touched]) / counts[touched, None]
+    C_obs[touched] += step
+    centers[:, observed] = C_obs
+    return assignment
+
+
+def load_base_model_set(bundles_dir, model_dir):
+    model_set = load_current_bundle(bundles_dir)
+    if model_set is None:
+        model_set = ModelSet.from_pickles(model_dir, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS, verbose=False)
+    if not isinstance(model_set.engine, FastInferenceEngine):
+        raise BundleError("The base models could not be flattened, so they cannot be retrained into a bundle.")
+    return model_set
+
+
+def run(args):
+    base = load_base_model_set(args.bundles_dir, args.model_dir)
+    encoder = base.feature_encoder
+    segmenter = base.engine.segmenter
+    watermark = int(base.metadata.get('segmentation_watermark', 0))
+    centers = np.array(segmenter.centers, dtype=np.float64) # writable copy of the (memory-mapped) centroids
+    counts = (np.array(segmenter.counts, dtype=np.float64) if segmenter.counts is not None
+              else np.full(len(centers), float(args.prior_weight)))
+    observed = np.array([feature not in UNOBSERVED_FEATURES for feature in encoder.segmentation_features])
+    placeholder_weather = encoder.classes['Weather'][0] # encoded but never used: Weather is unobserved
+
+    print(f"Updating segmentation of '{base.version}' from purchases after id {watermark}.")
+    conn = sqlite3.connect(f"file:{os.path.abspath(args.database)}?mode=ro", uri=True)
+    used = dropped = 0
+    new_watermark = watermark
+    try:
+        for rows in stream_purchases(conn, watermark, args.batch_size):
+            customers, n_dropped = purchases_to_customers(encoder, rows, placeholder_weather)
+            dropped += n_dropped
+            if customers:
+                S = encoder.segmentation_matrix(encoder.encode_rows(customers))
+                minibatch_update(centers, counts, S, observed)
+                used += len(customers)
+            new_watermark = rows[-1][0]
+            if args.max_rows and used + dropped >= args.max_rows:
+                break
+    finally:
+        conn.close()
+
+    if new_watermark == watermark:
+        print("No new purchases since the last update; nothing to do.")
+        return None
+    shift = np.linalg.norm(centers - np.asarray(segmenter.centers), axis=1)
+    print(f"Folded in {used} purchases ({dropped} skipped for unknown labels or bad values); watermark {watermark} -> {new_watermark}.")
+    for cluster_id, distance in enumerate(shift):
+        print(f"  segment {cluster_id} ({base.segment_label(cluster_id)}): moved {distance:.4f}, weight {counts[cluster_id]:.0f}")
+    if args.dry_run:
+        print("Dry run: no bundle written.")
+        return None
+
+    engine = FastInferenceEngine(encoder, CentroidAssigner(centers, counts), base.engine.ensemble)
+    metadata = {**base.metadata, "parent_version": base.version, "segmentation_watermark": new_watermark,
+                "segmentation_rows_added": used, "segmentation_updated_at": datetime.now(timezone.utc).isoformat()}
+    model_set = ModelSet(base.version, encoder, engine, base.segment_mapping, base.source, metadata)
+    path = write_bundle(model_set, args.bundles_dir, version=args.version, activate=not args.no_activate)
+    print(f"Bundle written to {path}" + ("" if args.no_activate else " and made current."))
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incrementally update the segmentation centroids from new purchases.")
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'users_data.db'))
+    parser.add_argument('--bundles-dir', default=BUNDLES_DIR)
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--batch-size', type=int, default=2048, help="purchases read and folded in per step")
+    parser.add_argument('--max-rows', type=int, default=0, help="stop after this many purchases (0 = all)")
+    parser.add_argument('--prior-weight', type=float, default=DEFAULT_PRIOR_WEIGHT,
+                        help="rows each centroid counts as on the first incremental run")
+    parser.add_argument('--version', help="name of the new bundle (default: UTC timestamp)")
+    parser.add_argument('--no-activate', action='store_true', help="do not point CURRENT at the new bundle")
+    parser.add_argument('--dry-run', action='store_true', help="report centroid movement without writing a bundle")
+    args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error("--batch-size must be positive")
+    run(args)
@@ -0,0 +1,223 @@
+# shadow.py
+#
+# Shadow evaluation of a candidate model set against live pricing traffic.
+# After the serving models have answered, the request hands its encoded rows (the same X the primary scored),
+# original prices and primary outputs to ShadowEvaluator.submit(), which only enqueues them and returns.
+# A small thread pool scores X with the candidate and records how far it diverges from the primary:
+# segment agreement (by label, so renumbered clusters still compare), conversion probability differences
+# and relative differences in the optimized price under the current pricing rules.
+#
+# The primary response never waits on the shadow:
+#   - submit() is a counter check and an executor submit; when max_threads + max_queued evaluations are
+#     already in flight the rows are dropped ("overload") instead of queued
+#   - each evaluation has time_budget seconds from submit() to finish; one still queued at its deadline is
+#     skipped ("expired"), one that finishes after it is discarded ("late"), so a slow candidate can never
+#     build up a backlog
+#   - sample_rate shadows only a fraction of requests
+# The shadow threads still share the worker's CPU (and the GIL outside NumPy), so keep max_threads small.
+#
+# X can only be shared when the candidate encodes rows identically: same row layout, label classes and
+# Purchase_Amount scaler (a new gb_model or updated centroids, not a re-fitted encoder). set_candidate()
+# refuses anything else.
+
+import os
+import random
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Recent per-row differences kept for the percentiles in stats()
+RECENT_ROWS = 10000
+
+
+class ShadowError(ValueError):
+    pass
+
+
+# Whether rows encoded by a can be scored by models built on b
+def encoders_compatible(a, b):
+    return (a.columns == b.columns and a.segmentation_features == b.segmentation_features
+            and a.gb_features == b.gb_features and a.classes == b.classes
+            and a.purchase_amount_mean == b.purchase_amount_mean and a.purchase_amount_scale == b.purchase_amount_scale)
+
+
+def _summary(values):
+    if len(values) == 0:
+        return None
+    return {"mean": float(values.mean()), "p50": float(np.quantile(values, 0.5)), "p95": float(np.quantile(values, 0.95)),
+            "p99": float(np.quantile(values, 0.99)), "max": float(values.max())}
+
+
+class ShadowEvaluator:
+    # pricing_rules_source: callable returning the current PricingRules.
+    # on_evaluated(seconds), if given, is called with the candidate's model time for every evaluation.
+    def __init__(self, pricing_rules_source, max_threads=1, max_queued=32, time_budget=0.25, sample_rate=1.0,
+                 on_evaluated=None):
+        self.pricing_rules_source = pricing_rules_source
+        self.max_threads = int(max_threads)
+        self.limit = self.max_threads + int(max_queued)
+        self.time_budget = float(time_budget)
+        self.sample_rate = float(sample_rate)
+        self.on_evaluated = on_evaluated
+        self.candidate = None
+        self._compatible = (None, None) # (primary version, candidate) last checked by _evaluate
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._in_flight = 0
+        self._reset()
+
+    # Divergence and drop counters start over with every candidate (and every primary version)
+    def _reset(self, primary_version=None):
+        self.primary_version = primary_version
+        self.started_at = time.time()
+        self.counts = Counter() # submitted / evaluated / overload / expired / late / incompatible / error
+        self.rows = 0
+        self.segment_matches = 0
+        self.segment_pairs = Counter() # (primary label, candidate label) -> rows, disagreements only
+        self._prob_diffs = np.zeros(RECENT_ROWS)
+        self._price_diffs = np.zeros(RECENT_ROWS)
+        self._recent = 0 # rows written into the ring buffers so far
+        self._prob_diff_sum = 0.0
+        self._price_diff_sum = 0.0
+        self._prob_diff_max = 0.0
+        self._price_diff_max = 0.0
+        self.last_error = None
+
+    def set_candidate(self, candidate, primary=None):
+        if candidate is not None and primary is not None and not encoders_compatible(primary.feature_encoder,
+                                                                                     candidate.feature_encoder):
+            raise ShadowError(f"'{candidate.version}' encodes rows differently from '{primary.version}' "
+                              "(classes, feature layout or scaler), so it cannot score the primary's rows.")
+        with self._lock:
+            self.candidate = candidate
+            self._reset(primary.version if primary is not None else None)
+
+    @property
+    def active(self):
+        return self.candidate is not None
+
+    # Threads do not survive fork(), so each worker process gets its own executor on first use
+    def _ensure_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.max_threads, thread_name_prefix='shadow')
+            self._pid = os.getpid()
+            self._in_flight = 0
+        return self._executor
+
+    # Queues one evaluation and returns at once; never raises into the request
+    def submit(self, primary, X, original_prices, cluster_ids, conversion_probabilities):
+        candidate = self.candidate
+        if candidate is None or candidate is primary or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return False
+        deadline = time.monotonic() + self.time_budget
+        with self._lock:
+            executor = self._ensure_executor()
+            self.counts['submitted'] += 1
+            if self._in_flight >= self.limit:
+                self.counts['overload'] += 1
+                return False
+            self._in_flight += 1
+        try:
+            executor.submit(self._evaluate, candidate, primary, X, np.asarray(original_prices, dtype=np.float64),
+                            np.asarray(cluster_ids), np.asarray(conversion_probabilities), deadline)
+        except RuntimeError: # executor shut down at interpreter exit
+            with self._lock:
+                self._in_flight -= 1
+            return False
+        return True
+
+    def _evaluate(self, candidate, primary, X, original_prices, primary_ids, primary_probs, deadline):
+        try:
+            if time.monotonic() > deadline:
+                self._count('expired')
+                return
+            # a hot reload may have brought in a primary with a different encoder since set_candidate()
+            if self._compatible != (primary.version, candidate):
+                if not encoders_compatible(primary.feature_encoder, candidate.feature_encoder):
+                    self._count('incompatible')
+                    return
+                self._compatible = (primary.version, candidate)
+            started = time.perf_counter()
+            candidate_ids, candidate_probs = candidate.predict(X)
+            if self.on_evaluated is not None:
+                self.on_evaluated(time.perf_counter() - started)
+            if time.monotonic() > deadline:
+                self._count('late')
+                return
+            rules = self.pricing_rules_source()
+            primary_prices = rules.apply(original_prices, primary_probs, primary_ids, primary.segment_mapping)
+            candidate_prices = rules.apply(original_prices, candidate_probs, candidate_ids, candidate.segment_mapping)
+            self._record(candidate, primary, primary_ids, candidate_ids, np.abs(candidate_probs - primary_probs),
+                         np.abs(candidate_prices - primary_prices) / np.maximum(primary_prices, 1e-9))
+        except Exception as e:
+            self.last_error = str(e)
+            self._count('error')
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _count(self, result):
+        with self._lock:
+            self.counts[result] += 1
+
+    def _record(self, candidate, primary, primary_ids, candidate_ids, prob_diffs, price_diffs):
+        primary_labels = [primary.segment_label(i) for i in primary_ids]
+        candidate_labels = [candidate.segment_label(i) for i in candidate_ids]
+        with self._lock:
+            if candidate is not self.candidate:
+                return # the candidate was replaced while this evaluation ran
+            if primary.version != self.primary_version:
+                if self.primary_version is not None:
+                    print(f"Shadow: serving models changed to '{primary.version}'; divergence statistics restarted.")
+                self._reset(primary.version)
+            self.counts['evaluated'] += 1
+            self.rows += len(primary_labels)
+            for primary_label, candidate_label in zip(primary_labels, candidate_labels):
+                if primary_label == candidate_label:
+                    self.segment_matches += 1
+                else:
+                    self.segment_pairs[(primary_label, candidate_label)] += 1
+            positions = (self._recent + np.arange(len(prob_diffs))) % RECENT_ROWS
+            self._prob_diffs[positions] = prob_diffs
+            self._price_diffs[positions] = price_diffs
+            self._recent += len(prob_diffs)
+            self._prob_diff_sum += float(prob_diffs.sum())
+            self._price_diff_sum += float(price_diffs.sum())
+            self._prob_diff_max = max(self._prob_diff_max, float(prob_diffs.max()))
+            self._price_diff_max = max(self._price_diff_max, float(price_diffs.max()))
+
+    def stats(self):
+        with self._lock:
+            candidate = self.candidate
+            recent = min(self._recent, RECENT_ROWS)
+            prob_recent, price_recent = self._prob_diffs[:recent].copy(), self._price_diffs[:recent].copy()
+            rows = self.rows
+            result = {
+                "candidate": candidate.describe() if candidate is not None else None,
+                "primary_version": self.primary_version,
+                "since": self.started_at,
+                "threads": self.max_threads,
+                "limit": self.limit,
+                "in_flight": self._in_flight if self._pid == os.getpid() else 0,
+                "time_budget_seconds": self.time_budget,
+                "sample_rate": self.sample_rate,
+                "requests": dict(self.counts),
+                "rows": rows,
+                "segment_agreement": self.segment_matches / rows if rows else None,
+                "segment_disagreements": [{"primary": p, "candidate": c, "rows": n}
+                                          for (p, c), n in self.segment_pairs.most_common()],
+                "probability_abs_diff": {"mean": self._prob_diff_sum / rows, "max": self._prob_diff_max} if rows else None,
+                "price_rel_diff": {"mean": self._price_diff_sum / rows, "max": self._price_diff_max} if rows else None,
+                "last_error": self.last_error,
+            }
+        # percentiles over the most recent rows, computed outside the lock
+        result["recent_rows"] = recent
+        result["recent_probability_abs_diff"] = _summary(prob_recent)
+        result["recent_price_rel_diff"] = _summary(price_recent)
+        return result
@@ -0,0 +1,73 @@
+# spending_summary.py
+#
+# Per-user spending totals by product_category and by month, kept as summary tables
+# (user_category_totals, user_monthly_totals; created by migration 5) that are updated in the same
+# transaction as the purchases themselves. Reading a user's breakdown is then O(categories + months)
+# index lookups instead of an aggregate over their whole purchase history.
+# Also the chunked reader behind the CSV order export.
+
+from collections import defaultdict
+
+CATEGORY_UPSERT = """
+    INSERT INTO user_category_totals (user_id, product_category, lines, quantity, amount) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, product_category) DO UPDATE SET
+        lines = lines + excluded.lines, quantity = quantity + excluded.quantity, amount = amount + excluded.amount
+"""
+MONTHLY_UPSERT = """
+    INSERT INTO user_monthly_totals (user_id, month, lines, quantity, amount) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, month) DO UPDATE SET
+        lines = lines + excluded.lines, quantity = quantity + excluded.quantity, amount = amount + excluded.amount
+"""
+EXPORT_COLUMNS = ('purchase_id', 'purchase_date', 'product_name', 'product_category', 'original_price', 'quantity')
+
+
+# Adds purchase rows (user_id, product_name, product_category, original_price, quantity, purchase_date)
+# to the summary tables, inside the caller's transaction. Rows are combined per key first, so an order
+# costs one UPSERT per distinct category and month rather than one per line.
+# "lines" counts purchase lines (not checkouts), amount is original_price * quantity.
+def record_purchases(conn, purchase_rows):
+    by_category = defaultdict(lambda: [0, 0, 0.0])
+    by_month = defaultdict(lambda: [0, 0, 0.0])
+    for user_id, _, product_category, original_price, quantity, purchase_date in purchase_rows:
+        for totals in (by_category[(user_id, product_category)], by_month[(user_id, purchase_date[:7])]):
+            totals[0] += 1
+            totals[1] += quantity
+            totals[2] += original_price * quantity
+    conn.executemany(CATEGORY_UPSERT, [(*key, *totals) for key, totals in by_category.items()])
+    conn.executemany(MONTHLY_UPSERT, [(*key, *totals) for key, totals in by_month.items()])
+
+
+def _totals_dicts(rows, key_name):
+    return [{key_name: row[0], "lines": row[1], "quantity": row[2], "amount": round(row[3], 2)} for row in rows]
+
+
+# {"by_category": [...], "by_month": [...], "totals": {...}} for one user, from the summary tables only
+def user_summary(conn, user_id):
+    by_category = conn.execute(
+        "SELECT product_category, lines, quantity, amount FROM user_category_totals WHERE user_id = ? "
+        "ORDER BY amount DESC, product_category", (user_id,)).fetchall()
+    by_month = conn.execute(
+        "SELECT month, lines, quantity, amount FROM user_monthly_totals WHERE user_id = ? ORDER BY month",
+        (user_id,)).fetchall()
+    return {
+        "by_category": _totals_dicts(by_category, "product_category"),
+        "by_month": _totals_dicts(by_month, "month"),
+        "totals": {"lines": sum(row[1] for row in by_category), "quantity": sum(row[2] for row in by_category),
+                   "amount": round(sum(row[3] for row in by_category), 2)},
+    }
+
+
+# Yields a user's purchases oldest first as lists of at most chunk_rows EXPORT_COLUMNS tuples. Each chunk is
+# its own keyset query on idx_purchases_user_date, run on connection() at the time it is pulled: no read
+# transaction stays open while a slow client downloads, memory is one chunk, and a streamed response may be
+# pulled on different threads (each with its own connection).
+def iter_purchase_chunks(connection, user_id, chunk_rows=1000):
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM purchases WHERE user_id = ? "
+    rows = connection().execute(query + "ORDER BY purchase_date, purchase_id LIMIT ?", (user_id, chunk_rows)).fetchall()
+    while rows:
+        yield [tuple(row) for row in rows]
+        if len(rows) < chunk_rows:
+            return
+        last_date, last_id = rows[-1][1], rows[-1][0]
+        rows = connection().execute(query + "AND (purchase_date, purchase_id) > (?, ?) ORDER BY purchase_date, purchase_id LIMIT ?",
+                                    (user_id, last_date, last_id, chunk_rows)).fetchall()
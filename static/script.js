@@ -64,6 +64,7 @@ document.addEventListener('DOMContentLoaded', function() {
             cart.push(product);
         }
         localStorage.setItem("cart", JSON.stringify(cart));
+        localStorage.removeItem("cartIdempotencyKey"); // A different cart is a different order
         updateCartCount(); // Update cart count in navbar
         alert(`"${product.name}" added to cart!`);
     }
@@ -335,6 +336,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const removedItem = cart.splice(index, 1);
                 console.log("Removed:", removedItem[0].name);
                 localStorage.setItem("cart", JSON.stringify(cart));
+                localStorage.removeItem("cartIdempotencyKey"); // A different cart is a different order
                 renderCart(); // Re-render the cart display
                 updateCartCount(); // Update cart count in navbar
             }
@@ -384,11 +386,19 @@ document.addEventListener('DOMContentLoaded', function() {
                 
                 confirmPaymentBtn.disabled = true;
                 confirmPaymentBtn.textContent = 'Processing...';
+                // Lets the server recognise a retried submission of this same order: the key is created once per
+                // cart and kept with it until the order is accepted, so retrying after an error resends it
+                let idempotencyKey = localStorage.getItem("cartIdempotencyKey");
+                if (!idempotencyKey) {
+                    idempotencyKey = window.crypto && crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`;
+                    localStorage.setItem("cartIdempotencyKey", idempotencyKey);
+                }
+                let orderAccepted = false;
 
                 try {
                     const response = await fetch('/complete_purchase', {
                         method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
+                        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey },
                         body: JSON.stringify({ cart_items: cart }) // Send entire cart for logging in purchases table
                     });
 
@@ -398,8 +408,13 @@ document.addEventListener('DOMContentLoaded', function() {
                     }
                     const result = await response.json();
                     console.log(result.message);
+                    orderAccepted = true; // 200 (recorded or replayed) or 202 (still being recorded)
 
-                    alert(`✅ Payment of ₹${finalPricePaid.toFixed(2)} successful via ${paymentMethod}! Your purchase history has been updated.`);
+                    if (response.status === 202) {
+                        alert(`✅ Payment of ₹${finalPricePaid.toFixed(2)} successful via ${paymentMethod}! ${result.message}`);
+                    } else {
+                        alert(`✅ Payment of ₹${finalPricePaid.toFixed(2)} successful via ${paymentMethod}! Your purchase history has been updated.`);
+                    }
                     
                 } catch (error) {
                     console.error("Purchase completion error:", error);
@@ -408,9 +423,13 @@ document.addEventListener('DOMContentLoaded', function() {
                     confirmPaymentBtn.disabled = false;
                     confirmPaymentBtn.textContent = 'Confirm Payment';
                     paymentModal.hide(); // Hide modal
+                }
 
-                    // Clear cart and redirect
+                // Only an accepted order clears the cart and its key; after an error both stay, so trying again
+                // resubmits the same order and the server records it at most once
+                if (orderAccepted) {
                     localStorage.removeItem("cart");
+                    localStorage.removeItem("cartIdempotencyKey");
                     localStorage.removeItem("predictedPrice");
                     localStorage.removeItem("predictedProductName");
                     localStorage.removeItem("predictedProductCategory"); 
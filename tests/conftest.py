@@ -0,0 +1,15 @@
+# conftest.py
+#
+# The modules live flat in the repository root and resolve their model and rules paths relative to the
+# working directory, so tests run from the root. Importing app (directly or through asgi) initializes a
+# SQLite database: point it at a throwaway file instead of users_data.db.
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='neuroprice-tests-'), 'users_data.db')
+os.environ.setdefault('MODEL_BUNDLES_DIR', os.path.join(tempfile.mkdtemp(prefix='neuroprice-bundles-'), 'bundles'))
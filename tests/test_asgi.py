@@ -0,0 +1,84 @@
+# test_asgi.py
+
+import asyncio
+import contextvars
+
+from flask import Flask, Response, request, stream_with_context
+
+from asgi import RESPONSE_PIECE_BYTES, BoundedPool, WsgiBridge
+
+request_tag = contextvars.ContextVar('request_tag', default=None)
+CHUNK = b'x' * 1023 + b'\n'
+
+
+def _call(bridge, path, query=b''):
+    messages = []
+
+    async def run():
+        body_sent = False
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.sleep(3600) # the client never disconnects
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': [],
+                 'http_version': '1.1', 'scheme': 'http', 'server': ('test', 80), 'client': ('127.0.0.1', 1)}
+        await bridge(scope, receive, send)
+
+    asyncio.run(run())
+    status = next(m['status'] for m in messages if m['type'] == 'http.response.start')
+    pieces = [m['body'] for m in messages if m['type'] == 'http.response.body']
+    return status, pieces
+
+
+def _bridge(wsgi_app):
+    return WsgiBridge(wsgi_app, BoundedPool('inference', 4, 8), BoundedPool('io', 4, 8), request_timeout=10)
+
+
+def test_stream_with_context_response_spans_pieces():
+    flask_app = Flask(__name__)
+
+    @flask_app.route('/stream')
+    def stream():
+        def generate():
+            for _ in range(int(request.args['n'])):
+                yield request.args['tag'].encode() + CHUNK # needs the request context on every pull
+        return Response(stream_with_context(generate()), mimetype='text/plain')
+
+    n = 4 * RESPONSE_PIECE_BYTES // len(CHUNK) + 10
+    status, pieces = _call(_bridge(flask_app), '/stream', f'n={n}&tag=a'.encode())
+    assert status == 200
+    assert len(pieces) >= 5
+    assert b''.join(pieces) == (b'a' + CHUNK) * n
+
+
+def test_context_variables_follow_the_response_and_do_not_leak():
+    pool = BoundedPool('io', 4, 8)
+    seen = []
+
+    def wsgi_app(environ, start_response):
+        request_tag.set(environ['QUERY_STRING'])
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+
+        def body():
+            for _ in range(3 * RESPONSE_PIECE_BYTES // len(CHUNK) + 10):
+                seen.append(request_tag.get())
+                yield CHUNK
+        return body()
+
+    bridge = WsgiBridge(wsgi_app, BoundedPool('inference', 1, 1), pool, request_timeout=10)
+    for tag in ('first', 'second'):
+        seen.clear()
+        status, pieces = _call(bridge, '/', tag.encode())
+        assert status == 200 and len(pieces) >= 4
+        assert set(seen) == {tag}
+
+    # the pool threads' own contexts were never touched
+    probes = [pool._ensure_executor().submit(request_tag.get) for _ in range(16)]
+    assert {probe.result() for probe in probes} == {None}
@@ -0,0 +1,120 @@
+# test_batch_endpoints.py
+#
+# /predict_price_batch and /predict_price_sweep through the Flask test client, checked against /predict_price
+
+import pytest
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+PRICED_FIELDS = ("customer_segment", "original_price", "optimized_price", "predicted_conversion_probability")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'PRICE_TABLE', False) # every row from the models, as /predict_price without a table
+    return app, app.app.test_client()
+
+
+def _guest(app, **overrides):
+    classes = app.models.feature_encoder.classes
+    customer = {'Age': 34, 'Gender': classes['Gender'][0], 'City': classes['City'][0],
+                'Occupation': classes['Occupation'][0], 'Loyalty_Tier': classes['Loyalty_Tier'][0],
+                'User_Product_Count': 3, 'Product_Category': classes['Product_Category'][0],
+                'Purchase_Amount': 250.0, 'Weather': classes['Weather'][0], 'Time_of_Day': classes['Time_of_Day'][0]}
+    customer.update(overrides)
+    return customer
+
+
+def _single(client, body):
+    response = client.post('/predict_price', json=body)
+    assert response.status_code == 200, response.json
+    return {field: response.json[field] for field in PRICED_FIELDS}
+
+
+def test_batch_prices_each_item_like_predict_price(client):
+    app, client = client
+    context = {key: value for key, value in _guest(app).items() if key not in ('Age', 'Purchase_Amount')}
+    items = [{'Age': 22, 'Purchase_Amount': 40.0}, {'Age': 47, 'Purchase_Amount': 999.99},
+             {'Age': 63, 'Purchase_Amount': 1500.0, 'Weather': app.models.feature_encoder.classes['Weather'][-1]}]
+    response = client.post('/predict_price_batch', json={'context': context, 'items': items})
+    assert response.status_code == 200
+    assert response.json['total_items'] == 3 and response.json['failed_items'] == 0
+    for i, (item, result) in enumerate(zip(items, response.json['results'])):
+        assert result['index'] == i
+        assert {field: result[field] for field in PRICED_FIELDS} == _single(client, {**context, **item})
+
+
+def test_batch_reports_errors_per_item(client):
+    app, client = client
+    items = [_guest(app), _guest(app, Age='abc'), _guest(app, City='Atlantis'), 'not an object',
+             _guest(app, Purchase_Amount=-5), {k: v for k, v in _guest(app).items() if k != 'Weather'}, _guest(app, Age=51)]
+    response = client.post('/predict_price_batch', json={'items': items})
+    assert response.status_code == 200
+    results = response.json['results']
+    assert response.json['failed_items'] == 5
+    assert [result.get('status') for result in results] == [None, 400, 422, 400, 400, 400, None]
+    assert results[1]['error'].startswith("Invalid numeric value")
+    assert "Unseen label for 'City'" in results[2]['error']
+    assert results[3]['error'] == "Each item must be a JSON object."
+    assert results[4]['error'] == "Original purchase amount must be positive."
+    assert "'Weather'" in results[5]['error']
+    # the failures do not disturb the valid items
+    assert {field: results[6][field] for field in PRICED_FIELDS} == _single(client, _guest(app, Age=51))
+    # each failing item gets the error /predict_price gives for it
+    assert client.post('/predict_price', json=items[2]).json['error'] == results[2]['error']
+
+
+def test_batch_size_limits(client, monkeypatch):
+    app, client = client
+    monkeypatch.setattr(app, 'MAX_BATCH_ITEMS', 3)
+    assert client.post('/predict_price_batch', json={'items': [_guest(app)] * 3}).status_code == 200
+    response = client.post('/predict_price_batch', json={'items': [_guest(app)] * 4})
+    assert response.status_code == 413 and "Maximum is 3" in response.json['error']
+    assert client.post('/predict_price_batch', json={'items': []}).status_code == 400
+    assert client.post('/predict_price_batch', json={'items': [_guest(app)], 'context': 'Sunny'}).status_code == 400
+    assert client.post('/predict_price_batch', json=[_guest(app)]).status_code == 400
+
+
+def test_purchase_amount_sweep_matches_predict_price(client):
+    app, client = client
+    amounts = [15.0, 120.5, 480.0, 2500.0]
+    response = client.post('/predict_price_sweep', json={**_guest(app), 'sweep': 'purchase_amount',
+                                                         'purchase_amounts': amounts})
+    assert response.status_code == 200 and response.json['total_points'] == len(amounts)
+    for amount, point in zip(amounts, response.json['points']):
+        assert {field: point[field] for field in PRICED_FIELDS} == _single(client, _guest(app, Purchase_Amount=amount))
+
+    response = client.post('/predict_price_sweep', json={**_guest(app), 'sweep': 'purchase_amount',
+                                                         'purchase_amount_range': {'min': 10, 'max': 50, 'steps': 5}})
+    assert [point['original_price'] for point in response.json['points']] == [10.0, 20.0, 30.0, 40.0, 50.0]
+
+
+def test_weather_time_of_day_sweep_matches_predict_price(client):
+    app, client = client
+    classes = app.models.feature_encoder.classes
+    response = client.post('/predict_price_sweep', json={**_guest(app), 'sweep': 'weather_time_of_day'})
+    assert response.status_code == 200
+    points = response.json['points']
+    assert len(points) == len(classes['Weather']) * len(classes['Time_of_Day'])
+    for point in points:
+        expected = _single(client, _guest(app, Weather=point['Weather'], Time_of_Day=point['Time_of_Day']))
+        assert {field: point[field] for field in PRICED_FIELDS} == expected
+
+
+def test_sweep_limits_and_errors(client, monkeypatch):
+    app, client = client
+    monkeypatch.setattr(app, 'MAX_SWEEP_POINTS', 5)
+    body = {**_guest(app), 'sweep': 'purchase_amount'}
+    assert client.post('/predict_price_sweep', json={**body, 'purchase_amounts': [10.0] * 5}).status_code == 200
+    assert client.post('/predict_price_sweep', json={**body, 'purchase_amounts': [10.0] * 6}).status_code == 413
+    response = client.post('/predict_price_sweep', json={**body, 'purchase_amount_range': {'min': 1, 'max': 9, 'steps': 6}})
+    assert response.status_code == 413 and "Maximum is 5" in response.json['error']
+    assert client.post('/predict_price_sweep', json={**body, 'purchase_amounts': [10.0, 0]}).status_code == 400
+    assert client.post('/predict_price_sweep', json={**body, 'purchase_amounts': ['x']}).status_code == 400
+    assert client.post('/predict_price_sweep', json={**_guest(app), 'sweep': 'age'}).status_code == 400
+    # a bad fixed input fails the whole sweep with /predict_price's error
+    response = client.post('/predict_price_sweep', json={**_guest(app, City='Atlantis'), 'sweep': 'purchase_amount',
+                                                         'purchase_amounts': [10.0, 20.0]})
+    assert response.status_code == 422
+    assert response.json['error'] == client.post('/predict_price', json=_guest(app, City='Atlantis')).json['error']
@@ -0,0 +1,62 @@
+# test_batch_score.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from batch_score import score_frame
+from pricing import DEFAULT_PRICING_RULES, PricingRules
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+# As read from a CSV (every cell a string) and as JSON numbers
+NUMERIC_CASES = [
+    ('Age', '34'), ('Age', '34.7'), ('Age', '34.0'), ('Age', ' 41 '), ('Age', 'abc'), ('Age', '0'), ('Age', '120'),
+    ('Age', 34.7), ('Age', 34.0),
+    ('Purchase_Amount', '250.5'), ('Purchase_Amount', '-3'), ('Purchase_Amount', '0'), ('Purchase_Amount', 'nan'),
+    ('Purchase_Amount', 'inf'), ('Purchase_Amount', '1e3'),
+    ('User_Product_Count', '2'), ('User_Product_Count', '2.5'), ('User_Product_Count', '-1'),
+]
+
+
+@pytest.fixture(scope='module')
+def app_module():
+    import app
+    return app
+
+
+def _customer(model_set, **overrides):
+    customer = {'Age': '30', 'Purchase_Amount': '100.0', 'User_Product_Count': '1'}
+    for col in ['Gender', 'City', 'Occupation', 'Loyalty_Tier', 'Product_Category', 'Weather', 'Time_of_Day']:
+        customer[col] = model_set.feature_encoder.classes[col][0]
+    customer.update(overrides)
+    return customer
+
+
+# A row batch scoring rejects is rejected by /predict_price with the same message, and vice versa
+def test_numeric_validation_matches_predict_price(app_module):
+    model_set = app_module.models
+    customers = [_customer(model_set, **{field: value}) for field, value in NUMERIC_CASES]
+    # object columns, so JSON-style numbers reach score_frame unconverted
+    result = score_frame(model_set, PricingRules(DEFAULT_PRICING_RULES), pd.DataFrame(customers, dtype=object))
+    for (field, value), customer, batch_error in zip(NUMERIC_CASES, customers, result['error']):
+        _, app_error, _ = app_module.build_customer_input(model_set, dict(customer))
+        assert batch_error == (app_error or ''), (field, value)
+
+    errors = dict(zip(NUMERIC_CASES, result['error']))
+    assert errors[('Age', '34')] == ''
+    assert errors[('Age', '34.7')].startswith("Invalid numeric value")
+    assert errors[('Age', 34.7)].startswith("Invalid numeric value")
+    assert errors[('Purchase_Amount', 'nan')] == "Original purchase amount must be positive."
+
+
+def test_valid_rows_are_priced_like_predict_price(app_module):
+    model_set = app_module.models
+    customers = [_customer(model_set, Age=str(age), Purchase_Amount=str(amount)) for age, amount in
+                 [(19, 40.0), (35, 999.99), (64, 2500.0)]]
+    result = score_frame(model_set, PricingRules(DEFAULT_PRICING_RULES), pd.DataFrame(customers, dtype=str))
+    assert list(result['error']) == [''] * 3
+    rows = [app_module.build_customer_input(model_set, customer)[0] for customer in customers]
+    cluster_ids, probabilities = model_set.predict(model_set.feature_encoder.encode_rows(rows))
+    np.testing.assert_allclose(result['predicted_conversion_probability'], probabilities)
+    assert list(result['customer_segment']) == [model_set.segment_label(i) for i in cluster_ids]
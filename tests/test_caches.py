@@ -0,0 +1,128 @@
+# test_caches.py
+#
+# TTL and LRU eviction in PredictionCache and ProfileCache, and what /complete_purchase leaves in them
+
+import pytest
+
+from prediction_cache import PredictionCache
+from profile_cache import ProfileCache
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_prediction_cache_evicts_least_recently_used():
+    cache = PredictionCache(max_size=2, ttl_seconds=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1 # 'b' is now the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    stats = cache.stats()
+    assert stats["size"] == 2 and stats["evictions"] == 1
+    assert (stats["hits"], stats["misses"]) == (3, 1)
+
+
+def test_prediction_cache_entries_expire():
+    clock = FakeClock()
+    cache = PredictionCache(max_size=10, ttl_seconds=5, clock=clock)
+    cache.put('a', 1)
+    clock.now += 4.9
+    assert cache.get('a') == 1
+    clock.now += 0.1 # a hit does not extend the TTL
+    assert cache.get('a') is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["size"] == 0
+    cache.put('a', 2) # a put starts a fresh TTL
+    clock.now += 4
+    assert cache.get('a') == 2
+
+
+def test_disabled_prediction_cache_stores_nothing():
+    cache = PredictionCache(max_size=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None and cache.stats()["size"] == 0
+
+
+def test_profile_cache_ttl_and_lru():
+    clock = FakeClock()
+    cache = ProfileCache(max_size=2, ttl_seconds=30, clock=clock)
+    cache.put('u1', {'User_Product_Count': 1})
+    cache.put('u2', {'User_Product_Count': 2})
+    assert cache.get('u1') == {'User_Product_Count': 1}
+    cache.put('u3', {'User_Product_Count': 3}) # evicts u2, the least recently used
+    assert cache.get('u2') is None
+    clock.now += 30
+    assert cache.get('u1') is None and cache.get('u3') is None
+    assert cache.stats()["size"] == 0
+
+
+def test_profile_cache_returns_copies_and_counts_only_grow():
+    cache = ProfileCache(max_size=10, ttl_seconds=30)
+    cache.put('u1', {'User_Product_Count': 5})
+    cache.get('u1')['User_Product_Count'] = 99 # a caller mutating its copy changes nothing
+    cache.update_product_count('u1', 7)
+    cache.update_product_count('u1', 6) # a late, older count is ignored
+    assert cache.get('u1') == {'User_Product_Count': 7}
+    cache.update_product_count('nobody', 3) # nothing cached: stays uncached
+    assert cache.get('nobody') is None
+    cache.invalidate('u1')
+    assert cache.get('u1') is None
+
+
+# --- After a checkout ---
+# The seed users' cities are not in the models' label classes, so a user the models can price is registered first
+def _login_priceable_user(app, client):
+    classes = app.models.feature_encoder.classes
+    username = 'cache_check_u'
+    if app.get_db_connection().execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone() is None:
+        with app.database.transaction() as conn:
+            conn.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (app.allocate_user_id(conn), username, app.generate_password_hash('cachepass'), 'Cache', 33,
+                          classes['Gender'][0], classes['City'][0], classes['Occupation'][0], classes['Loyalty_Tier'][0]))
+    assert client.post('/login', data={'username': username, 'password': 'cachepass'}).status_code == 302
+    return app.get_db_connection().execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+
+
+def test_checkout_updates_the_cached_profile_and_prediction_keys(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'PRICE_TABLE', False)
+    monkeypatch.setattr(app, 'PURCHASE_WRITE_MODE', 'direct')
+    client = app.app.test_client()
+    user_id = _login_priceable_user(app, client)
+    classes = app.models.feature_encoder.classes
+    body = {'Product_Category': classes['Product_Category'][0], 'Purchase_Amount': 321.0,
+            'Weather': classes['Weather'][0], 'Time_of_Day': classes['Time_of_Day'][0]}
+
+    evaluated = []
+    real_run_models = app.run_models
+
+    def counting_run_models(model_set, X, timer):
+        evaluated.append(X[:, app.models.feature_encoder.column_index['User_Product_Count']].tolist())
+        return real_run_models(model_set, X, timer)
+
+    monkeypatch.setattr(app, 'run_models', counting_run_models)
+    assert client.post('/predict_price', json=body).status_code == 200
+    before = app.profile_cache.get(user_id)['User_Product_Count']
+    assert client.post('/predict_price', json=body).status_code == 200
+    assert len(evaluated) == 1 # the repeat is a prediction cache hit
+
+    cart = {'cart_items': [{'name': 'Cache check', 'category': 'Toys', 'original_price': 15, 'quantity': 2}]}
+    assert client.post('/complete_purchase', json=cart).status_code == 200
+    # the committed count is written through to the profile cache: no stale count for the next prediction
+    stored = app.get_db_connection().execute("SELECT product_count FROM users WHERE id = ?",
+                                              (user_id,)).fetchone()[0]
+    assert app.profile_cache.get(user_id)['User_Product_Count'] == stored == before + 2
+
+    # the new count is a different prediction cache key, so the next price comes from the models
+    evaluated.clear()
+    assert client.post('/predict_price', json=body).status_code == 200
+    assert evaluated == [[before + 2]]
@@ -0,0 +1,111 @@
+# test_fast_inference.py
+#
+# Parity of the flattened evaluator (fast_inference.py) with the pickled sklearn models it replaces, on the
+# notebook's customer data and on edge rows: feature values exactly on (and one float32 step either side of)
+# every split threshold, rows sitting on the centroids, and labels the encoders never saw.
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fast_inference import FastInferenceEngine, sample_feature_rows
+from feature_encoder import FeatureEncoder
+from model_schema import CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES
+
+# Largest allowed gap between probabilities: the logistic is computed in NumPy rather than scipy's expit
+PROBABILITY_TOLERANCE = 1e-15
+
+# The models are fed NumPy rows, as in serving
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+
+def _load(name):
+    with open(os.path.join(MODEL_DIR, f'{name}.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+@pytest.fixture(scope='module')
+def models():
+    label_encoders = _load('label_encoders')
+    encoder = FeatureEncoder.from_sklearn(label_encoders, _load('scaler_purchase_amount'),
+                                          _load('scaler_segmentation_features'), SEGMENTATION_FEATURES, GB_FEATURES,
+                                          CATEGORICAL_COLS)
+    kmeans_model, gb_model = _load('kmeans_model'), _load('gb_model')
+    return encoder, kmeans_model, gb_model, FastInferenceEngine.from_sklearn(encoder, kmeans_model, gb_model)
+
+
+# The training customers, encoded. User_Product_Count is each user's number of rows, as in the notebook.
+@pytest.fixture(scope='module')
+def customer_rows(models):
+    encoder = models[0]
+    frame = pd.read_csv('Segmented_Customers.csv')
+    frame['User_Product_Count'] = frame.groupby('User_ID')['User_ID'].transform('size')
+    known = np.all([frame[col].isin(encoder.classes[col]) for col in CATEGORICAL_COLS], axis=0)
+    return encoder.encode_rows(frame[known].to_dict('records'))
+
+
+def _assert_parity(models, X):
+    encoder, kmeans_model, gb_model, engine = models
+    ref_ids = kmeans_model.predict(encoder.segmentation_matrix(X.copy()))
+    fast_ids = engine.segmenter.predict(encoder.segmentation_matrix(X.copy()))
+    np.testing.assert_array_equal(fast_ids, ref_ids)
+
+    G = encoder.gb_matrix(X.copy(), ref_ids)
+    np.testing.assert_array_equal(engine.ensemble.decision_function(G), gb_model.decision_function(G))
+    np.testing.assert_allclose(engine.ensemble.predict_positive_proba(G), gb_model.predict_proba(G)[:, 1],
+                               rtol=0, atol=PROBABILITY_TOLERANCE)
+
+    fast_ids, fast_probs = engine.predict(X.copy())
+    np.testing.assert_array_equal(fast_ids, ref_ids)
+    np.testing.assert_allclose(fast_probs, gb_model.predict_proba(G)[:, 1], rtol=0, atol=PROBABILITY_TOLERANCE)
+
+
+def test_parity_on_training_customers(models, customer_rows):
+    assert len(customer_rows) > 9000
+    _assert_parity(models, customer_rows)
+
+
+def test_parity_on_sampled_rows(models):
+    _assert_parity(models, sample_feature_rows(models[0], n_rows=5000, seed=1))
+
+
+def test_parity_for_single_rows(models, customer_rows):
+    for row in customer_rows[:50]:
+        _assert_parity(models, row[np.newaxis, :])
+
+
+def test_trees_agree_on_split_thresholds(models, customer_rows):
+    encoder, _, gb_model, engine = models
+    base = encoder.gb_matrix(customer_rows[:1].copy(), np.zeros(1, dtype=np.int64))[0]
+    rows = []
+    for estimator in gb_model.estimators_[:, 0]:
+        tree = estimator.tree_
+        for feature, threshold in zip(tree.feature[tree.feature >= 0], tree.threshold[tree.feature >= 0]):
+            on_split = np.float32(threshold)
+            for value in (threshold, on_split, np.nextafter(on_split, np.float32(-np.inf)),
+                          np.nextafter(on_split, np.float32(np.inf))):
+                row = base.copy()
+                row[feature] = value
+                rows.append(row)
+    G = np.array(rows)
+    assert len(G) > 1000
+    np.testing.assert_array_equal(engine.ensemble.decision_function(G), gb_model.decision_function(G))
+
+
+def test_centroid_assignment_on_centroids(models):
+    _, kmeans_model, _, engine = models
+    centers = kmeans_model.cluster_centers_
+    np.testing.assert_array_equal(engine.segmenter.predict(centers), kmeans_model.predict(centers))
+    np.testing.assert_array_equal(engine.segmenter.predict(centers), np.arange(len(centers)))
+
+
+def test_unseen_labels_are_rejected_before_encoding(models):
+    encoder = models[0]
+    for col in CATEGORICAL_COLS:
+        assert encoder.code(col, 'Not A Label') is None
+        assert encoder.code(col, ['unhashable']) is None
+        assert encoder.code(col, encoder.classes[col][-1]) == len(encoder.classes[col]) - 1
+    assert encoder.code('City', 'New York') is None # the seed users' labels are not in the training data
@@ -0,0 +1,122 @@
+# test_micro_batcher.py
+#
+# Coalescing and load shedding in micro_batcher.MicroBatcher, and the 503 /predict_price answers when it sheds
+
+import threading
+
+import pytest
+
+from micro_batcher import BatcherOverloaded, MicroBatcher
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+
+# process_batch that records each batch and, with block=True, waits for release before answering
+class RecordingProcessor:
+    def __init__(self, block=False):
+        self.batches = []
+        self.release = threading.Event()
+        self.started = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, payloads):
+        self.batches.append(list(payloads))
+        self.started.set()
+        self.release.wait(5)
+        return [payload * 10 for payload in payloads]
+
+
+def test_concurrent_submissions_share_one_batch():
+    processor = RecordingProcessor(block=True)
+    batcher = MicroBatcher(processor, window_ms=50, max_batch_items=64)
+    first = batcher.submit(0)
+    assert processor.started.wait(5) # the worker is busy with the first payload: the rest queue up
+    futures = [batcher.submit(i) for i in range(1, 6)]
+    processor.release.set()
+    assert first.result(timeout=5) == 0
+    assert [future.result(timeout=5) for future in futures] == [10, 20, 30, 40, 50]
+    assert processor.batches == [[0], [1, 2, 3, 4, 5]]
+    stats = batcher.stats()
+    assert stats["batches"] == 2 and stats["items"] == 6 and stats["largest_batch"] == 5
+
+
+def test_batch_closes_at_max_batch_items():
+    processor = RecordingProcessor(block=True)
+    batcher = MicroBatcher(processor, window_ms=1000, max_batch_items=4)
+    first = batcher.submit(0)
+    assert processor.started.wait(5)
+    futures = [batcher.submit(i, n_items=2) for i in range(1, 5)]
+    processor.release.set()
+    assert [future.result(timeout=5) for future in [first, *futures]] == [0, 10, 20, 30, 40]
+    # the 1000 ms window is never waited out: each batch stops at 4 rows
+    assert processor.batches == [[0], [1, 2], [3, 4]]
+
+
+def test_full_queue_sheds_immediately():
+    processor = RecordingProcessor(block=True)
+    batcher = MicroBatcher(processor, window_ms=0, max_pending=2)
+    running = batcher.submit(0)
+    assert processor.started.wait(5)
+    queued = [batcher.submit(1), batcher.submit(2)]
+    with pytest.raises(BatcherOverloaded, match='2 pending'):
+        batcher.submit(3)
+    assert batcher.stats()["shed"] == 1
+    processor.release.set()
+    assert [future.result(timeout=5) for future in [running, *queued]] == [0, 10, 20]
+
+
+def test_failed_batch_fails_its_futures_only():
+    calls = []
+
+    def process(payloads):
+        calls.append(payloads)
+        if len(calls) == 1:
+            raise RuntimeError("model blew up")
+        return payloads
+
+    batcher = MicroBatcher(process, window_ms=0)
+    with pytest.raises(RuntimeError, match='blew up'):
+        batcher.submit('a').result(timeout=5)
+    assert batcher.submit('b').result(timeout=5) == 'b'
+    assert batcher.stats()["failed_batches"] == 1
+
+
+# --- Load shedding through /predict_price ---
+@pytest.fixture
+def batching_app(monkeypatch):
+    import app
+    processor = RecordingProcessor(block=True)
+    monkeypatch.setattr(app, 'INFERENCE_MICRO_BATCHING', True)
+    monkeypatch.setattr(app, 'PRICE_TABLE', False)
+    monkeypatch.setattr(app.prediction_cache, 'get', lambda key: None) # every request reaches the models
+    monkeypatch.setattr(app, 'inference_batcher', MicroBatcher(processor, window_ms=0, max_pending=1))
+    yield app, processor
+    processor.release.set()
+
+
+def _guest(app):
+    classes = app.models.feature_encoder.classes
+    return {'Age': 30, 'User_Product_Count': 1, 'Purchase_Amount': 100.0,
+            **{col: classes[col][0] for col in ['Gender', 'City', 'Occupation', 'Loyalty_Tier', 'Product_Category',
+                                                'Weather', 'Time_of_Day']}}
+
+
+def test_overloaded_batcher_answers_503(batching_app):
+    app, processor = batching_app
+    app.inference_batcher.submit('busy') # occupies the batching thread
+    assert processor.started.wait(5)
+    app.inference_batcher.submit('queued') # fills the queue (max_pending=1)
+    response = app.app.test_client().post('/predict_price', json=_guest(app))
+    assert response.status_code == 503
+    assert response.json['error'] == "Pricing is temporarily overloaded. Please retry shortly."
+    assert app.inference_batcher.stats()["shed"] == 1
+
+
+def test_inference_timeout_answers_503(batching_app, monkeypatch):
+    app, processor = batching_app
+    monkeypatch.setattr(app, 'INFERENCE_TIMEOUT', 0.05)
+    app.inference_batcher.submit('busy')
+    assert processor.started.wait(5)
+    response = app.app.test_client().post('/predict_price_batch', json={'items': [_guest(app)]})
+    assert response.status_code == 503
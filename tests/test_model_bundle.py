@@ -0,0 +1,151 @@
+# test_model_bundle.py
+#
+# Bundle write/load (model_bundle.py) and the app's hot reload: reload_models_if_changed and /admin/models/reload
+
+import contextlib
+import os
+
+import numpy as np
+import pytest
+
+from fast_inference import sample_feature_rows
+from model_bundle import (BundleError, ModelSet, current_version, load_bundle, load_current_bundle,
+                          set_current_version, write_bundle)
+from model_schema import CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+
+@pytest.fixture(scope='module')
+def model_set():
+    return ModelSet.from_pickles(MODEL_DIR, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS, verbose=False)
+
+
+# Flips one byte near the end of an array file (inside the data, after the .npy header)
+def _corrupt(bundle_path, name='gb_threshold.npy'):
+    with open(os.path.join(bundle_path, name), 'r+b') as f:
+        f.seek(-3, os.SEEK_END)
+        byte = f.read(1)
+        f.seek(-3, os.SEEK_END)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def test_bundle_round_trip(model_set, tmp_path):
+    path = write_bundle(model_set, str(tmp_path), version='v1')
+    assert current_version(str(tmp_path)) == 'v1'
+    loaded = load_current_bundle(str(tmp_path))
+    assert loaded.version == 'v1' and loaded.source == os.path.abspath(path)
+    assert loaded.segment_mapping == model_set.segment_mapping
+    assert loaded.feature_encoder.classes == model_set.feature_encoder.classes
+
+    X = sample_feature_rows(model_set.feature_encoder, n_rows=500)
+    expected_ids, expected_probs = model_set.predict(X.copy())
+    ids, probs = loaded.predict(X.copy())
+    np.testing.assert_array_equal(ids, expected_ids)
+    np.testing.assert_array_equal(probs, expected_probs)
+
+    with pytest.raises(BundleError, match='already exists'):
+        write_bundle(model_set, str(tmp_path), version='v1')
+
+
+def test_corrupted_bundle_is_rejected(model_set, tmp_path):
+    path = write_bundle(model_set, str(tmp_path), version='v1')
+    _corrupt(path)
+    with pytest.raises(BundleError, match='Checksum mismatch'):
+        load_bundle(path)
+    with pytest.raises(BundleError, match='Checksum mismatch'):
+        load_current_bundle(str(tmp_path))
+    assert load_bundle(path, verify_checksums=False).version == 'v1'
+
+
+def test_activate_requires_an_existing_bundle(tmp_path):
+    with pytest.raises(BundleError, match='No bundle'):
+        set_current_version(str(tmp_path), 'missing')
+    assert current_version(str(tmp_path)) is None
+
+
+# --- Hot reload in the app ---
+@pytest.fixture
+def app_bundles(model_set, tmp_path, monkeypatch):
+    import app
+    bundles_dir = str(tmp_path / 'bundles')
+    for version in ('v1', 'v2', 'bad'):
+        write_bundle(model_set, bundles_dir, version=version, activate=False)
+    _corrupt(os.path.join(bundles_dir, 'bad'))
+    monkeypatch.setattr(app, 'MODEL_BUNDLES_DIR', bundles_dir)
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'test-token')
+    monkeypatch.setattr(app, 'PRICE_TABLE', False)
+    # the serving set and form options are put back after each test
+    monkeypatch.setattr(app, 'models', app.models)
+    monkeypatch.setattr(app, 'FORM_OPTIONS', app.FORM_OPTIONS)
+    return app, bundles_dir
+
+
+def _rows(model_set, n_rows=4):
+    classes = model_set.feature_encoder.classes
+    return [{'Age': 25 + i, 'Gender': classes['Gender'][0], 'City': classes['City'][0],
+             'Occupation': classes['Occupation'][0], 'Loyalty_Tier': classes['Loyalty_Tier'][0],
+             'User_Product_Count': 2, 'Product_Category': classes['Product_Category'][0],
+             'Purchase_Amount': 120.0 + i, 'Weather': classes['Weather'][0], 'Time_of_Day': classes['Time_of_Day'][0]}
+            for i in range(n_rows)]
+
+
+# Prices rows with the serving set; returns how many rows reached the models (i.e. missed the prediction cache)
+def _model_rows(app, monkeypatch, rows):
+    evaluated = []
+    real_run_models = app.run_models
+
+    def counting_run_models(model_set, X, timer):
+        evaluated.append(len(X))
+        return real_run_models(model_set, X, timer)
+
+    monkeypatch.setattr(app, 'run_models', counting_run_models)
+    app.predict_customer_rows(app.models, rows, lambda stage: contextlib.nullcontext())
+    return sum(evaluated)
+
+
+def test_current_swap_is_picked_up_and_changes_cache_keys(app_bundles, monkeypatch):
+    app, bundles_dir = app_bundles
+    set_current_version(bundles_dir, 'v1')
+    assert app.reload_models_if_changed()
+    assert app.models.version == 'v1'
+    assert not app.reload_models_if_changed() # CURRENT unchanged: nothing to do
+
+    rows = _rows(app.models)
+    X = app.models.feature_encoder.encode_rows(rows)
+    v1_key = app.PredictionCache.make_key('v1', X[0], rows[0]['Purchase_Amount'])
+    assert _model_rows(app, monkeypatch, rows) == len(rows)
+    assert app.prediction_cache.get(v1_key) is not None
+    assert _model_rows(app, monkeypatch, rows) == 0 # served from the cache
+
+    set_current_version(bundles_dir, 'v2')
+    assert app.reload_models_if_changed()
+    assert app.models.version == 'v2'
+    v2_key = app.PredictionCache.make_key('v2', X[0], rows[0]['Purchase_Amount'])
+    assert v2_key != v1_key and app.prediction_cache.get(v2_key) is None
+    assert _model_rows(app, monkeypatch, rows) == len(rows) # v1's cached outputs are not reused
+    assert app.prediction_cache.get(v2_key) is not None
+
+
+def test_bad_bundle_leaves_the_old_models_serving(app_bundles):
+    app, bundles_dir = app_bundles
+    client = app.app.test_client()
+    headers = {'X-Admin-Token': 'test-token'}
+    response = client.post('/admin/models/reload', json={'version': 'v1'}, headers=headers)
+    assert response.status_code == 200 and response.json['serving']['version'] == 'v1'
+    serving = app.models
+
+    response = client.post('/admin/models/reload', json={'version': 'bad'}, headers=headers)
+    assert response.status_code == 400 and 'Checksum mismatch' in response.json['error']
+    assert response.json['serving']['version'] == 'v1'
+    assert app.models is serving
+    assert current_version(bundles_dir) == 'v1' # CURRENT only moves once the bundle has loaded
+
+    assert client.post('/admin/models/reload', json={'version': 'v2'}).status_code == 403
+    assert app.models is serving
+
+    # A CURRENT moved to the bad bundle by hand: the reload fails and v1 keeps serving
+    set_current_version(bundles_dir, 'bad')
+    with pytest.raises(BundleError):
+        app.reload_models_if_changed()
+    assert app.models is serving
@@ -0,0 +1,217 @@
+# test_price_table.py
+
+import contextlib
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from model_bundle import ModelSet
+from model_schema import CATEGORICAL_COLS, GB_FEATURES, MODEL_DIR, SEGMENTATION_FEATURES
+from price_table import PriceTable, PriceTableManager, parse_edges
+from pricing import DEFAULT_PRICING_RULES, PricingRules
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+PASSING_REPORT = {"segment_agreement": 0.995, "probability_abs_error": {"p99": 0.01}, "price_rel_error": {"p99": 0.02}}
+
+
+@pytest.fixture(scope='module')
+def model_set():
+    return ModelSet.from_pickles(MODEL_DIR, SEGMENTATION_FEATURES, GB_FEATURES, CATEGORICAL_COLS, verbose=False)
+
+
+# Default "splits" edges over a narrow domain: small enough to build in a test
+SMALL_GRID = {"age_edges": "splits:30:36", "count_edges": "splits:0:8", "amount_edges": "splits:40:48"}
+AGES, COUNTS, AMOUNTS = (30, 35), (0, 7), (40.0, 47.99)
+
+
+@pytest.fixture(scope='module')
+def table(model_set):
+    return PriceTable.build(model_set, **SMALL_GRID)
+
+
+def _random_rows(encoder, n_rows, seed, ages=(10, 95), counts=(0, 40), amounts=(1.0, 2000.0)):
+    rng = np.random.default_rng(seed)
+    codes = {col: rng.integers(0, len(encoder.classes[col]), n_rows) for col in encoder.categorical_cols}
+    age = rng.integers(ages[0], ages[1] + 1, n_rows)
+    count = rng.integers(counts[0], counts[1] + 1, n_rows)
+    amount = np.exp(rng.uniform(np.log(amounts[0]), np.log(amounts[1]), n_rows))
+    return encoder.encode_columns(codes, age, count, amount)
+
+
+def test_cells_hold_the_models_outputs_at_their_representative_inputs(model_set, table):
+    encoder = model_set.feature_encoder
+    cells = np.random.default_rng(0).integers(0, table.n_cells, 2000)
+    index = np.unravel_index(cells, table.shape)
+    n_categorical = len(encoder.categorical_cols)
+    ages, counts, amounts = table.representative_inputs()
+    X = encoder.encode_columns(dict(zip(encoder.categorical_cols, index[:n_categorical])), ages[index[n_categorical]],
+                               counts[index[n_categorical + 1]], amounts[index[n_categorical + 2]])
+    served, ids, probs = table.lookup(model_set, X.copy())
+    model_ids, model_probs = model_set.predict(X.copy())
+    assert served.all()
+    np.testing.assert_array_equal(ids, model_ids)
+    np.testing.assert_array_equal(probs, model_probs.astype(np.float32))
+
+
+# No GB split falls inside a bucket, so every served row gets the models' own outputs
+def test_served_rows_match_the_models(model_set, table):
+    X = _random_rows(model_set.feature_encoder, 20000, seed=2, ages=AGES, counts=COUNTS, amounts=AMOUNTS)
+    served, ids, probs = table.lookup(model_set, X)
+    model_ids, model_probs = model_set.predict(X)
+    assert served.mean() > 0.9
+    np.testing.assert_array_equal(ids[served], model_ids[served])
+    np.testing.assert_array_equal(probs[served], model_probs[served].astype(np.float32))
+    # rows the centroids put in another segment than their cell's are the ones that fall back
+    cell_ids = table.segments[table.cell_index(model_set.feature_encoder, X)[0]]
+    np.testing.assert_array_equal(served, cell_ids == model_ids)
+
+
+def test_single_row_lookup_matches_vectorized(model_set, table):
+    X = _random_rows(model_set.feature_encoder, 500, seed=1, ages=(28, 38), counts=(0, 9), amounts=(38.0, 50.0))
+    served, ids, probs = table.lookup(model_set, X)
+    assert 0 < served.sum() < len(X) # the sample covers both sides of the domain edges
+    for i, row in enumerate(X):
+        one_served, one_id, one_prob = table.lookup(model_set, row[np.newaxis, :])
+        assert one_served[0] == served[i]
+        if served[i]:
+            assert (one_id[0], one_prob[0]) == (ids[i], probs[i])
+
+
+@pytest.mark.parametrize('age, count, amount', [(29, 3, 44.0), (36, 3, 44.0), (33, 8, 44.0),
+                                                (33, 3, 39.99), (33, 3, 48.0)])
+def test_rows_outside_the_grid_fall_back(model_set, table, age, count, amount):
+    encoder = model_set.feature_encoder
+    codes = {col: np.zeros(1, dtype=np.int64) for col in encoder.categorical_cols}
+    X = encoder.encode_columns(codes, [age], [count], [amount])
+    assert not table.lookup(model_set, X)[0][0]
+    assert not table.lookup(model_set, np.repeat(X, 2, axis=0))[0].any()
+
+
+def test_split_edges(model_set, table):
+    assert table.age_edges.tolist() == [30, 33, 36] # GB splits Age at 32.0 and 32.5 in this range
+    assert table.count_edges.tolist() == [0, 8] # and never on User_Product_Count
+    points = model_set.split_points('Purchase_Amount_Scaled')
+    encoder = model_set.feature_encoder
+    inside = points[(points > encoder.scale_purchase_amount(40.0)) & (points < encoder.scale_purchase_amount(48.0))]
+    assert len(table.amount_edges) == len(inside) + 2
+
+
+@pytest.mark.parametrize('spec, name, parsed', [
+    ('splits', 'Age', ('splits', (18, 81))),
+    ('splits:20:60', 'Age', ('splits', (20, 60))),
+    ('0,1,3,8,32', 'User_Product_Count', ('edges', (0, 1, 3, 8, 32))),
+    ('geometric:48:5:1000', 'Purchase_Amount', ('geometric', 48, 5.0, 1000.0)),
+    ([5.0, 50.0, 500.0], 'Purchase_Amount', ('edges', (5.0, 50.0, 500.0))),
+])
+def test_parse_edges(spec, name, parsed):
+    assert parse_edges(spec, name) == parsed
+
+
+@pytest.mark.parametrize('spec, name', [('18,30,29', 'Age'), ('18.5,30', 'Age'), ('18', 'Age'), ('splits:1', 'Age'),
+                                        ('geometric:4:18:80', 'Age'), ('0,10', 'Purchase_Amount'), ('a,b', 'Age'),
+                                        ('geometric:0:5:10', 'Purchase_Amount')])
+def test_invalid_edges_are_rejected(spec, name):
+    with pytest.raises(ValueError):
+        parse_edges(spec, name)
+
+
+# Explicit coarse edges; age buckets are still split at the Age_Group bounds
+def test_explicit_edges(model_set):
+    coarse = PriceTable.build(model_set, age_edges=[25, 40], count_edges='0,2', amount_edges='geometric:2:40:48')
+    assert coarse.age_edges.tolist() == [25, 30, 40]
+    assert coarse.shape[-3:] == (2, 1, 2)
+    assert coarse.representative_inputs()[0].tolist() == [27, 34]
+
+
+def test_save_and_load(tmp_path, model_set, table):
+    table.save(str(tmp_path))
+    loaded = PriceTable.load(str(tmp_path), model_set.version)
+    assert loaded.shape == table.shape
+    np.testing.assert_array_equal(loaded.age_edges, table.age_edges)
+    np.testing.assert_array_equal(loaded.segments, table.segments)
+    np.testing.assert_array_equal(loaded.probabilities, table.probabilities)
+    assert PriceTable.load(str(tmp_path), 'no-such-version') is None
+
+
+def test_error_report_measures_the_table(model_set, table):
+    report = table.measure_error(model_set, PricingRules(DEFAULT_PRICING_RULES), n_rows=5000)
+    assert report["served_share"] > 0.9
+    assert report["segment_agreement"] == 1.0
+    assert report["probability_abs_error"]["max"] < 1e-6 # float32 storage only
+    assert report["price_rel_error"]["p99"] < 1e-6
+    assert PriceTableManager('unused').failed_gates(table) == []
+
+
+# A manager with the default gates builds the table, serves it, and the app answers in-domain rows from it
+def test_build_serves_lookups(tmp_path, monkeypatch, model_set):
+    import app
+
+    manager = PriceTableManager(str(tmp_path), pricing_rules_source=lambda: PricingRules(DEFAULT_PRICING_RULES),
+                                grid=SMALL_GRID)
+    assert manager.get(model_set) is None # building on a background thread
+    deadline = time.monotonic() + 60
+    while manager.stats()["building"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert manager.stats()["serving"], manager.stats()
+
+    model_rows = []
+
+    def run_models(model_set, X, timer):
+        model_rows.append(len(X))
+        return model_set.predict(X)
+
+    monkeypatch.setattr(app, 'PRICE_TABLE', True)
+    monkeypatch.setattr(app, 'price_tables', manager)
+    monkeypatch.setattr(app, 'run_models', run_models)
+    monkeypatch.setattr(app.prediction_cache, 'get', lambda key: None)
+    serving = app.models
+    encoder = serving.feature_encoder
+    rng = np.random.default_rng(3)
+    rows = [{**{col: encoder.classes[col][rng.integers(len(encoder.classes[col]))] for col in encoder.categorical_cols},
+             'Age': int(rng.integers(30, 36)), 'User_Product_Count': int(rng.integers(0, 8)),
+             'Purchase_Amount': float(rng.uniform(40.0, 47.9))} for _ in range(200)]
+    cluster_ids, conversion_probabilities = app.predict_customer_rows(serving, rows, lambda stage: contextlib.nullcontext())
+    model_ids, model_probs = serving.predict(encoder.encode_rows(rows))
+    assert sum(model_rows) < 20 # nearly every row came from the table
+    np.testing.assert_array_equal(cluster_ids, model_ids)
+    np.testing.assert_allclose(conversion_probabilities, model_probs, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('report, failed', [
+    (PASSING_REPORT, []),
+    ({**PASSING_REPORT, "segment_agreement": 0.945}, ["segment_agreement"]),
+    ({**PASSING_REPORT, "probability_abs_error": {"p99": 0.31}}, ["probability_abs_error"]),
+    ({**PASSING_REPORT, "price_rel_error": {"p99": 0.2}}, ["price_rel_error"]),
+    ({}, ["segment_agreement", "probability_abs_error", "price_rel_error"]),
+])
+def test_gates(tmp_path, model_set, table, report, failed):
+    manager = PriceTableManager(str(tmp_path), max_price_error=0.10, min_segment_agreement=0.99, max_probability_error=0.02)
+    table.report = report
+    assert manager.failed_gates(table) == failed
+    table.save(str(tmp_path))
+    manager.get(model_set)
+    assert (manager.get(model_set) is not None) == (not failed)
+
+
+def test_one_build_per_directory(tmp_path, monkeypatch, model_set, table):
+    builds = []
+
+    def slow_build(cls, model_set, **kwargs):
+        builds.append(threading.get_ident())
+        time.sleep(0.3)
+        return table
+
+    monkeypatch.setattr(PriceTable, 'build', classmethod(slow_build))
+    monkeypatch.setattr(PriceTable, 'measure_error', lambda self, *args, **kwargs: self.report.update(PASSING_REPORT))
+    # separate managers lock through separate open files, like separate worker processes
+    managers = [PriceTableManager(str(tmp_path), pricing_rules_source=lambda: PricingRules({})) for _ in range(3)]
+    assert all(manager.get(model_set) is None for manager in managers) # all start on a background thread
+    deadline = time.monotonic() + 10
+    while any(manager.stats()["building"] for manager in managers) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(builds) == 1
+    assert all(manager.get(model_set) is not None for manager in managers)
+    assert PriceTable.load(str(tmp_path), model_set.version) is not None
@@ -0,0 +1,77 @@
+# test_pricing.py
+#
+# PricingRules (built-in rules and the shipped pricing_rules.json) against the Colab notebook's smart_pricing
+# logic, kept here as the oracle
+
+import numpy as np
+import pytest
+
+from pricing import DEFAULT_PRICING_RULES, PricingRules
+
+SEGMENT_LABELS = ['Premium Buyer', 'Impulse Buyer', 'Bargain Hunter', 'Budget Buyer', 'New Customer']
+
+
+# Match Colab notebook's smart_pricing logic more closely.
+def calculate_optimized_price(original_price, conversion_prob, segment_label):
+    segment_discount_caps = {
+        'Premium Buyer': 0.95,
+        'Impulse Buyer': 0.90,
+        'Bargain Hunter': 0.88,
+        'Budget Buyer': 0.85,
+        'New Customer': 0.85
+    }
+
+    threshold = segment_discount_caps.get(segment_label, 0.90)
+    price_factor = max(threshold, conversion_prob)
+
+    raw_price = original_price * price_factor
+
+    capped_by_flat_discount = max(raw_price, original_price - 100) # Price should not go below original - 100
+
+    capped_by_percentage = max(capped_by_flat_discount, original_price * 0.70) # Max 30% discount
+
+    return max(0.0, capped_by_percentage)
+
+
+@pytest.fixture(params=['built-in', 'pricing_rules.json'])
+def rules(request):
+    return PricingRules(DEFAULT_PRICING_RULES) if request.param == 'built-in' else PricingRules.from_file(request.param)
+
+
+# Prices on both sides of the 100 flat-discount and 30% caps, probabilities across every discount_cap
+def _cases(n_rows=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    original_prices = np.concatenate([np.exp(rng.uniform(np.log(0.5), np.log(5000.0), n_rows - 6)),
+                                      [0.0, 1.0, 333.33, 1000.0, 1000.01, 10000.0]])
+    conversion_probs = np.concatenate([rng.uniform(0.0, 1.0, n_rows - 6), [0.0, 0.85, 0.88, 0.9, 0.95, 1.0]])
+    return original_prices, conversion_probs
+
+
+def test_built_in_rules_match_the_notebook_caps():
+    assert set(DEFAULT_PRICING_RULES['segments']) == set(SEGMENT_LABELS)
+
+
+def test_price_matches_oracle(rules):
+    original_prices, conversion_probs = _cases()
+    for label in SEGMENT_LABELS + ['Unknown Segment']:
+        for original_price, conversion_prob in zip(original_prices, conversion_probs):
+            assert rules.price(original_price, conversion_prob, label) == \
+                calculate_optimized_price(original_price, conversion_prob, label)
+
+
+def test_apply_matches_oracle(rules):
+    original_prices, conversion_probs = _cases()
+    segment_mapping = dict(enumerate(SEGMENT_LABELS))
+    # -1 and len(SEGMENT_LABELS) are ids the mapping does not know: default rules, as for 'Unknown Segment'
+    segment_ids = np.random.default_rng(1).integers(-1, len(SEGMENT_LABELS) + 1, len(original_prices))
+    expected = [calculate_optimized_price(p, c, segment_mapping.get(int(i), 'Unknown Segment'))
+                for p, c, i in zip(original_prices, conversion_probs, segment_ids)]
+    np.testing.assert_array_equal(rules.apply(original_prices, conversion_probs, segment_ids, segment_mapping),
+                                  expected)
+
+
+def test_segment_overrides_inherit_the_default():
+    rules = PricingRules({"default": {"max_flat_discount": 10}, "segments": {"Premium Buyer": {"discount_cap": 0.5}}})
+    assert rules.price(1000.0, 0.0, 'Premium Buyer') == 990.0
+    assert rules.price(10.0, 0.0, 'Premium Buyer') == 7.0
+    assert rules.price(10.0, 0.0, 'Budget Buyer') == 9.0
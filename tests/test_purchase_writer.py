@@ -0,0 +1,137 @@
+# test_purchase_writer.py
+#
+# Group commit (purchase_writer.py) and idempotent checkouts (app.complete_purchase)
+
+import threading
+
+import pytest
+
+from db import Database
+from purchase_writer import GroupCommitWriter
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'writer.db'))
+    with database.transaction() as conn:
+        conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE)")
+    return database
+
+
+def _labels(database):
+    return sorted(row[0] for row in database.connection().execute("SELECT label FROM orders"))
+
+
+def test_failing_job_is_rolled_back_alone(database):
+    writer = GroupCommitWriter(database, max_delay_ms=200) # long enough for all three jobs to share one group
+
+    def insert(*labels):
+        def job(conn):
+            for label in labels:
+                conn.execute("INSERT INTO orders (label) VALUES (?)", (label,))
+            return labels
+        return job
+
+    futures = [writer.submit(insert('a1', 'a2')),
+               writer.submit(insert('b1', 'a1')), # second row violates UNIQUE: b1 must go too
+               writer.submit(insert('c1'))]
+    assert futures[0].result(timeout=5) == ('a1', 'a2')
+    with pytest.raises(Exception, match='UNIQUE'):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == ('c1',)
+    assert _labels(database) == ['a1', 'a2', 'c1']
+    assert writer.stats()['groups_committed'] == 1
+    assert writer.stats()['jobs_failed'] == 1
+
+
+def test_results_are_released_only_after_commit(database):
+    writer = GroupCommitWriter(database, max_delay_ms=1)
+
+    def job(conn):
+        conn.execute("INSERT INTO orders (label) VALUES ('x')")
+        return 'done'
+
+    future = writer.submit(job)
+    assert future.result(timeout=5) == 'done'
+    assert _labels(database) == ['x'] # read on this thread's connection, not the writer's
+
+
+# synchronous applies to that transaction alone, including when it rolls back; 1 = NORMAL, 2 = FULL
+def test_transaction_synchronous_is_restored(database):
+    conn = database.connection()
+    with database.transaction(synchronous='FULL') as txn:
+        assert txn.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    with pytest.raises(RuntimeError):
+        with database.transaction(synchronous='FULL'):
+            raise RuntimeError
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+
+# --- Idempotent checkouts through the app ---
+@pytest.fixture
+def client():
+    import app as app_module
+    client = app_module.app.test_client()
+    assert client.post('/login', data={'username': 'alice_u', 'password': 'alicepass'}).status_code == 302
+    return app_module, client
+
+
+def _orders(app_module, product_name):
+    return app_module.get_db_connection().execute(
+        "SELECT COUNT(*) FROM purchases WHERE user_id = 'user_001' AND product_name = ?", (product_name,)).fetchone()[0]
+
+
+@pytest.mark.parametrize('mode', ['direct', 'group'])
+def test_retry_with_same_idempotency_key_records_one_order(client, monkeypatch, mode):
+    app_module, client = client
+    monkeypatch.setattr(app_module, 'PURCHASE_WRITE_MODE', mode)
+    cart = {'cart_items': [{'name': f'Idempotent {mode}', 'category': 'Toys', 'original_price': 20, 'quantity': 2}]}
+    headers = {'Idempotency-Key': f'order-{mode}'}
+    first = client.post('/complete_purchase', json=cart, headers=headers)
+    retry = client.post('/complete_purchase', json=cart, headers=headers)
+    assert first.status_code == 200 and 'replayed' not in first.json
+    assert retry.status_code == 200 and retry.json['replayed'] is True
+    assert _orders(app_module, f'Idempotent {mode}') == 1
+    assert client.post('/complete_purchase', json=cart, headers={'Idempotency-Key': 'x' * 129}).status_code == 400
+
+
+# A direct checkout commits with synchronous=FULL, like the group writer; other writes keep NORMAL
+def test_direct_checkout_commits_with_full_sync(client, monkeypatch):
+    app_module, client = client
+    monkeypatch.setattr(app_module, 'PURCHASE_WRITE_MODE', 'direct')
+    levels = []
+    real_write = app_module._write_purchases
+
+    def recording_write(conn, *args):
+        levels.append(conn.execute("PRAGMA synchronous").fetchone()[0])
+        return real_write(conn, *args)
+
+    monkeypatch.setattr(app_module, '_write_purchases', recording_write)
+    cart = {'cart_items': [{'name': 'Durable', 'category': 'Toys', 'original_price': 20, 'quantity': 1}]}
+    assert client.post('/complete_purchase', json=cart).status_code == 200
+    assert levels == [2]
+    assert app_module.get_db_connection().execute("PRAGMA synchronous").fetchone()[0] == 1
+
+
+def test_ack_timeout_is_pending_not_failed(client, monkeypatch):
+    app_module, client = client
+    monkeypatch.setattr(app_module, 'PURCHASE_WRITE_MODE', 'group')
+    monkeypatch.setattr(app_module, 'PURCHASE_ACK_TIMEOUT', 0.05)
+    release = threading.Event()
+    blocker = app_module.purchase_writer.submit(lambda conn: release.wait(5))
+    cart = {'cart_items': [{'name': 'Slow commit', 'category': 'Toys', 'original_price': 20, 'quantity': 1}]}
+    try:
+        response = client.post('/complete_purchase', json=cart, headers={'Idempotency-Key': 'slow-1'})
+    finally:
+        release.set()
+    assert response.status_code == 202
+    assert response.json['status'] == 'pending' and 'Do not resubmit' in response.json['message']
+    blocker.result(timeout=5)
+    app_module.purchase_writer.flush()
+    assert _orders(app_module, 'Slow commit') == 1
+
+    monkeypatch.setattr(app_module, 'PURCHASE_ACK_TIMEOUT', 5)
+    retry = client.post('/complete_purchase', json=cart, headers={'Idempotency-Key': 'slow-1'})
+    assert retry.status_code == 200 and retry.json['replayed'] is True
+    assert _orders(app_module, 'Slow commit') == 1
@@ -0,0 +1,31 @@
+# test_retrain_segmentation.py
+
+import sqlite3
+
+from migrations import migrate
+from retrain_segmentation import stream_purchases
+
+INSERT_PURCHASE = ("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) "
+                   "VALUES (?, ?, ?, ?, ?, ?)")
+
+
+# User_Product_Count is the buyer's total before each order, not today's total
+def test_product_count_is_taken_as_of_the_purchase():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    migrate(conn)
+    conn.execute("INSERT INTO users (id, username, password, name, age, gender, city, occupation, loyalty_tier, product_count) "
+                 "VALUES ('user_001', 'a', 'x', 'A', 30, 'Male', 'Pune', 'Engineer', 'Gold', 0)")
+    orders = [('2026-03-01T10:00:00', [2, 1]), ('2026-01-05T09:00:00', [4]), ('2026-02-10T18:30:00', [1])]
+    for purchase_date, quantities in orders:
+        for quantity in quantities:
+            conn.execute(INSERT_PURCHASE, ('user_001', 'p', 'Toys', 10.0, quantity, purchase_date))
+    # 3 units already bought before the purchases table existed
+    conn.execute("UPDATE users SET product_count = 3 + (SELECT SUM(quantity) FROM purchases)")
+
+    rows = [row for batch in stream_purchases(conn, 0, batch_size=2) for row in batch]
+    assert [row[-1] for row in rows] == [3 + 4 + 1, 3 + 4 + 1, 3, 3 + 4]
+    assert [row[0] for row in rows] == [1, 2, 3, 4]
+
+    # purchases at or below the watermark are not streamed but still count towards the later totals
+    rows = [row for batch in stream_purchases(conn, 2, batch_size=2) for row in batch]
+    assert [(row[0], row[-1]) for row in rows] == [(3, 3), (4, 3 + 4)]
@@ -0,0 +1,180 @@
+# test_shadow.py
+#
+# ShadowEvaluator's drop accounting (overload / expired / late) and what app.predict_customer_rows hands it
+
+import contextlib
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pricing import PricingRules
+from shadow import ShadowError, ShadowEvaluator
+
+pytestmark = pytest.mark.filterwarnings('ignore:X does not have valid feature names')
+
+LABELS = ['Budget', 'Premium']
+
+
+class FakeEncoder:
+    def __init__(self, classes=None):
+        self.columns = ['Age', 'Purchase_Amount']
+        self.segmentation_features = ['Age']
+        self.gb_features = ['Age', 'Purchase_Amount']
+        self.classes = classes or {'City': ['A', 'B']}
+        self.purchase_amount_mean = 100.0
+        self.purchase_amount_scale = 50.0
+
+
+# A model set answering segment 0 / probability 0.5 for every row; predict() waits for release when given
+class FakeModelSet:
+    def __init__(self, version, encoder=None, release=None):
+        self.version = version
+        self.feature_encoder = encoder or FakeEncoder()
+        self.segment_mapping = dict(enumerate(LABELS))
+        self.release = release
+        self.started = threading.Event()
+
+    def predict(self, X):
+        self.started.set()
+        if self.release is not None:
+            self.release.wait(5)
+        return np.zeros(len(X), dtype=np.int64), np.full(len(X), 0.5)
+
+    def segment_label(self, cluster_id):
+        return self.segment_mapping[int(cluster_id)]
+
+    def describe(self):
+        return {"version": self.version}
+
+
+def _evaluator(candidate, primary, **kwargs):
+    evaluator = ShadowEvaluator(lambda: PricingRules({}), **kwargs)
+    evaluator.set_candidate(candidate, primary)
+    return evaluator
+
+
+def _submit(evaluator, primary, n_rows=3, probability=0.5):
+    return evaluator.submit(primary, np.zeros((n_rows, 2)), [100.0] * n_rows, np.zeros(n_rows, dtype=np.int64),
+                            np.full(n_rows, probability))
+
+
+def _wait_idle(evaluator):
+    for _ in range(500):
+        if evaluator.stats()["in_flight"] == 0:
+            return
+        time.sleep(0.01)
+    raise AssertionError("shadow evaluations did not finish")
+
+
+def test_identical_outputs_agree():
+    primary = FakeModelSet('v1')
+    evaluator = _evaluator(FakeModelSet('v2'), primary)
+    assert _submit(evaluator, primary, n_rows=4)
+    _wait_idle(evaluator)
+    stats = evaluator.stats()
+    assert stats["requests"] == {"submitted": 1, "evaluated": 1}
+    assert stats["rows"] == 4
+    assert stats["segment_agreement"] == 1.0
+    assert stats["probability_abs_diff"]["max"] == 0.0
+    assert stats["price_rel_diff"]["max"] == 0.0
+
+
+def test_divergence_is_recorded():
+    primary = FakeModelSet('v1')
+    evaluator = _evaluator(FakeModelSet('v2'), primary)
+    evaluator.submit(primary, np.zeros((2, 2)), [100.0, 100.0], np.array([0, 1]), np.array([0.5, 0.8]))
+    _wait_idle(evaluator)
+    stats = evaluator.stats()
+    assert stats["segment_agreement"] == 0.5
+    assert stats["segment_disagreements"] == [{"primary": "Premium", "candidate": "Budget", "rows": 1}]
+    assert stats["probability_abs_diff"]["max"] == pytest.approx(0.3)
+
+
+# One evaluation running, nothing may queue: the next submit is dropped at once
+def test_overload_drops_instead_of_queueing():
+    release = threading.Event()
+    primary, candidate = FakeModelSet('v1'), FakeModelSet('v2', release=release)
+    evaluator = _evaluator(candidate, primary, max_threads=1, max_queued=0, time_budget=5)
+    try:
+        assert _submit(evaluator, primary)
+        assert candidate.started.wait(5)
+        started = time.monotonic()
+        assert not _submit(evaluator, primary)
+        assert time.monotonic() - started < 0.1
+    finally:
+        release.set()
+    _wait_idle(evaluator)
+    assert evaluator.stats()["requests"] == {"submitted": 2, "overload": 1, "evaluated": 1}
+
+
+# The first evaluation outlives its budget (late) while the second waits behind it past its deadline (expired)
+def test_late_and_expired_evaluations_are_discarded():
+    release = threading.Event()
+    primary, candidate = FakeModelSet('v1'), FakeModelSet('v2', release=release)
+    evaluator = _evaluator(candidate, primary, max_threads=1, max_queued=4, time_budget=0.05)
+    assert _submit(evaluator, primary)
+    assert candidate.started.wait(5)
+    assert _submit(evaluator, primary)
+    time.sleep(0.1)
+    release.set()
+    _wait_idle(evaluator)
+    stats = evaluator.stats()
+    assert stats["requests"] == {"submitted": 2, "late": 1, "expired": 1}
+    assert stats["rows"] == 0
+    assert stats["segment_agreement"] is None
+
+
+def test_incompatible_candidate_is_refused():
+    with pytest.raises(ShadowError):
+        _evaluator(FakeModelSet('v2', FakeEncoder({'City': ['A', 'C']})), FakeModelSet('v1'))
+
+
+# Table-served rows carry the table's approximation, not the serving models' outputs: only the rest are shadowed
+def test_price_table_rows_are_not_shadowed(monkeypatch):
+    import app
+
+    class HalfTable:
+        def lookup(self, encoder, X):
+            in_domain = np.arange(len(X)) % 2 == 0
+            return in_domain, np.full(len(X), 7, dtype=np.int64), np.full(len(X), 0.99)
+
+    class RecordingShadow:
+        active = True
+        submitted = []
+
+        def submit(self, primary, X, original_prices, cluster_ids, conversion_probabilities):
+            self.submitted.append((X, original_prices, cluster_ids, conversion_probabilities))
+
+    shadow = RecordingShadow()
+    monkeypatch.setattr(app, 'PRICE_TABLE', True)
+    monkeypatch.setattr(app.price_tables, 'get', lambda model_set: HalfTable())
+    monkeypatch.setattr(app, 'shadow_evaluator', shadow)
+    model_set = app.models
+    rows = [{'Age': 20 + i, 'Gender': model_set.feature_encoder.classes['Gender'][0],
+             'City': model_set.feature_encoder.classes['City'][0],
+             'Occupation': model_set.feature_encoder.classes['Occupation'][0],
+             'Loyalty_Tier': model_set.feature_encoder.classes['Loyalty_Tier'][0], 'User_Product_Count': 3,
+             'Product_Category': model_set.feature_encoder.classes['Product_Category'][0],
+             'Purchase_Amount': 100.0 + i, 'Weather': model_set.feature_encoder.classes['Weather'][0],
+             'Time_of_Day': model_set.feature_encoder.classes['Time_of_Day'][0]} for i in range(5)]
+
+    cluster_ids, conversion_probabilities = app.predict_customer_rows(model_set, rows,
+                                                                      lambda stage: contextlib.nullcontext())
+    model_ids, model_probs = model_set.predict(model_set.feature_encoder.encode_rows(rows))
+    np.testing.assert_array_equal(cluster_ids[1::2], model_ids[1::2])
+    assert list(conversion_probabilities[::2]) == [0.99] * 3
+
+    [(X, original_prices, shadow_ids, shadow_probs)] = shadow.submitted
+    assert len(X) == 2
+    assert list(original_prices) == [101.0, 103.0]
+    np.testing.assert_array_equal(shadow_ids, model_ids[1::2])
+    np.testing.assert_allclose(shadow_probs, model_probs[1::2])
+
+    # every row from the table: nothing to shadow
+    monkeypatch.setattr(HalfTable, 'lookup', lambda self, encoder, X: (np.ones(len(X), dtype=bool),
+                                                                         np.zeros(len(X), dtype=np.int64),
+                                                                         np.full(len(X), 0.5)))
+    app.predict_customer_rows(model_set, rows, lambda stage: contextlib.nullcontext())
+    assert len(shadow.submitted) == 1
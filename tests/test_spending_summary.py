@@ -0,0 +1,90 @@
+# test_spending_summary.py
+
+import random
+import sqlite3
+
+import pytest
+
+from migrations import MIGRATIONS, migrate
+from spending_summary import EXPORT_COLUMNS, iter_purchase_chunks, record_purchases, user_summary
+
+INSERT_PURCHASE = ("INSERT INTO purchases (user_id, product_name, product_category, original_price, quantity, purchase_date) "
+                   "VALUES (?, ?, ?, ?, ?, ?)")
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    migrate(conn)
+    return conn
+
+
+# Random orders as complete_purchase builds them: one timestamp per order, several lines
+def _orders(n_orders, seed=0):
+    rng = random.Random(seed)
+    for i in range(n_orders):
+        user_id = rng.choice(['user_001', 'user_002', 'user_003'])
+        date = f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:{i % 60:02d}"
+        yield [(user_id, f'p{i}-{line}', rng.choice(['Toys', 'Electronics', 'Clothing']),
+                round(rng.uniform(1, 500), 2), rng.randint(1, 4), date) for line in range(rng.randint(1, 4))]
+
+
+def _write(conn, rows):
+    conn.executemany(INSERT_PURCHASE, rows)
+    record_purchases(conn, rows)
+
+
+def _aggregate(conn, key_sql, table, key_column):
+    expected = conn.execute(
+        f"SELECT user_id, {key_sql}, COUNT(*), SUM(quantity), SUM(original_price * quantity) FROM purchases "
+        f"GROUP BY 1, 2 ORDER BY 1, 2").fetchall()
+    actual = conn.execute(f"SELECT user_id, {key_column}, lines, quantity, amount FROM {table} ORDER BY 1, 2").fetchall()
+    assert [row[:4] for row in actual] == [row[:4] for row in expected]
+    assert [row[4] for row in actual] == pytest.approx([row[4] for row in expected])
+
+
+def test_incremental_totals_match_an_aggregate_of_purchases(conn):
+    for rows in _orders(300):
+        _write(conn, rows)
+    _aggregate(conn, 'product_category', 'user_category_totals', 'product_category')
+    _aggregate(conn, 'SUBSTR(purchase_date, 1, 7)', 'user_monthly_totals', 'month')
+
+
+def test_summary_reads(conn):
+    _write(conn, [('user_001', 'a', 'Toys', 10.0, 2, '2026-01-05T10:00:00'),
+                  ('user_001', 'b', 'Toys', 5.5, 1, '2026-02-05T10:00:00'),
+                  ('user_001', 'c', 'Electronics', 100.0, 1, '2026-02-06T10:00:00'),
+                  ('user_002', 'd', 'Toys', 1.0, 1, '2026-02-06T10:00:00')])
+    summary = user_summary(conn, 'user_001')
+    assert summary["by_category"] == [
+        {"product_category": "Electronics", "lines": 1, "quantity": 1, "amount": 100.0},
+        {"product_category": "Toys", "lines": 2, "quantity": 3, "amount": 25.5}]
+    assert [(m["month"], m["amount"]) for m in summary["by_month"]] == [("2026-01", 20.0), ("2026-02", 105.5)]
+    assert summary["totals"] == {"lines": 3, "quantity": 4, "amount": 125.5}
+    assert user_summary(conn, 'nobody')["totals"] == {"lines": 0, "quantity": 0, "amount": 0}
+
+
+def test_migration_backfills_existing_purchases():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    summaries_version = next(version for version, _, apply in MIGRATIONS if apply.__name__ == '_create_spending_summaries')
+    for version, _, apply in MIGRATIONS:
+        if version < summaries_version:
+            apply(conn)
+    conn.execute(f"PRAGMA user_version = {summaries_version - 1}")
+    for rows in _orders(100, seed=2):
+        conn.executemany(INSERT_PURCHASE, rows) # written before the summary tables existed
+    migrate(conn)
+    _aggregate(conn, 'product_category', 'user_category_totals', 'product_category')
+    _aggregate(conn, 'SUBSTR(purchase_date, 1, 7)', 'user_monthly_totals', 'month')
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 1000])
+def test_export_chunks_cover_every_purchase_in_order(conn, chunk_rows):
+    for rows in _orders(200, seed=3):
+        _write(conn, rows)
+    expected = conn.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM purchases WHERE user_id = 'user_001' "
+                            "ORDER BY purchase_date, purchase_id").fetchall()
+    chunks = list(iter_purchase_chunks(lambda: conn, 'user_001', chunk_rows))
+    assert all(len(chunk) <= chunk_rows for chunk in chunks)
+    assert [row for chunk in chunks for row in chunk] == expected
+    assert list(iter_purchase_chunks(lambda: conn, 'nobody', chunk_rows)) == []
@@ -0,0 +1,72 @@
+# traffic_capture.py
+#
+# Records live request payloads as JSON lines so they can be replayed by benchmarks/run_benchmarks.py.
+# One line per request:
+#   {"ts": 1718000000.123, "endpoint": "/predict_price", "method": "POST", "authenticated": false,
+#    "status": 200, "duration_ms": 1.9, "payload": {...}}
+# Lines are appended under a lock and flushed as they are written, so several threads (and, with O_APPEND,
+# several worker processes) can share one file. sample_rate < 1 records only that fraction of requests,
+# and capture stops once the file reaches max_bytes.
+
+import json
+import os
+import random
+import threading
+import time
+
+
+class TrafficRecorder:
+    def __init__(self, path, sample_rate=1.0, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.sample_rate = float(sample_rate)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self.recorded = 0
+        self.dropped = 0
+
+    # The file object is not shared across fork(); each process opens its own append handle
+    def _handle(self):
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._pid = os.getpid()
+        return self._file
+
+    def record(self, endpoint, method, payload, status, duration_ms, authenticated):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        line = json.dumps({
+            "ts": round(time.time(), 6),
+            "endpoint": endpoint,
+            "method": method,
+            "authenticated": authenticated,
+            "status": status,
+            "duration_ms": round(duration_ms, 3),
+            "payload": payload,
+        }, separators=(',', ':')) + '\n'
+        with self._lock:
+            f = self._handle()
+            if f.tell() + len(line) > self.max_bytes:
+                self.dropped += 1
+                return
+            f.write(line)
+            f.flush()
+            self.recorded += 1
+
+    def stats(self):
+        return {"path": self.path, "sample_rate": self.sample_rate, "max_bytes": self.max_bytes,
+                "recorded": self.recorded, "dropped": self.dropped}
+
+
+# Yields the records of a capture file, skipping blank and truncated lines
+def read_traffic(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue # a partially written last line from a killed process